@@ -0,0 +1,307 @@
+import os
+import logging
+import logging.handlers
+import argparse
+import itertools
+import json
+import math
+import time
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from . import config as g
+from . import models
+from . import io
+
+'''
+Vectorized parameter sweep over the live trading rules. The minute vwaps
+of every symbol in pearson.csv are read from the bar store and aligned on
+one minute index (forward filled), and every pair's signed deviation in
+standard deviations (z, positive when symbol2 is above the model mean) is
+computed from its stored model parameters, giving a pairs x minutes
+matrix. The rules of Trade and signal.main are then replayed minute by
+minute for every point of a parameter grid at once, with the state of all
+(grid point, pair) combinations held in NumPy arrays:
+- open when |z| > to_open, ranked as in signal.rank_trades (outliers
+  above 1.1 * to_open by |z|, the rest by pearson), while fewer than
+  floor(1 / MAX_TRADE_SIZE) trades are open and neither symbol would go
+  past max_symbol of equity net long or short (signal.select_trades),
+- close when |z| drops below close_scale * (0.25, 0.5, 1, 2), the level
+  stepping up every close_weeks weeks held (Trade.close_signal),
+- bail out, and burn the pair, once held more than bail_days when the
+  mean |z| since the start of the day bail_days days back exceeds
+  bail_level (Trade.bail_out_signal, with its window rounded to a day).
+Each trade puts MAX_TRADE_SIZE / 2 of equity long one symbol and short the
+other at the minute's vwap, so it returns half the trade size times the
+difference of the two legs' returns. Hedges, spreads and fills are not
+modelled, and trades still open at the end are marked at the last vwap.
+The grid is split across worker processes, which share the matrices by
+fork.
+
+Reports per grid point: return on equity, utilisation (mean fraction of
+equity in open trades), turnover (notional traded over equity), trades
+opened and bail-outs.
+
+Memory is dominated by the matrices, 4 bytes per symbol-minute and per
+pair-minute: about 1.4 GB for a year of 1,600 pairs over 2,000 symbols.
+'''
+BASE_CLOSE = np.array([0.25, 0.5, 1.0, 2.0])
+DAY = 24 * 60
+DEFAULTS = {'to_open': [g.TO_OPEN_SIGNAL], 'close_scale': [1.0],
+            'close_weeks': [1.0], 'bail_level': [6.0], 'bail_days': [7.0],
+            'max_symbol': [g.MAX_SYMBOL]}
+_data = None # Matrices, shared with worker processes by fork
+
+def read_vwap(symbol, start, end):
+  path = os.path.join(g.minute_bar_dir, symbol + '.csv')
+  frame = pd.read_csv(path, usecols=['timestamp', 'vwap'])
+  frame = frame[frame['timestamp'] != 'timestamp']
+  index = pd.to_datetime(frame['timestamp'], utc=True)
+  s = pd.Series(frame['vwap'].to_numpy(dtype=np.float32), index=index)
+  s = s[(s.index >= start) & (s.index < end)]
+  return s[~s.index.duplicated(keep='last')]
+
+def daily_sums(a, days, block=256):
+  '''
+  Cumulative sums and counts of the finite values of |a| per row, up to
+  the start of each day, computed a block of rows at a time.
+  '''
+  starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+  sums = np.zeros((a.shape[0], len(starts) + 1))
+  counts = np.zeros((a.shape[0], len(starts) + 1))
+  for i in range(0, a.shape[0], block):
+    b = np.abs(a[i:i + block])
+    valid = np.isfinite(b)
+    sums[i:i + block, 1:] = np.cumsum(np.add.reduceat(
+      np.where(valid, b, 0), starts, axis=1, dtype=np.float64), axis=1)
+    counts[i:i + block, 1:] = np.cumsum(np.add.reduceat(
+      valid, starts, axis=1, dtype=np.float64), axis=1)
+  return sums, counts, days[starts]
+
+def load(start, end, limit=None):
+  '''
+  Build the aligned matrices for every pair in pearson.csv that has model
+  parameters and bars in [start, end).
+  '''
+  logger = logging.getLogger(__name__)
+  began = time.monotonic()
+  pearson = io.read_pearson()
+  if limit: pearson = pearson[:limit]
+  models.load(pearson['title'].to_list())
+  pearson = pearson[pearson['title'].isin(models.params.keys())]
+  series = {}
+  for symbol in sorted(set(pearson['symbol1']) | set(pearson['symbol2'])):
+    try: s = read_vwap(symbol, start, end)
+    except FileNotFoundError:
+      logger.warning('%s not in the bar store' % symbol)
+      continue
+    if len(s): series[symbol] = s
+  pearson = pearson[pearson['symbol1'].isin(series.keys()) &
+                    pearson['symbol2'].isin(series.keys())]
+  symbols = sorted(series.keys())
+  frame = pd.concat([series[s] for s in symbols], axis=1, keys=symbols)
+  frame = frame.sort_index().ffill()
+  prices = np.ascontiguousarray(frame.to_numpy(dtype=np.float32).T)
+  column = {s: i for i, s in enumerate(symbols)}
+  x = pearson['symbol1'].map(column).to_numpy(dtype=np.int64)
+  y = pearson['symbol2'].map(column).to_numpy(dtype=np.int64)
+  z = np.empty((len(x), prices.shape[1]), dtype=np.float32)
+  for i, title in enumerate(pearson['title']):
+    p = models.params[title]
+    z[i] = (prices[y[i]] - models.mean(p, prices[x[i]])) / \
+           models.stddev(p, prices[x[i]])
+  minutes = frame.index.asi8 // (60 * 10**9)
+  sums, counts, day_starts = daily_sums(z, minutes // DAY)
+  logger.info('Loaded %s pairs over %s symbols and %s minutes in %.1f seconds' %
+              (len(x), len(symbols), len(minutes), time.monotonic() - began))
+  return {'prices': prices, 'z': z, 'x': x, 'y': y,
+          'pearson': pearson['pearson'].abs().to_numpy(dtype=np.float64),
+          'minutes': minutes, 'sums': sums, 'counts': counts,
+          'day_starts': day_starts}
+
+def make_grid(values):
+  '''
+  The cartesian product of {'parameter': [values]}, as a list of dicts.
+  '''
+  keys = list(DEFAULTS.keys())
+  values = [values.get(k) or DEFAULTS[k] for k in keys]
+  return [dict(zip(keys, v)) for v in itertools.product(*values)]
+
+def simulate(grid):
+  '''
+  Run the rules over _data for every point of grid at once.
+  '''
+  d = _data
+  prices, z, x, y = d['prices'], d['z'], d['x'], d['y']
+  minutes, sums, counts = d['minutes'], d['sums'], d['counts']
+  day_starts = d['day_starts']
+  n_grid, n_pairs = len(grid), z.shape[0]
+  rows = np.arange(n_grid)
+  param = {k: np.array([p[k] for p in grid], dtype=np.float64)
+           for k in DEFAULTS.keys()}
+  to_open = param['to_open'][:, None]
+  levels = param['close_scale'][:, None] * BASE_CLOSE[None, :]
+  close_step = (param['close_weeks'] * 7 * DAY)[:, None]
+  bail_hold = (param['bail_days'] * DAY)[:, None]
+  bail_level = param['bail_level'][:, None]
+  caps = np.floor(param['max_symbol'] * 2 / g.MAX_TRADE_SIZE + 1e-9)
+  slots = math.floor(1 / g.MAX_TRADE_SIZE + 1e-9)
+  # State per (grid point, pair) and (grid point, symbol)
+  is_open = np.zeros((n_grid, n_pairs), dtype=bool)
+  burned = np.zeros((n_grid, n_pairs), dtype=bool)
+  opened = np.zeros((n_grid, n_pairs), dtype=np.int64)
+  side = np.zeros((n_grid, n_pairs))
+  entry_x = np.ones((n_grid, n_pairs))
+  entry_y = np.ones((n_grid, n_pairs))
+  net = np.zeros((n_grid, prices.shape[0]), dtype=np.int64)
+  # Results per grid point
+  pl = np.zeros(n_grid)
+  opens = np.zeros(n_grid, dtype=np.int64)
+  closes = np.zeros(n_grid, dtype=np.int64)
+  bail_outs = np.zeros(n_grid, dtype=np.int64)
+  exposure = np.zeros(n_grid)
+  day = None
+  for t in range(z.shape[1]):
+    s = np.abs(z[:, t]).astype(np.float64)
+    if minutes[t] // DAY != day:
+      day = minutes[t] // DAY
+      today = np.searchsorted(day_starts, day)
+      first = np.searchsorted(day_starts, day - param['bail_days'])
+      window_sum = (sums[:, today][:, None] - sums[:, first]).T
+      window_count = (counts[:, today][:, None] - counts[:, first]).T
+      today_sum = np.zeros(n_pairs)
+      today_count = np.zeros(n_pairs)
+    valid = np.isfinite(s)
+    today_sum = today_sum + np.where(valid, s, 0)
+    today_count = today_count + valid
+    if is_open.any():
+      held = minutes[t] - opened
+      step = np.minimum(held // close_step, 3).astype(np.int64)
+      close = is_open & (s < np.take_along_axis(levels, step, axis=1))
+      mean = (window_sum + today_sum) / np.maximum(window_count +
+                                                   today_count, 1)
+      bail = is_open & ~close & (held > bail_hold) & (mean > bail_level)
+      gi, pi = np.nonzero(close | bail)
+      if len(gi):
+        pl += np.bincount(gi, g.MAX_TRADE_SIZE / 2 * side[gi, pi] *
+                          (prices[x[pi], t] / entry_x[gi, pi] -
+                           prices[y[pi], t] / entry_y[gi, pi]),
+                          minlength=n_grid)
+        closes += np.bincount(gi, minlength=n_grid)
+        bail_outs += np.bincount(gi, bail[gi, pi], minlength=n_grid).astype(
+                       np.int64)
+        long = np.where(side[gi, pi] > 0, x[pi], y[pi])
+        short = np.where(side[gi, pi] > 0, y[pi], x[pi])
+        np.add.at(net, (gi, long), -1)
+        np.add.at(net, (gi, short), 1)
+        is_open[gi, pi] = False
+        burned[gi, pi] = burned[gi, pi] | bail[gi, pi]
+    c = np.flatnonzero(s > param['to_open'].min())
+    if len(c):
+      candidate = ~is_open[:, c] & ~burned[:, c] & (s[c] > to_open)
+      if candidate.any():
+        # Rank per grid point as signal.rank_trades, then walk the ranks
+        # for all grid points together
+        outlier = s[c] > 1.1 * to_open
+        key = np.where(outlier, -s[c], -d['pearson'][c])
+        order = np.lexsort((key, ~outlier, ~candidate), axis=-1)
+        count = is_open.sum(axis=1)
+        for k in range(order.shape[1]):
+          j = order[:, k]
+          ok = candidate[rows, j] & (count < slots)
+          if not ok.any(): break
+          pi = c[j]
+          long = np.where(z[pi, t] > 0, x[pi], y[pi])
+          short = np.where(z[pi, t] > 0, y[pi], x[pi])
+          ok = ok & (net[rows, long] + 1 <= caps) & (net[rows, short] - 1 >= -caps)
+          gi, pi = rows[ok], pi[ok]
+          net[gi, long[ok]] += 1
+          net[gi, short[ok]] -= 1
+          is_open[gi, pi] = True
+          opened[gi, pi] = minutes[t]
+          side[gi, pi] = np.sign(z[pi, t])
+          entry_x[gi, pi] = prices[x[pi], t]
+          entry_y[gi, pi] = prices[y[pi], t]
+          count[gi] += 1
+          opens[gi] += 1
+    exposure += is_open.sum(axis=1)
+  # Mark whatever is still open at the last vwap
+  gi, pi = np.nonzero(is_open)
+  unrealised = np.bincount(gi, g.MAX_TRADE_SIZE / 2 * side[gi, pi] *
+                           (prices[x[pi], -1] / entry_x[gi, pi] -
+                            prices[y[pi], -1] / entry_y[gi, pi]),
+                           minlength=n_grid)
+  n = max(z.shape[1], 1)
+  return [{'params': p, 'return': float(pl[i] + unrealised[i]),
+           'realised': float(pl[i]),
+           'utilisation': float(exposure[i] * g.MAX_TRADE_SIZE / n),
+           'turnover': float((opens[i] + closes[i]) * g.MAX_TRADE_SIZE),
+           'trades': int(opens[i]), 'bail_outs': int(bail_outs[i]),
+           'still_open': int(is_open[i].sum())}
+          for i, p in enumerate(grid)]
+
+def sweep(data, grid, workers=None, chunk=8):
+  '''
+  Simulate grid over data, chunk grid points per task across workers
+  forked processes.
+  '''
+  global _data
+  logger = logging.getLogger(__name__)
+  began = time.monotonic()
+  _data = data
+  chunks = [grid[i:i + chunk] for i in range(0, len(grid), chunk)]
+  workers = min(workers or os.cpu_count(), len(chunks))
+  if workers <= 1: results = [simulate(c) for c in chunks]
+  else:
+    with mp.get_context('fork').Pool(workers) as pool:
+      results = pool.map(simulate, chunks)
+  logger.info('Swept %s grid points over %s pairs and %s minutes in %.1f seconds' %
+              (len(grid), data['z'].shape[0], data['z'].shape[1],
+               time.monotonic() - began))
+  return [r for rs in results for r in rs]
+
+def table(results):
+  keys = list(DEFAULTS.keys())
+  lines = ['  '.join(['%11s' % k for k in keys] +
+                     ['%9s' % k for k in ['return', 'util', 'turnover',
+                                          'trades', 'bail_outs']])]
+  for r in sorted(results, key=lambda r: -r['return']):
+    lines.append('  '.join(['%11g' % r['params'][k] for k in keys] +
+                           ['%9.4f' % r['return'], '%9.4f' % r['utilisation'],
+                            '%9.2f' % r['turnover'], '%9d' % r['trades'],
+                            '%9d' % r['bail_outs']]))
+  return '\n'.join(lines)
+
+def floats(s): return [float(v) for v in s.split(',')]
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Sweep the trading rules '
+                                   'over a parameter grid on stored bars')
+  parser.add_argument('start', help='first timestamp to simulate (UTC)')
+  parser.add_argument('end', help='timestamp to stop at (UTC)')
+  for k, v in DEFAULTS.items():
+    parser.add_argument('--' + k.replace('_', '-'), type=floats,
+                        help='comma separated values (default: %s)' %
+                        ','.join('%g' % x for x in v))
+  parser.add_argument('--pairs', type=int,
+                      help='only the first PAIRS pairs of pearson.csv')
+  parser.add_argument('--workers', type=int,
+                      help='worker processes (default: one per CPU)')
+  parser.add_argument('--json', action='store_true',
+                      help='print the results as JSON')
+  args = parser.parse_args(argv)
+  logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+    handlers=[logging.handlers.WatchedFileHandler(os.environ.get("LOGFILE", "creek-backtest.log"))]
+  )
+  grid = make_grid({k: getattr(args, k) for k in DEFAULTS.keys()})
+  data = load(pd.Timestamp(args.start, tz='UTC'),
+              pd.Timestamp(args.end, tz='UTC'), args.pairs)
+  results = sweep(data, grid, args.workers)
+  if args.json: print(json.dumps(results, indent=2))
+  else: print(table(results))
+  return
+
+if __name__ == '__main__':
+  main()
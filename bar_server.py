@@ -0,0 +1,353 @@
+import os
+import sys
+import argparse
+import glob
+import json
+import logging
+import logging.handlers
+import signal
+import socket
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import config as g
+
+'''
+A resident copy of the bar universe for the batch scripts and notebooks.
+
+creek_interpolate, creek_pearson and creek_tf each read thousands of bar
+files into their module-global frames, keeping only the timestamp and
+vwap. The bar server keeps those two columns of each bar file it has been
+asked for in a block of shared memory (int64 nanoseconds since the epoch,
+then float64 vwaps), reloading a file when its size or mtime changes.
+Clients ask it over BAR_SERVER_SOCKET for a symbol, an interval and an
+optional date range, and get the name of the block and the rows in the
+range back. They map the block and build their frame over it, so the
+vwaps are never copied: not by the client, and not by the pandarallel
+workers it forks, which share the mapping. The UTC index is rebuilt on
+attach, since pandas copies timestamps to localize them.
+
+Blocks are evicted least recently used once they take more than
+BAR_SERVER_BYTES. An evicted block is unlinked, but stays mapped by the
+clients that have it until they detach or exit.
+
+frame(symbol, interval) returns None if no server is running, and the
+stages then read the csv as before.
+
+python bar_server.py [--bytes N] [--preload Hour,Minute]
+python bar_server.py --stats
+'''
+
+def directory(interval):
+  if interval == 'Hour': return g.hour_bar_dir
+  elif interval == 'Minute': return g.minute_bar_dir
+  raise ValueError('Unknown interval %s' % interval)
+
+def nanoseconds(t):
+  t = pd.Timestamp(t)
+  if t.tzinfo is None: t = t.tz_localize('UTC')
+  return t.as_unit('ns').value
+
+class Block():
+  '''
+  The timestamps and vwaps of one bar file in shared memory.
+  '''
+  def __init__(self, path, stat):
+    frame = pd.read_csv(path, usecols=['timestamp', 'vwap'])
+    self.stat = stat
+    self.rows = len(frame)
+    self.nbytes = 16 * self.rows
+    self.shm = shared_memory.SharedMemory(create=True,
+                                          size=max(self.nbytes, 1))
+    self.timestamps = np.ndarray(self.rows, 'i8', self.shm.buf)
+    self.timestamps[:] = pd.DatetimeIndex(pd.to_datetime(
+      frame['timestamp'], utc=True)).as_unit('ns').asi8
+    np.ndarray(self.rows, 'f8', self.shm.buf,
+               8 * self.rows)[:] = frame['vwap'].to_numpy(dtype='f8')
+
+  def range(self, start, end):
+    '''
+    The rows from start to end, both included as in frame[start:end].
+    '''
+    begin = 0 if start is None else int(np.searchsorted(
+      self.timestamps, nanoseconds(start), 'left'))
+    end = self.rows if end is None else int(np.searchsorted(
+      self.timestamps, nanoseconds(end), 'right'))
+    return begin, max(begin, end)
+
+  def reply(self, start, end):
+    begin, end = self.range(start, end)
+    return {'name': self.shm.name, 'rows': self.rows, 'begin': begin,
+            'end': end}
+
+  def close(self):
+    # Unlink first: the memory is freed even if unmapping fails
+    self.shm.unlink()
+    del self.timestamps
+    self.shm.close()
+    return
+
+class Cache():
+  def __init__(self, limit):
+    self.limit = limit
+    self.blocks = OrderedDict() # (symbol, interval): Block, oldest first
+    self.nbytes = 0
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.load_seconds = 0.0
+
+  def get(self, symbol, interval, start=None, end=None):
+    '''
+    {'name', 'rows', 'begin', 'end'}: the block of symbol's bar file,
+    loading it if it is not cached or has changed, and its rows from start
+    to end. The range is found under the lock, so that no other request
+    can evict the block meanwhile. Raises FileNotFoundError if there is
+    no bar file.
+    '''
+    logger = logging.getLogger(__name__)
+    path = os.path.join(directory(interval), symbol + '.csv')
+    st = os.stat(path)
+    stat = (st.st_size, st.st_mtime_ns)
+    k = (symbol, interval)
+    with self.lock:
+      block = self.blocks.get(k)
+      if block is not None and block.stat == stat:
+        self.blocks.move_to_end(k)
+        self.hits += 1
+        return block.reply(start, end)
+      self.misses += 1
+    began = time.monotonic()
+    loaded = Block(path, stat)
+    seconds = time.monotonic() - began
+    logger.info('Loaded %s %s, %s rows in %.2f seconds', symbol, interval,
+                loaded.rows, seconds)
+    with self.lock:
+      self.load_seconds += seconds
+      block = self.blocks.get(k)
+      if block is not None and block.stat == stat:
+        # Another request loaded it meanwhile
+        loaded.close()
+        self.blocks.move_to_end(k)
+        return block.reply(start, end)
+      if block is not None: self.drop(k)
+      self.blocks[k] = loaded
+      self.nbytes += loaded.nbytes
+      while self.nbytes > self.limit and len(self.blocks) > 1:
+        self.evictions += 1
+        self.drop(next(iter(self.blocks)))
+      return loaded.reply(start, end)
+
+  def drop(self, k):
+    block = self.blocks.pop(k)
+    self.nbytes -= block.nbytes
+    block.close()
+    return
+
+  def clear(self):
+    with self.lock:
+      for k in list(self.blocks.keys()): self.drop(k)
+    return
+
+  def stats(self):
+    with self.lock:
+      return {'blocks': len(self.blocks), 'bytes': self.nbytes,
+              'limit': self.limit, 'hits': self.hits, 'misses': self.misses,
+              'evictions': self.evictions,
+              'load_seconds': round(self.load_seconds, 3)}
+
+class Handler(socketserver.StreamRequestHandler):
+  '''
+  One JSON request per line, one JSON reply per line:
+  {"op": "get", "symbol", "interval", "start", "end"}
+    -> {"name", "rows", "begin", "end"} (rows of the block, range begin:end)
+  {"op": "stats"} -> Cache.stats()
+  Errors reply {"error": ...}, "not found" for a missing bar file.
+  '''
+  def handle(self):
+    logger = logging.getLogger(__name__)
+    cache = self.server.cache
+    for line in self.rfile:
+      try:
+        request = json.loads(line)
+        if request['op'] == 'get':
+          reply = cache.get(request['symbol'], request['interval'],
+                            request.get('start'), request.get('end'))
+        elif request['op'] == 'stats': reply = cache.stats()
+        else: reply = {'error': 'unknown op %s' % request['op']}
+      except FileNotFoundError: reply = {'error': 'not found'}
+      except Exception as error:
+        logger.exception('Request %s failed', line)
+        reply = {'error': str(error)}
+      self.wfile.write((json.dumps(reply) + '\n').encode())
+      self.wfile.flush()
+    return
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, path, cache):
+    self.cache = cache
+    super().__init__(path, Handler)
+
+# Client side, per process: forked workers reconnect
+_lock = threading.Lock()
+_connection = None # (pid, socket, file)
+_unavailable = None # pid that found no server
+_attached = {} # block name: SharedMemory
+
+def request(**r):
+  '''
+  Send a request to the bar server, None if none is running.
+  '''
+  global _connection, _unavailable
+  with _lock:
+    pid = os.getpid()
+    if _unavailable == pid: return None
+    if _connection is None or _connection[0] != pid:
+      if not os.path.exists(g.BAR_SERVER_SOCKET): return None
+      s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try: s.connect(g.BAR_SERVER_SOCKET)
+      except OSError:
+        s.close()
+        _unavailable = pid
+        return None
+      _connection = (pid, s, s.makefile('rwb'))
+    f = _connection[2]
+    try:
+      f.write((json.dumps(r) + '\n').encode())
+      f.flush()
+      reply = f.readline()
+    except OSError: reply = b''
+    if not reply:
+      _connection = None
+      _unavailable = pid
+      return None
+    return json.loads(reply)
+
+def attach(name):
+  shm = _attached.get(name)
+  if shm is None:
+    shm = shared_memory.SharedMemory(name=name)
+    # The resource tracker would unlink the server's block when we exit
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    _attached[name] = shm
+  return shm
+
+def frame(symbol, interval, start=None, end=None):
+  '''
+  symbol's bars from start to end (both included, None for all) from the
+  bar server, as the stages build them from the csv: vwap on a UTC
+  timestamp index. The vwaps are read-only views of shared memory:
+  writing to them raises ValueError, so take a .copy() of the frame
+  (in a notebook, say) before modifying it in place. None if no bar
+  server is running. Raises FileNotFoundError if there is no bar file for
+  symbol.
+  '''
+  logger = logging.getLogger(__name__)
+  for attempt in range(2):
+    reply = request(op='get', symbol=symbol, interval=interval,
+                    start=None if start is None else str(start),
+                    end=None if end is None else str(end))
+    if reply is None: return None
+    if reply.get('error') == 'not found':
+      raise FileNotFoundError('%s.csv not found' % symbol)
+    if 'error' in reply.keys():
+      logger.error('Bar server failed to get %s: %s', symbol, reply['error'])
+      return None
+    try:
+      shm = attach(reply['name'])
+      break
+    except FileNotFoundError: continue # evicted since, ask again
+  else: return None
+  rows = reply['rows']
+  timestamps = np.ndarray(rows, 'i8', shm.buf)[reply['begin']:reply['end']]
+  vwaps = np.ndarray(rows, 'f8', shm.buf, 8 * rows)[reply['begin']:reply['end']]
+  timestamps.flags.writeable = False
+  vwaps.flags.writeable = False
+  index = pd.DatetimeIndex(timestamps.view('M8[ns]'), name='timestamp',
+                           copy=False).tz_localize('UTC')
+  return pd.DataFrame({'vwap': vwaps}, index=index, copy=False)
+
+def detach():
+  '''
+  Unmap the blocks no frame uses any more.
+  '''
+  for name in list(_attached.keys()):
+    try: _attached[name].close()
+    except BufferError: continue
+    _attached.pop(name)
+  return
+
+def stats():
+  return request(op='stats')
+
+def preload(cache, intervals):
+  '''
+  Load every bar file of intervals until the cache is full.
+  '''
+  logger = logging.getLogger(__name__)
+  for interval in intervals:
+    for path in sorted(glob.glob(os.path.join(directory(interval), '*.csv'))):
+      cache.get(os.path.basename(path)[:-4], interval)
+      if cache.evictions:
+        logger.info('Cache full, stopped preloading at %s', path)
+        return
+  logger.info('Preloaded %s blocks, %s bytes', len(cache.blocks),
+              cache.nbytes)
+  return
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Serve bars from shared '
+                                   'memory')
+  parser.add_argument('--bytes', type=int, default=g.BAR_SERVER_BYTES,
+                      help='most bytes of bars to keep')
+  parser.add_argument('--preload', help='comma separated intervals to load '
+                      'at start (Hour, Minute)')
+  parser.add_argument('--stats', action='store_true',
+                      help='print the running server\'s stats and exit')
+  args = parser.parse_args(argv)
+  if args.stats:
+    print(json.dumps(stats(), indent=2))
+    return
+  logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+    handlers=[logging.handlers.WatchedFileHandler(os.environ.get("LOGFILE", "creek-bars.log"))]
+  )
+  logger = logging.getLogger(__name__)
+  if os.path.exists(g.BAR_SERVER_SOCKET):
+    if request(op='stats') is not None:
+      logger.error('A bar server is already running on %s',
+                   g.BAR_SERVER_SOCKET)
+      sys.exit(1)
+    os.remove(g.BAR_SERVER_SOCKET)
+  # Writing past the size of /dev/shm would kill the server with SIGBUS
+  st = os.statvfs('/dev/shm')
+  free = st.f_bavail * st.f_frsize
+  if args.bytes > free:
+    logger.warning('Only %s bytes free in /dev/shm, keeping at most that',
+                   free)
+    args.bytes = free
+  cache = Cache(args.bytes)
+  server = Server(g.BAR_SERVER_SOCKET, cache)
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    if args.preload: preload(cache, args.preload.split(','))
+    logger.info('Serving bars on %s, up to %s bytes', g.BAR_SERVER_SOCKET,
+                args.bytes)
+    server.serve_forever()
+  finally:
+    server.server_close()
+    os.remove(g.BAR_SERVER_SOCKET)
+    cache.clear()
+  return
+
+if __name__ == '__main__':
+  main()
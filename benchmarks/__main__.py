@@ -0,0 +1,213 @@
+import os
+import argparse
+import gc
+import json
+import logging
+import logging.handlers
+import multiprocessing as mp
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import traceback
+from datetime import datetime as dt
+import numpy as np
+import pandas as pd
+from .. import config as g
+from .. import io
+from .. import synth
+from . import bench_pipeline
+from . import bench_live
+from . import bench_ranking
+
+'''
+Benchmark runner. Generates (or reuses) a synthetic universe with synth.py
+ending at the last weekday, points config at it and runs every stage of
+bench_pipeline, bench_live and bench_ranking, each in its own forked
+process so that stages cannot disturb each other's module state or peak
+memory. A stage is prepared untimed, run once under tracemalloc for its
+peak traced allocation (which also warms it up), then run repeat more
+times for wall and CPU time. Stages whose dependencies are missing are
+reported as skipped.
+
+Results go to a JSON file tagged with the commit, host and data, so runs
+can be compared across commits and machines:
+
+python -m <package>.benchmarks [--symbols N] [--days N] [--only a,b]
+                               [--out FILE] [--compare OLD.json]
+'''
+STAGES = bench_pipeline.STAGES + bench_live.STAGES + bench_ranking.STAGES
+PACKAGE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def git(*args):
+  try:
+    return subprocess.run(['git', '-C', PACKAGE] + list(args),
+                          capture_output=True, text=True,
+                          check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError): return None
+
+def host():
+  return {'node': platform.node(), 'platform': platform.platform(),
+          'processor': platform.processor() or platform.machine(),
+          'cpus': os.cpu_count(), 'python': platform.python_version(),
+          'numpy': np.__version__, 'pandas': pd.__version__}
+
+def data(args):
+  '''
+  Generate the universe into args.data unless it is already there for the
+  same parameters.
+  '''
+  start = (pd.Timestamp.today().normalize() -
+           pd.offsets.BDay(args.days)).strftime('%Y-%m-%d')
+  spec = {'symbols': args.symbols, 'days': args.days, 'start': start,
+          'seed': args.seed}
+  path = os.path.join(args.data, 'bench.json')
+  try:
+    with open(path, 'r') as f: cached = json.load(f)
+    if cached['spec'] == spec: return cached
+  except (IOError, ValueError, KeyError): pass
+  summary = synth.generate(args.data, workers=args.workers, **spec)
+  cached = {'spec': spec, 'summary': summary}
+  with open(path, 'w') as f: json.dump(cached, f)
+  return cached
+
+def context(args, spec):
+  synth.use(args.data)
+  pearson = io.read_pearson()
+  index = synth.sessions(pd.Timestamp(spec['start']), spec['days'])
+  universe = sorted(f[:-4] for f in os.listdir(g.minute_bar_dir)
+                    if f.endswith('.csv'))
+  return {'data': args.data, 'pearson': pearson,
+          'symbols': sorted(set(pearson['symbol1']) |
+                            set(pearson['symbol2'])),
+          'universe': universe, 'session': (index[-synth.SESSION],
+                                            index[-1] + pd.Timedelta(minutes=1)),
+          'minutes': args.minutes, 'all_pairs': args.all_pairs,
+          'regress_pairs': args.regress_pairs, 'epochs': args.epochs,
+          'combine_pairs': args.combine_pairs,
+          'candidates': args.candidates}
+
+def summary(times):
+  return {'min': min(times), 'median': statistics.median(times),
+          'max': max(times)}
+
+def measure(prepare, ctx, repeat):
+  try: fn, units = prepare(ctx)
+  except ImportError as error: return {'skipped': str(error)}
+  gc.collect()
+  tracemalloc.start()
+  fn()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  wall, cpu = [], []
+  for i in range(repeat):
+    gc.collect()
+    w, c = time.perf_counter(), time.process_time()
+    fn()
+    wall.append(time.perf_counter() - w)
+    cpu.append(time.process_time() - c)
+  return {'units': units, 'wall': summary(wall), 'cpu': summary(cpu),
+          'per_unit': min(wall) / max(units, 1),
+          'peak_traced_mb': peak / 2**20,
+          # ru_maxrss is in kilobytes on Linux
+          'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                        / 2**10}
+
+def child(name, prepare, ctx, repeat, conn):
+  try: result = measure(prepare, ctx, repeat)
+  except Exception:
+    result = {'error': traceback.format_exc().strip().split('\n')[-1]}
+  conn.send(result)
+  conn.close()
+
+def run_stage(name, prepare, ctx, repeat):
+  fork = mp.get_context('fork')
+  receive, send = fork.Pipe(duplex=False)
+  p = fork.Process(target=child, args=(name, prepare, ctx, repeat, send))
+  p.start()
+  send.close()
+  try: result = receive.recv()
+  except EOFError: result = {'error': 'exited with code %s' % p.exitcode}
+  p.join()
+  return result
+
+def table(results, base=None):
+  lines = ['%-16s %10s %12s %12s %10s %10s' % ('stage', 'units', 'wall (s)',
+                                               'per unit', 'peak MB',
+                                               'vs base')]
+  for name, r in results['stages'].items():
+    if 'wall' not in r:
+      lines.append('%-16s %s' % (name, r.get('skipped') and
+                                 'skipped: ' + r['skipped'] or
+                                 'error: ' + r['error']))
+      continue
+    ratio = ''
+    if base is not None and 'wall' in base['stages'].get(name, {}):
+      ratio = '%.2fx' % (r['wall']['min'] / base['stages'][name]['wall']['min'])
+    lines.append('%-16s %10s %12.4f %12.3g %10.1f %10s' %
+                 (name, r['units'], r['wall']['min'], r['per_unit'],
+                  r['peak_traced_mb'], ratio))
+  return '\n'.join(lines)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the pipeline and '
+                                   'the live loop on synthetic data')
+  parser.add_argument('--symbols', type=int, default=200)
+  parser.add_argument('--days', type=int, default=280,
+                      help='sessions of history (the batch stages want a '
+                      'year and a week)')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--data', help='where to generate the data (default: '
+                      'a directory under the system temp dir)')
+  parser.add_argument('--workers', type=int,
+                      help='processes generating the data')
+  parser.add_argument('--only', help='comma separated stages to run')
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--minutes', type=int, default=30,
+                      help='minutes of bars append_bar replays')
+  parser.add_argument('--all-pairs', type=int, default=2000,
+                      help='pairs pearson_all computes')
+  parser.add_argument('--regress-pairs', type=int, default=2)
+  parser.add_argument('--epochs', type=int, default=25)
+  parser.add_argument('--combine-pairs', type=int, default=10)
+  parser.add_argument('--candidates', type=int, default=10000,
+                      help='candidates the ranking stages rank')
+  parser.add_argument('--out', help='results file (default: '
+                      'bench-COMMIT.json)')
+  parser.add_argument('--compare', help='earlier results file to compare '
+                      'against')
+  args = parser.parse_args(argv)
+  logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+    handlers=[logging.handlers.WatchedFileHandler(os.environ.get("LOGFILE", "creek-bench.log"))]
+  )
+  args.data = args.data or os.path.join(
+    tempfile.gettempdir(), 'creek-bench-%s-%s-%s' % (args.symbols, args.days,
+                                                     args.seed))
+  names = args.only.split(',') if args.only else [n for n, p in STAGES]
+  unknown = set(names) - set(n for n, p in STAGES)
+  if unknown: parser.error('unknown stages: %s' % ', '.join(sorted(unknown)))
+  generated = data(args)
+  ctx = context(args, generated['spec'])
+  commit = git('rev-parse', 'HEAD')
+  results = {'commit': commit, 'dirty': bool(git('status', '--porcelain')),
+             'date': dt.now().isoformat(), 'host': host(),
+             'data': generated, 'repeat': args.repeat, 'stages': {}}
+  for name, prepare in STAGES:
+    if name not in names: continue
+    results['stages'][name] = run_stage(name, prepare, ctx, args.repeat)
+  out = args.out or 'bench-%s.json' % (commit[:10] if commit else 'unknown')
+  with open(out, 'w') as f: json.dump(results, f, indent=2)
+  base = None
+  if args.compare:
+    with open(args.compare, 'r') as f: base = json.load(f)
+  print(table(results, base))
+  print('Results written to %s' % out)
+  return
+
+if __name__ == '__main__':
+  main()
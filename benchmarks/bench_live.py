@@ -0,0 +1,64 @@
+import asyncio
+import numpy as np
+import pandas as pd
+import pytz as tz
+from datetime import timedelta as td
+from .. import config as g
+from .. import replay
+from .. import creek_signal as signal
+
+'''
+The live loop on generated data: Trade.append_bar and Trade._sigma over
+every pair, and full signal.main cycles against the simulated broker, over
+the last session of the data (ctx['session']).
+'''
+def session_bars(ctx, minutes):
+  start, end = ctx['session']
+  end = min(end, start + pd.Timedelta(minutes=minutes))
+  return list(replay.minutes(replay.read_store(sorted(g.active_symbols.keys()),
+                                               start, end)))
+
+def append_bar(ctx):
+  replay.setup()
+  minutes = session_bars(ctx, ctx['minutes'])
+  trades = list(g.trades.values())
+  def fn():
+    for t in trades: t._sigma_series = pd.Series(dtype=np.float64)
+    for symbol in g.bars.keys(): g.bars[symbol] = []
+    for ts, bars in minutes:
+      for bar in bars: g.bars[bar.symbol].append(bar)
+      for t in trades: t.append_bar()
+  return fn, len(trades) * len(minutes)
+
+def sigma(ctx):
+  replay.setup()
+  trades = list(g.trades.values())
+  prices = np.random.default_rng(0).uniform(10, 100, (len(trades), 2))
+  calls = 100
+  def fn():
+    for t, (x, y) in zip(trades, prices.tolist()):
+      for i in range(calls): t._sigma(x, y)
+  return fn, len(trades) * calls
+
+def signal_cycle(ctx):
+  '''
+  One minute of bars in, then one signal.main, per call.
+  '''
+  client = replay.simulate()
+  replay.setup(client)
+  start, end = ctx['session']
+  clock = replay.VirtualClock(start.tz_convert(tz.timezone('US/Eastern')),
+                              end.tz_convert(tz.timezone('US/Eastern')))
+  client.now = clock.now
+  minutes = iter(session_bars(ctx, 390))
+  def fn():
+    ts, bars = next(minutes)
+    clock.set(ts.tz_convert(tz.timezone('US/Eastern')).to_pydatetime()
+              + td(minutes=1))
+    asyncio.run(replay.feed(bars))
+    asyncio.run(signal.main(clock))
+  return fn, 1
+
+STAGES = [('append_bar', append_bar),
+          ('sigma', sigma),
+          ('signal_cycle', signal_cycle)]
@@ -0,0 +1,148 @@
+import os
+import sys
+import importlib
+import importlib.util
+import itertools
+import pandas as pd
+from .. import config as g
+from .. import models
+from .. import synth
+
+'''
+The batch pipeline's stages on generated data. The batch scripts are run
+from the package directory and import config (and each other) as top-level
+modules, so they are imported that way here, with that config pointed at
+the generated data too. Each stage needs whatever its script imports
+(pandarallel, tensorflow, matplotlib...) and is skipped without it.
+'''
+PACKAGE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def batch(ctx, name):
+  if PACKAGE not in sys.path: sys.path.append(PACKAGE)
+  module = importlib.import_module(name)
+  synth.use(ctx['data'], sys.modules['config'])
+  return module
+
+def scratch(ctx, *path):
+  path = os.path.join(ctx['data'], 'bench', *path)
+  os.makedirs(path, exist_ok=True)
+  return path
+
+def get_frame(ctx):
+  cp = batch(ctx, 'creek_pearson')
+  symbols = ctx['symbols']
+  def fn():
+    cp.frames = {}
+    for symbol in symbols: cp.get_frame(symbol, 'Minute')
+  return fn, len(symbols)
+
+def get_frames(ctx):
+  ct = batch(ctx, 'creek_tf')
+  symbols = ctx['symbols']
+  def fn():
+    ct.frames = {}
+    ct.get_frames(symbols)
+  return fn, len(symbols)
+
+def interpolate(ctx):
+  ci = batch(ctx, 'creek_interpolate')
+  symbols = ctx['symbols']
+  def fn():
+    for symbol in symbols: ci.interpolate(symbol)
+  return fn, len(symbols)
+
+def frames(ctx):
+  cp = batch(ctx, 'creek_pearson')
+  cp.frames = {}
+  for symbol in ctx['universe']: cp.get_frame(symbol, 'Minute')
+  return cp
+
+def pearson_pairs(ctx):
+  cp = frames(ctx)
+  pairs = ctx['pearson']
+  def fn(): pairs.apply(cp.pearson, axis=1)
+  return fn, len(pairs)
+
+def pearson_all(ctx):
+  '''
+  Every pair of the universe (what pearson.cpp computes), up to
+  all_pairs of them.
+  '''
+  cp = frames(ctx)
+  pairs = pd.DataFrame(itertools.islice(
+            itertools.combinations(ctx['universe'], 2), ctx['all_pairs']),
+            columns=['symbol1', 'symbol2'])
+  def fn(): pairs.apply(cp.pearson, axis=1)
+  return fn, len(pairs)
+
+def is_sparse(ctx):
+  cp = frames(ctx)
+  pairs = ctx['pearson']
+  def fn(): pairs.apply(cp.is_sparse, axis=1)
+  return fn, len(pairs)
+
+def compare_mean(ctx):
+  cp = frames(ctx)
+  pairs = ctx['pearson']
+  def fn(): pairs.apply(cp.compare_mean, axis=1)
+  return fn, len(pairs)
+
+def regress(ctx):
+  ct = batch(ctx, 'creek_tf')
+  ct.e = ctx['epochs']
+  pairs = ctx['pearson'][:ctx['regress_pairs']]
+  # Keep the generated checkpoint markers: train into a scratch tree
+  config = sys.modules['config']
+  config.root = scratch(ctx, 'creek')
+  config.tf_dir = scratch(ctx, 'tf')
+  for d in ['checkpoints']: scratch(ctx, 'creek', d)
+  for d in ['dev', 'regression', 'loss']: scratch(ctx, 'tf', d)
+  ct.frames = {}
+  ct.get_frames(set(pairs['symbol1']) | set(pairs['symbol2']))
+  def fn(): pairs.apply(ct.regress, axis=1)
+  return fn, len(pairs)
+
+def write_dev(ctx, pairs, directory):
+  '''
+  The per-minute dev files regress writes, from the generated models.
+  '''
+  models.read_cache()
+  for symbol1, symbol2 in zip(pairs['symbol1'], pairs['symbol2']):
+    title = symbol1 + '-' + symbol2
+    bars = [pd.read_csv(os.path.join(g.minute_bar_dir, s + '.csv'),
+                        usecols=['timestamp', 'vwap']) for s in (symbol1,
+                                                                 symbol2)]
+    m = bars[0].merge(bars[1], how='inner', on='timestamp',
+                      suffixes=['_1', '_2'])
+    p = models.params[title]
+    m['mean'] = models.mean(p, m['vwap_1'])
+    m['stddev'] = models.stddev(p, m['vwap_1'])
+    m['dev'] = abs(m['vwap_2'] - m['mean']) / m['stddev']
+    m.to_csv(os.path.join(directory, title + '_dev.csv'), index=False)
+  return
+
+def tf_combine(ctx):
+  os.environ['LOGFILE'] = os.path.join(scratch(ctx), 'tf_combine.log')
+  spec = importlib.util.spec_from_file_location(
+           'tf_combine', os.path.join(PACKAGE, 'tf', 'tf_combine.py'))
+  tc = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(tc)
+  pairs = ctx['pearson'][:ctx['combine_pairs']]
+  tc.dev_directory = scratch(ctx, 'dev')
+  write_dev(ctx, pairs, tc.dev_directory)
+  def fn():
+    tc.p = pd.DataFrame()
+    tc.indices = []
+    pairs.apply(tc.get_summarized_frame, axis=1)
+    tc.p.resample('h').sum().resample('D').sum()
+  return fn, len(pairs)
+
+STAGES = [('get_frame', get_frame),
+          ('get_frames', get_frames),
+          ('interpolate', interpolate),
+          ('pearson_pairs', pearson_pairs),
+          ('pearson_all', pearson_all),
+          ('is_sparse', is_sparse),
+          ('compare_mean', compare_mean),
+          ('regress', regress),
+          ('tf_combine', tf_combine)]
@@ -0,0 +1,109 @@
+import sys
+import math
+import time
+import numpy as np
+import pandas as pd
+from .. import config as g
+from .. import ledger
+from .. import creek_signal as signal
+
+'''
+Candidate ranking and concentration limits at scale: the pandas
+sort_trades/remove_concentration that signal.main used to run every cycle,
+against signal.select_trades.
+
+python -m <package>.benchmarks.bench_ranking [candidates]
+
+Both also run as stages of the suite (python -m <package>.benchmarks).
+'''
+def sort_trades(to_open):
+  to_open_outliers = to_open[to_open['dev'] > 1.1 * g.TO_OPEN_SIGNAL]
+  to_open_bulk = to_open[to_open['dev'] <= 1.1 * g.TO_OPEN_SIGNAL]
+  to_open_outliers = to_open_outliers.sort_values(by='dev',ascending=False)
+  to_open_bulk = to_open_bulk.sort_values(by='pearson',ascending=False)
+  return pd.concat([to_open_outliers,to_open_bulk])
+
+def remove_concentration(to_open):
+  candidates = set(to_open['long'].to_list() + to_open['short'].to_list())
+  for key in candidates:
+    frac_position = ledger.exposure(key) / g.equity
+    longs = math.floor((g.MAX_SYMBOL
+                             -frac_position)*2/g.MAX_TRADE_SIZE)
+    shorts = math.floor((g.MAX_SYMBOL
+                              +frac_position)*2/g.MAX_TRADE_SIZE)
+    l = to_open['long'].to_list().count(key)
+    s = to_open['short'].to_list().count(key)
+    net = l-s
+    if net > longs:
+      mask = ((to_open['long']!=key) |
+              (to_open.groupby('long').cumcount() <= l - (net - longs)))
+      to_open = to_open[mask]
+    elif net < -shorts:
+      mask = ((to_open['short']!=key) |
+              (to_open.groupby('short').cumcount() <= s -(-net-shorts)))
+      to_open = to_open[mask]
+  return to_open
+
+def candidates(n, n_symbols, seed=0):
+  rng = np.random.default_rng(seed)
+  names = ['S%04d' % i for i in range(n_symbols)]
+  to_open = {}
+  while len(to_open) < n:
+    a, b = rng.choice(n_symbols, 2, replace=False)
+    key = names[a] + '-' + names[b]
+    to_open[key] = [float(rng.uniform(0.9, 1.0)),
+                    float(g.TO_OPEN_SIGNAL * rng.uniform(1.0, 1.5)),
+                    names[a], names[b]]
+  exposure = rng.uniform(-g.MAX_SYMBOL, g.MAX_SYMBOL, n_symbols) * g.equity
+  ledger.cost.clear()
+  ledger.cost.update(zip(names, exposure.tolist()))
+  return to_open
+
+def best(fn, repeat):
+  times = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+def run(n=10000, n_symbols=2000, repeat=5):
+  g.equity = 1e6
+  to_open = candidates(n, n_symbols)
+  slots = math.floor(1 / g.MAX_TRADE_SIZE)
+  def pandas_version():
+    df = pd.DataFrame.from_dict(to_open, orient='index',
+                                columns=['pearson','dev','long','short'])
+    return remove_concentration(sort_trades(df))
+  def numpy_version(): return signal.select_trades(to_open, slots)
+  result = {'candidates': n, 'symbols': n_symbols,
+            'pandas': best(pandas_version, repeat),
+            'numpy': best(numpy_version, repeat)}
+  result['speedup'] = result['pandas'] / result['numpy']
+  return result
+
+def pandas_ranking(ctx):
+  g.equity = 1e6
+  to_open = candidates(ctx['candidates'], 2000)
+  def fn():
+    df = pd.DataFrame.from_dict(to_open, orient='index',
+                                columns=['pearson','dev','long','short'])
+    remove_concentration(sort_trades(df))
+  return fn, len(to_open)
+
+def select_trades(ctx):
+  g.equity = 1e6
+  to_open = candidates(ctx['candidates'], 2000)
+  slots = math.floor(1 / g.MAX_TRADE_SIZE)
+  def fn(): signal.select_trades(to_open, slots)
+  return fn, len(to_open)
+
+STAGES = [('pandas_ranking', pandas_ranking),
+          ('select_trades', select_trades)]
+
+if __name__ == '__main__':
+  n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  r = run(n)
+  print('%s candidates over %s symbols: pandas %.1f ms, numpy %.1f ms (%.0fx)'
+        % (r['candidates'], r['symbols'], r['pandas'] * 1e3,
+           r['numpy'] * 1e3, r['speedup']))
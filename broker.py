@@ -0,0 +1,195 @@
+import logging
+import asyncio
+import functools
+import time
+import collections
+import contextvars
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from alpaca.data.requests import StockLatestTradeRequest
+from alpaca.data.requests import StockLatestQuoteRequest
+from . import config as g
+from . import metrics
+
+'''
+Async facade over the synchronous alpaca clients. Every call is offloaded
+to a bounded thread pool so that the legs gathered in creek_signal.main
+overlap instead of running one HTTP round-trip at a time. The pool is
+shared across event loops (__main__ calls asyncio.run once per cycle), and
+the clients' HTTP sessions are given a connection pool of the same size so
+that concurrent requests reuse kept-alive connections.
+'''
+_executor = None
+# 'endpoint': deque of the most recent call latencies in seconds
+latency = {}
+LATENCY_SAMPLES = 1000
+
+def mount(client):
+  session = getattr(client, '_session', None)
+  if session is None: return
+  adapter = HTTPAdapter(pool_connections=g.BROKER_WORKERS,
+                        pool_maxsize=g.BROKER_WORKERS)
+  session.mount('https://', adapter)
+  return
+
+def pool():
+  global _executor
+  if _executor is None:
+    mount(g.tclient)
+    mount(g.hclient)
+    _executor = ThreadPoolExecutor(max_workers=g.BROKER_WORKERS,
+                                   thread_name_prefix='broker')
+  return _executor
+
+def record(endpoint, seconds):
+  if endpoint not in latency.keys():
+    latency[endpoint] = collections.deque(maxlen=LATENCY_SAMPLES)
+  latency[endpoint].append(seconds)
+  metrics.observe('rest', seconds, endpoint=endpoint)
+  return
+
+async def call(endpoint, fn, *args, **kwargs):
+  loop = asyncio.get_running_loop()
+  start = time.monotonic()
+  try:
+    return await loop.run_in_executor(pool(),
+                                      functools.partial(fn, *args, **kwargs))
+  finally: record(endpoint, time.monotonic() - start)
+
+'''
+Per-endpoint latency summary over the last LATENCY_SAMPLES calls:
+{'endpoint': {'calls', 'mean', 'p50', 'p95', 'max'}} in seconds.
+'''
+def stats():
+  d = {}
+  for endpoint, samples in latency.items():
+    if not samples: continue
+    s = sorted(samples)
+    n = len(s)
+    d[endpoint] = {'calls': n,
+                   'mean': sum(s) / n,
+                   'p50': s[n // 2],
+                   'p95': s[min(n - 1, int(0.95 * n))],
+                   'max': s[-1]}
+  return d
+
+def log_stats():
+  logger = logging.getLogger(__name__)
+  for endpoint, s in stats().items():
+    logger.info('%s: %s calls, mean %.3fs, p50 %.3fs, p95 %.3fs, max %.3fs',
+                endpoint, s['calls'], s['mean'], s['p50'], s['p95'],
+                s['max'])
+  if waits:
+    logger.info('Order queue: depth %s (max %s), %s throttled, mean wait %.3fs, max wait %.3fs',
+                depth(), max_depth, throttled, sum(waits) / len(waits),
+                max(waits))
+  return
+
+'''
+Order-rate budget shared by every execution coroutine. Each order request
+(submit, replace, cancel) spends a token from a bucket refilled at
+ORDER_RATE tokens per second up to ORDER_BURST. When the bucket is empty
+callers queue, and are served lowest priority value first, then in
+arrival order, so bail-outs and closes go ahead of hedges and opens. The
+priority is a context variable: a coroutine sets it once and every order
+request it makes, directly or through market_qty/limit_qty, inherits it.
+'''
+BAIL_OUT, CLOSE, HEDGE, OPEN = 0, 1, 2, 3
+priority = contextvars.ContextVar('priority', default=OPEN)
+tokens = None
+_refilled = 0.0
+_queue = [] # heap of (priority, sequence number)
+_sequence = itertools.count()
+# Queue metrics
+waits = collections.deque(maxlen=LATENCY_SAMPLES)
+throttled = 0
+max_depth = 0
+
+def refill():
+  global tokens, _refilled
+  now = time.monotonic()
+  if tokens is None: tokens = float(g.ORDER_BURST)
+  else:
+    tokens = min(float(g.ORDER_BURST),
+                 tokens + (now - _refilled) * g.ORDER_RATE)
+  _refilled = now
+  return
+
+async def acquire():
+  global tokens, throttled, max_depth
+  start = time.monotonic()
+  entry = (priority.get(), next(_sequence))
+  heapq.heappush(_queue, entry)
+  max_depth = max(max_depth, len(_queue))
+  waited = False
+  try:
+    while True:
+      refill()
+      if _queue[0] == entry and tokens >= 1:
+        heapq.heappop(_queue)
+        tokens = tokens - 1
+        break
+      waited = True
+      await asyncio.sleep(max((1 - tokens) / g.ORDER_RATE, 0.005))
+  finally:
+    if entry in _queue:
+      _queue.remove(entry)
+      heapq.heapify(_queue)
+  if waited: throttled = throttled + 1
+  waits.append(time.monotonic() - start)
+  metrics.observe('order_queue', waits[-1])
+  return
+
+def rate_limited():
+  '''
+  The broker answered 429: empty the bucket, so that every request queued
+  waits for it to refill rather than be refused too.
+  '''
+  global tokens
+  refill()
+  tokens = min(tokens, 0.0)
+  return
+
+def depth(): return len(_queue)
+
+async def submit_order(request):
+  await acquire()
+  return await call('submit_order', g.tclient.submit_order, request)
+
+async def replace_order(oid, request):
+  await acquire()
+  return await call('replace_order', g.tclient.replace_order_by_id,
+                    order_id=oid, order_data=request)
+
+async def cancel_order(oid):
+  await acquire()
+  return await call('cancel_order', g.tclient.cancel_order_by_id, oid)
+
+async def cancel_orders():
+  await acquire()
+  return await call('cancel_orders', g.tclient.cancel_orders)
+
+async def get_account():
+  return await call('get_account', g.tclient.get_account)
+
+async def get_all_positions():
+  return await call('get_all_positions', g.tclient.get_all_positions)
+
+async def get_clock():
+  return await call('get_clock', g.tclient.get_clock)
+
+async def latest_trade(symbol_or_symbols):
+  request = StockLatestTradeRequest(symbol_or_symbols=symbol_or_symbols)
+  return await call('latest_trade', g.hclient.get_stock_latest_trade,
+                    request)
+
+async def latest_quote(symbol_or_symbols):
+  request = StockLatestQuoteRequest(symbol_or_symbols=symbol_or_symbols)
+  return await call('latest_quote', g.hclient.get_stock_latest_quote,
+                    request)
+
+metrics.register('broker', lambda: {'order_queue_depth': depth(),
+                                    'order_queue_max_depth': max_depth,
+                                    'throttled': throttled})
@@ -18,12 +18,15 @@ active_symbols = {} # 'SYMBOL': <Symbol_Object>
 trades = {} # 'SYMBOL1-SYMBOL2': <Trade_Object>
 closed_trades = []
 bars = {} # 'SYMBOL': [<Bar>]
-orders = {} # 'SYMBOL1-SYMBOL2': {'long': <Order>, 'short': <Order>}
+pairs_by_symbol = {} # 'SYMBOL': {'SYMBOL1-SYMBOL2', ...}
+dirty_symbols = set() # Symbols with bars not yet seen by signal.main
+open_trades = set() # 'SYMBOL1-SYMBOL2' of trades that are not closed
 trade_size = 0.0
 retarget = {'missed':[],'util':[]}
 cash = 0.0
 equity = 0.0
 positions = []
+account = None # Last <TradeAccount> fetched
 burn_list = [] # This list contains those positions we bailed out of
 
 '''
@@ -75,4 +78,127 @@ HEDGE_SYMBOL = 'VXF'
 Other symbols to try if HEDGE_SYMBOL is not fractionable
 List taken from https://www.forbes.com/sites/baldwin/2018/08/02/best-etfs-for-trading-small-and-mid-cap/
 '''
-HEDGE_SYMBOL_LIST = ['VXF', 'SMMD', 'IJH', 'VO', 'SCHM', 'IJR', 'IWM', 'VB', 'VTI']
\ No newline at end of file
+HEDGE_SYMBOL_LIST = ['VXF', 'SMMD', 'IJH', 'VO', 'SCHM', 'IJR', 'IWM', 'VB', 'VTI']
+'''
+HEDGE_BAND is how many dollars the hedge position may drift from the sum
+of the open trades' hedges before hedging.py trades it back.
+'''
+HEDGE_BAND = 100.0
+'''
+BROKER_WORKERS bounds the thread pool (and HTTP connection pool) used by
+broker.py to run REST calls concurrently from the event loop.
+'''
+BROKER_WORKERS = 16
+
+'''
+FILL_TIMEOUT is how many seconds to wait for a market order to reach a
+terminal state (as reported by the trading stream) before giving up on it.
+'''
+FILL_TIMEOUT = 6.0
+'''
+REPRICE_INTERVAL is how many seconds to wait for a limit order to fill
+before replacing it with a more aggressive limit price.
+'''
+REPRICE_INTERVAL = 2.0
+'''
+MARKET_DATA_MAX_AGE is how many seconds a subscribed symbol's cached quote
+or trade stays fresh on its own, and it also stays fresh for as long as
+the stock stream has delivered a message within
+MARKET_DATA_STREAM_TIMEOUT seconds. A quote or trade of a symbol not
+subscribed, fetched by REST, stays fresh for MARKET_DATA_REST_MAX_AGE
+seconds. Stale entries are refreshed via REST.
+'''
+MARKET_DATA_MAX_AGE = 60.0
+MARKET_DATA_STREAM_TIMEOUT = 5.0
+MARKET_DATA_REST_MAX_AGE = 2.0
+'''
+Adaptive evaluation tiers (see tiers.py). TIER_WINDOW is how many recent
+sigma points bound how fast a pair's sigma can move, TIER_SAFETY scales
+that bound, and TIER_MAX_INTERVAL is the most cycles a closed pair may go
+without being evaluated.
+'''
+TIER_WINDOW = 30
+TIER_SAFETY = 2.0
+TIER_MAX_INTERVAL = 10
+'''
+ASSET_CACHE_TTL is how many seconds the on-disk asset metadata cache
+(root/assets.json) is trusted before refetching it from alpaca.
+MODEL_LOAD_WORKERS is how many checkpoints are read in parallel when
+model_params.csv needs refreshing.
+'''
+ASSET_CACHE_TTL = 12 * 3600
+MODEL_LOAD_WORKERS = 16
+'''
+WARMUP_SESSIONS is how many past sessions of minute bars are used to
+compute each pair's sigma history before the open (see warmup.py).
+'''
+WARMUP_SESSIONS = 7
+'''
+RECONCILE_INTERVAL is the most seconds between full reconciliations of
+positions and account against the broker. A reconciliation also runs at
+the end of any cycle that leaves the ledger with drift (see ledger.py).
+'''
+RECONCILE_INTERVAL = 300
+'''
+Order-rate budget shared by all execution coroutines (see broker.py):
+ORDER_RATE order requests per second on average, in bursts of at most
+ORDER_BURST. Alpaca allows 200 requests per minute per account, and data
+requests count against the same limit.
+'''
+ORDER_RATE = 2.5
+ORDER_BURST = 10
+'''
+An order submission the broker refuses with 429 (rate limited) is retried
+after RATE_LIMIT_BACKOFF seconds, doubling on each further 429 up to
+RATE_LIMIT_BACKOFF_MAX.
+'''
+RATE_LIMIT_BACKOFF = 1.0
+RATE_LIMIT_BACKOFF_MAX = 30.0
+'''
+CLOCK_RESYNC_INTERVAL is how many seconds signal.Clock serves market time
+from its measured offset before remeasuring it against the broker.
+'''
+CLOCK_RESYNC_INTERVAL = 600
+'''
+BAR_CAPTURE, if set to a path, makes io.bar_data_handler append every bar
+received on the websocket to that file as JSON lines (see replay.py).
+'''
+BAR_CAPTURE = None
+'''
+Live metrics (see metrics.py). METRICS_PORT is the local port serving
+/metrics (Prometheus text) and /metrics.json, None to not serve them.
+Every METRICS_INTERVAL seconds one JSON line of what happened over the
+interval is appended to METRICS_FILE (None to not write it), which is
+rotated at METRICS_FILE_BYTES keeping METRICS_FILE_BACKUPS old files.
+LOOP_LAG_INTERVAL is how often, in seconds, event loop lag is sampled
+during a cycle.
+'''
+METRICS_PORT = 9108
+METRICS_FILE = 'creek-metrics.jsonl'
+METRICS_INTERVAL = 60
+METRICS_FILE_BYTES = 10 * 2**20
+METRICS_FILE_BACKUPS = 5
+LOOP_LAG_INTERVAL = 0.1
+'''
+Rate limit of repetitive log messages (see logs.py): at most
+LOG_RATE_BURST records of INFO or below from any one line of code every
+LOG_RATE_WINDOW seconds.
+'''
+LOG_RATE_WINDOW = 60
+LOG_RATE_BURST = 100
+'''
+The nightly pipeline (see creek_pipeline.py). PEARSON_COMMAND is the shell
+command, run in pearson_dir, that computes pearson.csv from the
+interpolated bars (pearson/pearson.cpp built), or None to use pearson.csv
+as it is. Bar files are fingerprinted by their size and
+PIPELINE_HASH_BYTES bytes at each end.
+'''
+PEARSON_COMMAND = None
+PIPELINE_HASH_BYTES = 2**16
+'''
+The bar server (see bar_server.py) listens on BAR_SERVER_SOCKET and keeps
+at most BAR_SERVER_BYTES of bars in shared memory, evicting the least
+recently used.
+'''
+BAR_SERVER_SOCKET = '/tmp/creek-bars.sock'
+BAR_SERVER_BYTES = 32 * 2**30
@@ -11,6 +11,8 @@ import multiprocessing as mp
 import glob
 import config as g
 import refresh_bars as rb
+import bar_server
+import profiling
 
 # This global list will contain the symbols that have been interpolated
 interpolated = []
@@ -20,15 +22,19 @@ def interpolate(symbol):
   logger.info('Interpolating %s', symbol)
   path = os.path.join(g.minute_bar_dir, symbol + '.csv')
   try:
-    bars = pd.read_csv(path)
+    interpolated_bars = bar_server.frame(symbol, 'Minute')
+    if interpolated_bars is None:
+      bars = pd.read_csv(path)
+      if bars.empty:
+        return []
+      interpolated_bars = bars.drop(columns=['symbol','open','high','low','close','volume','trade_count'],axis=1)
+      interpolated_bars.set_index('timestamp', inplace=True)
+      interpolated_bars.index = pd.to_datetime(interpolated_bars.index)
   except FileNotFoundError:
     logger.error('%s.csv not found' % symbol)
     return []
-  if bars.empty:
+  if interpolated_bars.empty:
     return []
-  interpolated_bars = bars.drop(columns=['symbol','open','high','low','close','volume','trade_count'],axis=1)
-  interpolated_bars.set_index('timestamp', inplace=True)
-  interpolated_bars.index = pd.to_datetime(interpolated_bars.index)
   start_date = date.today().replace(year=date.today().year-1)
   buffer_start_date = start_date - td(days=7)
   end_date = date.today() - td(days=2)
@@ -43,6 +49,7 @@ def interpolate(symbol):
   interpolated_bars = interpolated_bars[start:end]
   return interpolated_bars
 
+@profiling.task
 def interpolate_wrapper(symbol, length):
   logger = logging.getLogger(__name__)
   b = interpolate(symbol)
@@ -70,30 +77,34 @@ def main():
     handlers=[logging.handlers.WatchedFileHandler(os.environ.get("LOGFILE", "creek-interpolate.log"))]
   )
   logger = logging.getLogger(__name__)
+  profiling.start('creek-interpolate', g.pearson_dir)
   path = os.path.join(g.interpolated_bars_dir, '*')
   files = glob.glob(path)
   for f in files:
     os.remove(f)
-  symbol_list = list(set(rb.get_shortable_equities() + rb.get_open_symbols()))
-  target_length = len(interpolate('AAPL'))
+  with profiling.stage('symbols'):
+    symbol_list = list(set(rb.get_shortable_equities() + rb.get_open_symbols()))
+  with profiling.stage('target_length'):
+    target_length = len(interpolate('AAPL'))
   logger.info('Target length = %s' % target_length)
   path = os.path.join(g.pearson_dir, 'pearson.config')
   with open(path, 'w') as f:
     f.write(str(target_length))
-  pool = mp.Pool(mp.cpu_count())
-  logger.info('Initializing %s pools', mp.cpu_count())
-  for symbol in symbol_list:
-    # A special problem is the construction of tuples containing 0 or 1 
-    # items: the syntax has some extra quirks to accommodate these. 
-    # Empty tuples are constructed by an empty pair of parentheses; a 
-    # tuple with one item is constructed by following a value with a 
-    # comma (it is not sufficient to enclose a single value in 
-    # parentheses). Ugly, but effective.
-    pool.apply_async(interpolate_wrapper, args=(symbol, target_length), callback=interpolated_callback, error_callback=pool_error_callback)
-  pool.close()
-  # postpones the execution of next line of code until all processes in 
-  # the queue are done.
-  pool.join()
+  with profiling.stage('interpolate'):
+    pool = mp.Pool(mp.cpu_count())
+    logger.info('Initializing %s pools', mp.cpu_count())
+    for symbol in symbol_list:
+      # A special problem is the construction of tuples containing 0 or 1 
+      # items: the syntax has some extra quirks to accommodate these. 
+      # Empty tuples are constructed by an empty pair of parentheses; a 
+      # tuple with one item is constructed by following a value with a 
+      # comma (it is not sufficient to enclose a single value in 
+      # parentheses). Ugly, but effective.
+      pool.apply_async(interpolate_wrapper, args=(symbol, target_length), callback=interpolated_callback, error_callback=pool_error_callback)
+    pool.close()
+    # postpones the execution of next line of code until all processes in 
+    # the queue are done.
+    pool.join()
   interpolated_df = pd.DataFrame({'symbol': interpolated})
   path = os.path.join(g.pearson_dir, 'interpolated.csv')
   interpolated_df.to_csv(path)
@@ -16,6 +16,8 @@ from alpaca.trading.requests import GetAssetsRequest
 from alpaca.trading.enums import AssetClass
 import config as g
 import refresh_bars as rb
+import bar_server
+import profiling
 
 last_year_cutoff = 0.95
 historical_cutoff = 0.95
@@ -27,6 +29,7 @@ p = pd.DataFrame()
 frames = {}
 missing_bars = []
 
+@profiling.stage('initial_truncate')
 def initial_truncate():
   search_params = GetAssetsRequest(asset_class=AssetClass.US_EQUITY)
   assets = g.tclient.get_all_assets(search_params)
@@ -64,6 +67,7 @@ def initial_truncate():
   p['symbol1_name'] = p['symbol1'].map(symbol_dict)
   p['symbol2_name'] = p['symbol2'].map(symbol_dict)
 
+@profiling.task
 def pearson(row):
   symbol1 = row['symbol1']
   symbol2 = row['symbol2']
@@ -81,6 +85,7 @@ def pearson(row):
   return ((n * xy - x * y) / 
 			math.sqrt((n * xsquared - x * x) * (n * ysquared - y * y)))
 			
+@profiling.task
 def compare_mean(row):
   symbol1 = row['symbol1']
   symbol2 = row['symbol2']
@@ -98,11 +103,13 @@ def get_frame(symbol, interval):
   elif (interval == 'Minute'):
     directory = g.minute_bar_dir
   try:
-    path = os.path.join(directory, symbol + '.csv')
-    frame = pd.read_csv(path)
-    frame = frame.drop(columns=['symbol','open','high','low','close','volume','trade_count'],axis=1)
-    frame.set_index('timestamp', inplace=True)
-    frame.index = pd.to_datetime(frame.index)
+    frame = bar_server.frame(symbol, interval)
+    if frame is None:
+      path = os.path.join(directory, symbol + '.csv')
+      frame = pd.read_csv(path)
+      frame = frame.drop(columns=['symbol','open','high','low','close','volume','trade_count'],axis=1)
+      frame.set_index('timestamp', inplace=True)
+      frame.index = pd.to_datetime(frame.index)
     frames[symbol] = frame
   except FileNotFoundError as error:
     logger = logging.getLogger(__name__)
@@ -126,6 +133,7 @@ def check_missing_bars():
     return 0
   else: return 1
 
+@profiling.stage('pearson_historical')
 def pearson_historical():
   logger = logging.getLogger(__name__)
   global p
@@ -141,6 +149,7 @@ def pearson_historical():
   logger.info('Computation complete')
   return 1
 
+@profiling.task
 def is_sparse(row):
   symbol1 = row['symbol1']
   symbol2 = row['symbol2']
@@ -154,6 +163,7 @@ def is_sparse(row):
   if n < sparse_cutoff: return True
   return False
 
+@profiling.stage('historical_sort')
 def historical_sort():
   global p
   p = p[abs(p['pearson_historical']) >= historical_cutoff]
@@ -161,6 +171,7 @@ def historical_sort():
   p.sort_values(by=['abs'], ascending=False, inplace=True)
   p.drop(['abs'], axis=1, inplace=True)
 
+@profiling.stage('sparse_truncate')
 def sparse_truncate():
   logger = logging.getLogger(__name__)
   global p
@@ -181,12 +192,19 @@ def sparse_truncate():
   logger.info('Sparse drop complete')
   # Reorder symbols so the one with the larger average price is second
   logger.info('Swapping symbols')
-  p['swap'] = p.parallel_apply(compare_mean, axis=1)
-  p[['symbol1','symbol2','symbol1_name','symbol2_name']] = p[['symbol2','symbol1','symbol2_name','symbol1_name']].where(p['swap'] == 1, p[['symbol1','symbol2','symbol1_name','symbol2_name']].values)
-  p = p.drop(columns=['swap'],axis=1)
+  p = apply_swap(p, p.parallel_apply(compare_mean, axis=1))
   logger.info('Swap complete')
   return 1
 
+def apply_swap(p, swap):
+  '''
+  Swap symbol1 and symbol2, and their names, in the rows of p where swap
+  (compare_mean's result, aligned with p) is 1. Also used by
+  creek_pipeline.py.
+  '''
+  p[['symbol1','symbol2','symbol1_name','symbol2_name']] = p[['symbol2','symbol1','symbol2_name','symbol1_name']].where(swap == 1, p[['symbol1','symbol2','symbol1_name','symbol2_name']].values)
+  return p
+
 def main():
   logging.basicConfig(
     level=logging.INFO,
@@ -194,18 +212,20 @@ def main():
   handlers=[logging.handlers.WatchedFileHandler(os.environ.get("LOGFILE", "creek-pearson.log"))]
   )
   logger = logging.getLogger(__name__)
+  profiling.start('creek-pearson', g.pearson_dir)
   pandarallel.initialize(nb_workers = mp.cpu_count(), progress_bar = True)
   initial_truncate()
   r = pearson_historical()
   if not r: return
   historical_sort()
   if not sparse_truncate(): return
-  path = os.path.join(g.pearson_dir, 'pearson_historical.csv')
-  p.to_csv(path)
-  path = os.path.join(g.root, 'pearson.csv')
-  path2 = os.path.join(g.root, 'pearson_backup.csv')
-  os.rename(path, path2)
-  p.to_csv(path)
+  with profiling.stage('write'):
+    path = os.path.join(g.pearson_dir, 'pearson_historical.csv')
+    p.to_csv(path)
+    path = os.path.join(g.root, 'pearson.csv')
+    path2 = os.path.join(g.root, 'pearson_backup.csv')
+    os.rename(path, path2)
+    p.to_csv(path)
 
 if __name__ == '__main__':
   main()
\ No newline at end of file
@@ -0,0 +1,615 @@
+import os
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import logging.handlers
+import multiprocessing as mp
+import subprocess
+import time
+from datetime import date
+from datetime import timedelta as td
+import pandas as pd
+import config as g
+import profiling
+
+'''
+The nightly pipeline as one run: refresh_bars -> creek_interpolate ->
+pearson.cpp -> creek_pearson (historical pearson, then the sparse filter
+and symbol swap) -> creek_tf, re-running only the work whose inputs
+changed since the last run.
+
+Every stage declares its units of work (a symbol or a pair) and, for each,
+a key hashing everything the unit's result depends on: the fingerprints of
+the bar files it reads and the date window it uses. A unit runs if its key
+differs from the one stored when it last completed, and the stage's
+combined outputs (interpolated.csv, pearson_historical.csv, the model
+set...) are then rebuilt from every unit's stored result. Keys and results
+are kept in root/pipeline.json, which is saved as units complete, so an
+interrupted run resumes where it stopped.
+
+Bar files are append-only, so a file is fingerprinted by its size and
+PIPELINE_HASH_BYTES at each end (a full refresh after a split rewrites
+both), and a fingerprint is only recomputed when the file's size or mtime
+changed. The historical pearson is keyed on the whole hour files, and the
+sparse filter and regression on the minute bars inside their one year
+window (window_bars), so a pair reruns when a bar enters or leaves its
+window, not because the date moved. On a trading night that is nearly
+every pair; what is skipped is weekend and holiday runs, and in the
+historical pearson, pairs of symbols that stopped trading. Interpolation
+resamples onto a minute grid that moves with the date, so it is keyed on
+the date and recomputes every symbol each day. Reruns and resumed runs
+skip everything already done.
+
+Before running, the plan is shown with each stage's units to run and an
+estimate from the seconds per unit measured on earlier runs. Stages are
+re-planned from the files on disk just before they run.
+
+python creek_pipeline.py [--plan] [--only a,b] [--skip a,b]
+                         [--symbols A,B] [--force] [--workers N]
+                         [--epochs N] [--profile]
+
+--symbols restricts every stage to the units involving those symbols (what
+update_symbols.py does for the regression), and --plan only shows the
+plan.
+'''
+STATE = 'pipeline.json'
+SAVE_INTERVAL = 30 # most seconds between saves of the state while running
+SPARSE_MARGIN = 30 # days, see young
+
+class State():
+  '''
+  files: {'path': [size, mtime_ns, fingerprint]}
+  keys: {'stage': {'unit': key of its last completed run}}
+  results: {'stage': {'unit': result}}
+  timings: {'stage': seconds per unit on its last run}
+  '''
+  def __init__(self, path):
+    self.path = path
+    try:
+      with open(path, 'r') as f: d = json.load(f)
+    except (IOError, ValueError): d = {}
+    self.files = d.get('files', {})
+    self.keys = d.get('keys', {})
+    self.results = d.get('results', {})
+    self.timings = d.get('timings', {})
+
+  def save(self):
+    with open(self.path + '.tmp', 'w') as f:
+      json.dump({'files': self.files, 'keys': self.keys,
+                 'results': self.results, 'timings': self.timings}, f)
+    os.replace(self.path + '.tmp', self.path)
+    return
+
+class Stage():
+  '''
+  A step of the pipeline:
+  - plan(ctx) returns {'unit': (key, (symbols...))} for all of its work,
+  - run(ctx, units, planned, done) does the units given, calling
+    done(unit, result) as each completes, and returns False to stop the
+    pipeline,
+  - finish(ctx, planned), if any, writes the stage's combined outputs from
+    the stored results, and returns False if it could not.
+  after: stages whose per-symbol outputs this stage reads.
+  whole: whether this stage's output changes the units of later stages.
+  '''
+  def __init__(self, name, inputs, outputs, plan, run, finish=None,
+               after=(), whole=False):
+    self.name = name
+    self.inputs = inputs
+    self.outputs = outputs
+    self.plan = plan
+    self.run = run
+    self.finish = finish
+    self.after = after
+    self.whole = whole
+
+def fingerprint(state, path):
+  try: st = os.stat(path)
+  except FileNotFoundError: return None
+  cached = state.files.get(path)
+  if cached is not None and cached[:2] == [st.st_size, st.st_mtime_ns]:
+    return cached[2]
+  n = g.PIPELINE_HASH_BYTES
+  h = hashlib.blake2b(str(st.st_size).encode(), digest_size=16)
+  with open(path, 'rb') as f:
+    if st.st_size <= 2 * n: h.update(f.read())
+    else:
+      h.update(f.read(n))
+      f.seek(-n, os.SEEK_END)
+      h.update(f.read(n))
+  state.files[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+  return h.hexdigest()
+
+def window_offset(f, size, start):
+  '''
+  Offset of the first row of the bar file f at or after start (bytes, a
+  date or timestamp as written in the file), by binary search.
+  '''
+  f.seek(0)
+  column = f.readline().rstrip().split(b',').index(b'timestamp')
+  first_row = f.tell()
+  def row_at(x):
+    # The first row starting at or after x
+    if x <= first_row: f.seek(first_row)
+    else:
+      f.seek(x - 1)
+      f.readline()
+    return f.tell(), f.readline()
+  lo, hi = first_row, size
+  while lo < hi:
+    mid = (lo + hi) // 2
+    offset, row = row_at(mid)
+    fields = row.split(b',')
+    # A blank or partial last row counts as past the end
+    if len(fields) <= column or fields[column] >= start: hi = mid
+    else: lo = mid + 1
+  return row_at(lo)[0]
+
+def window_bars(ctx, symbol, start):
+  '''
+  Fingerprint of symbol's minute bars from start on: how many bytes they
+  take, the first of them and the last PIPELINE_HASH_BYTES. It changes
+  when a bar enters or leaves the window, not with the date itself.
+  '''
+  state = ctx['state']
+  path = os.path.join(g.minute_bar_dir, symbol + '.csv')
+  try: st = os.stat(path)
+  except FileNotFoundError: return None
+  cached = state.files.get(path + '@')
+  if cached is not None and cached[:3] == [st.st_size, st.st_mtime_ns, start]:
+    return cached[3]
+  with open(path, 'rb') as f:
+    offset = window_offset(f, st.st_size, start.encode())
+    f.seek(offset)
+    h = hashlib.blake2b(str(st.st_size - offset).encode(), digest_size=16)
+    h.update(f.readline())
+    f.seek(max(offset, st.st_size - g.PIPELINE_HASH_BYTES))
+    h.update(f.read())
+  state.files[path + '@'] = [st.st_size, st.st_mtime_ns, start, h.hexdigest()]
+  return h.hexdigest()
+
+def first_bar(ctx, symbol):
+  '''
+  The timestamp of symbol's first minute bar, None if it has none.
+  '''
+  first = ctx.setdefault('first_bar', {})
+  if symbol not in first.keys():
+    try:
+      with open(os.path.join(g.minute_bar_dir, symbol + '.csv'), 'rb') as f:
+        column = f.readline().rstrip().split(b',').index(b'timestamp')
+        row = f.readline()
+      first[symbol] = row.split(b',')[column].decode() if row else None
+    except FileNotFoundError: first[symbol] = None
+  return first[symbol]
+
+def key(*parts):
+  return hashlib.blake2b(json.dumps(parts).encode(),
+                         digest_size=16).hexdigest()
+
+def minute_bars(ctx, symbol):
+  return fingerprint(ctx['state'], os.path.join(g.minute_bar_dir,
+                                                symbol + '.csv'))
+
+def hour_bars(ctx, symbol):
+  return fingerprint(ctx['state'], os.path.join(g.hour_bar_dir,
+                                                symbol + '.csv'))
+
+def titles(p):
+  return p['symbol1'] + '-' + p['symbol2']
+
+def universe(ctx):
+  '''
+  The symbols refresh_bars and creek_interpolate work on.
+  '''
+  if 'universe' not in ctx.keys():
+    import refresh_bars as rb
+    ctx['universe'] = sorted(set(rb.get_shortable_equities() +
+                                 rb.get_open_symbols()))
+  return ctx['universe']
+
+def parallel(ctx):
+  from pandarallel import pandarallel
+  pandarallel.initialize(nb_workers=ctx['workers'], progress_bar=False)
+  return
+
+# refresh_bars: minute and hour bars of every symbol, once a day
+def refresh_plan(ctx):
+  today = ctx['today'].isoformat()
+  return {s: (key(today), (s,)) for s in universe(ctx)}
+
+def refresh_run(ctx, units, planned, done):
+  logger = logging.getLogger(__name__)
+  import refresh_bars as rb
+  if not rb.sanity_check(): return False
+  for i, s in enumerate(units):
+    logger.info('Refreshing %s, %s/%s', s, i + 1, len(units))
+    rb.refresh_bars(s, False)
+    done(s)
+  return True
+
+# creek_interpolate: each symbol's last year of minute bars, every minute
+def interpolate_window(ctx):
+  today = ctx['today']
+  return (today.replace(year=today.year - 1).isoformat(),
+          (today - td(days=2)).isoformat())
+
+def interpolate_plan(ctx):
+  window = interpolate_window(ctx)
+  return {s: (key(window, minute_bars(ctx, s)), (s,))
+          for s in universe(ctx)}
+
+def interpolate_run(ctx, units, planned, done):
+  logger = logging.getLogger(__name__)
+  import creek_interpolate as ci
+  ctx['target_length'] = len(ci.interpolate('AAPL'))
+  logger.info('Target length = %s', ctx['target_length'])
+  for s in units:
+    path = os.path.join(g.interpolated_bars_dir, s + '.csv')
+    if os.path.exists(path): os.remove(path)
+  # Until a symbol completes again, it has no file and is not listed
+  results = ctx['state'].results.setdefault('interpolate', {})
+  for s in units: results.pop(s, None)
+  pool = mp.Pool(ctx['workers'])
+  for s in units:
+    # interpolate_wrapper returns None for a symbol with the wrong length
+    pool.apply_async(ci.interpolate_wrapper, args=(s, ctx['target_length']),
+                     callback=lambda r, s=s: done(s, r[1] if r else 0),
+                     error_callback=ci.pool_error_callback)
+  pool.close()
+  pool.join()
+  return True
+
+def interpolate_finish(ctx, planned):
+  results = ctx['state'].results.get('interpolate', {})
+  for path in glob.glob(os.path.join(g.interpolated_bars_dir, '*.csv')):
+    if os.path.basename(path)[:-4] not in planned.keys(): os.remove(path)
+  if 'target_length' in ctx.keys():
+    with open(os.path.join(g.pearson_dir, 'pearson.config'), 'w') as f:
+      f.write(str(ctx['target_length']))
+  interpolated = pd.DataFrame({'symbol': [s for s in planned.keys()
+                                          if results.get(s)]})
+  interpolated.to_csv(os.path.join(g.pearson_dir, 'interpolated.csv'))
+  return True
+
+# pearson.cpp: every pair of interpolated symbols, into pearson.csv
+def pearson_all_plan(ctx):
+  if not g.PEARSON_COMMAND: return {}
+  results = ctx['state'].results.get('interpolate', {})
+  inputs = [(s, fingerprint(ctx['state'],
+                            os.path.join(g.interpolated_bars_dir, s + '.csv')))
+            for s in sorted(results.keys()) if results[s]]
+  return {'pearson.csv': (key(inputs), ())}
+
+def pearson_all_run(ctx, units, planned, done):
+  logger = logging.getLogger(__name__)
+  r = subprocess.run(g.PEARSON_COMMAND, shell=True, cwd=g.pearson_dir)
+  if r.returncode != 0:
+    logger.error('%s exited with %s', g.PEARSON_COMMAND, r.returncode)
+    return False
+  ctx.pop('truncated', None)
+  for u in units: done(u)
+  return True
+
+# creek_pearson: historical pearson of the pairs in pearson.csv
+def pearson_module(ctx):
+  import creek_pearson as cp
+  if 'truncated' not in ctx.keys():
+    cp.initial_truncate()
+    ctx['truncated'] = cp.p
+  return cp
+
+def historical_plan(ctx):
+  pearson_module(ctx)
+  p = ctx['truncated']
+  return {t: (key(hour_bars(ctx, s1), hour_bars(ctx, s2)), (s1, s2))
+          for t, s1, s2 in zip(titles(p), p['symbol1'], p['symbol2'])}
+
+def load(cp, symbols, interval):
+  cp.frames = {}
+  cp.missing_bars = []
+  for s in symbols: cp.get_frame(s, interval)
+  return cp.check_missing_bars()
+
+def subset(ctx, units, planned):
+  pairs = [planned[u][1] for u in units]
+  return pd.DataFrame({'symbol1': [s1 for s1, s2 in pairs],
+                       'symbol2': [s2 for s1, s2 in pairs]})
+
+def historical_run(ctx, units, planned, done):
+  cp = pearson_module(ctx)
+  pairs = subset(ctx, units, planned)
+  if not load(cp, set(pairs['symbol1']) | set(pairs['symbol2']), 'Hour'):
+    return False
+  parallel(ctx)
+  for t, v in zip(titles(pairs), pairs.parallel_apply(cp.pearson, axis=1)):
+    done(t, float(v))
+  return True
+
+def historical(ctx):
+  '''
+  The pairs creek_pearson keeps after historical_sort, from the stored
+  historical pearsons. Pairs without one are kept too, at the end.
+  '''
+  cp = pearson_module(ctx)
+  results = ctx['state'].results.get('historical', {})
+  p = ctx['truncated'].copy()
+  p['pearson_historical'] = titles(p).map(results)
+  unknown = p[p['pearson_historical'].isna()]
+  cp.p = p[p['pearson_historical'].notna()]
+  cp.p = cp.p[['symbol1', 'symbol2', 'pearson', 'pearson_historical',
+               'symbol1_name', 'symbol2_name']]
+  cp.historical_sort()
+  return pd.concat([cp.p, unknown[cp.p.columns]])
+
+# creek_pearson: drop sparse pairs and put the dearer symbol second
+def young(ctx, s1, s2):
+  '''
+  The part of is_sparse's answer that depends on the date: whether the
+  pair's common history starts after its three year cutoff. That start is
+  taken as the later of the two first bars, and within SPARSE_MARGIN days
+  of the cutoff, where the two could disagree, the cutoff itself is used.
+  '''
+  today = ctx['today']
+  cutoff = today.replace(year=today.year - 3)
+  firsts = [first_bar(ctx, s1), first_bar(ctx, s2)]
+  if None in firsts: return None
+  start = date.fromisoformat(max(firsts)[:10])
+  if abs((start - cutoff).days) <= SPARSE_MARGIN: return cutoff.isoformat()
+  return start > cutoff
+
+def sparse_plan(ctx):
+  p = historical(ctx)
+  today = ctx['today']
+  one_year = today.replace(year=today.year - 1).isoformat()
+  return {t: (key(window_bars(ctx, s1, one_year),
+                  window_bars(ctx, s2, one_year), first_bar(ctx, s1),
+                  first_bar(ctx, s2), young(ctx, s1, s2)), (s1, s2))
+          for t, s1, s2 in zip(titles(p), p['symbol1'], p['symbol2'])}
+
+def sparse_run(ctx, units, planned, done):
+  cp = pearson_module(ctx)
+  pairs = subset(ctx, units, planned)
+  if not load(cp, set(pairs['symbol1']) | set(pairs['symbol2']), 'Minute'):
+    return False
+  parallel(ctx)
+  sparse = pairs.parallel_apply(cp.is_sparse, axis=1)
+  swap = pairs.parallel_apply(cp.compare_mean, axis=1)
+  for t, a, b in zip(titles(pairs), sparse, swap): done(t, [bool(a), int(b)])
+  return True
+
+def sparse_finish(ctx, planned):
+  '''
+  Write pearson_historical.csv and the engine's pearson.csv as
+  creek_pearson does, once every pair has its results.
+  '''
+  logger = logging.getLogger(__name__)
+  results = ctx['state'].results.get('sparse', {})
+  p = historical(ctx)
+  t = titles(p)
+  missing = p['pearson_historical'].isna() | ~t.isin(results.keys())
+  if missing.any():
+    logger.warning('%s pairs have never been computed (see --symbols); '
+                   'not writing pearson_historical.csv', missing.sum())
+    return False
+  p['sparse'] = t.map(lambda x: results[x][0]).astype(bool)
+  p['swap'] = t.map(lambda x: results[x][1])
+  p = p[~p['sparse']].drop(columns=['sparse'])
+  p = pearson_module(ctx).apply_swap(p, p.pop('swap'))
+  p.to_csv(os.path.join(g.pearson_dir, 'pearson_historical.csv'))
+  path = os.path.join(g.root, 'pearson.csv')
+  if os.path.exists(path):
+    os.rename(path, os.path.join(g.root, 'pearson_backup.csv'))
+  p.to_csv(path)
+  return True
+
+# creek_tf: a model per pair of pearson_historical.csv and open trade
+def tf_pairs():
+  p = pd.read_csv(os.path.join(g.pearson_dir, 'pearson_historical.csv'),
+                  usecols=['symbol1', 'symbol2'])
+  pairs = list(zip(p['symbol1'], p['symbol2']))
+  for f in glob.glob(os.path.join(g.root, 'open_trades', '*.json')):
+    pairs.append(tuple(os.path.basename(f)[:-5].split('-')))
+  return pairs
+
+def tf_plan(ctx):
+  today = ctx['today']
+  cutoff = today.replace(year=today.year - 1).isoformat()
+  return {s1 + '-' + s2: (key(window_bars(ctx, s1, cutoff),
+                              window_bars(ctx, s2, cutoff), ctx['epochs']),
+                          (s1, s2))
+          for s1, s2 in tf_pairs()}
+
+def regress(row):
+  '''
+  creek_tf.regress, True if it completed. A pair that failed is left to
+  run again next time rather than stop the others.
+  '''
+  import creek_tf as ct
+  try: ct.regress(row)
+  except Exception:
+    logger = logging.getLogger(__name__)
+    logger.exception('Regression of %s-%s failed', row['symbol1'],
+                     row['symbol2'])
+    return False
+  return True
+
+def tf_run(ctx, units, planned, done):
+  import creek_tf as ct
+  ct.e = ctx['epochs']
+  # Retire the checkpoints of the pairs retrained and of pairs now gone
+  retrain = set(units)
+  ct.retire_checkpoints(lambda title: title in retrain or
+                        title not in planned.keys())
+  ct.clear_outputs(units)
+  pairs = subset(ctx, units, planned)
+  ct.frames = {}
+  ct.get_frames(set(pairs['symbol1']) | set(pairs['symbol2']))
+  parallel(ctx)
+  completed = pairs.parallel_apply(regress, axis=1)
+  for t, ok in zip(titles(pairs), completed):
+    if ok: done(t)
+  if completed.any(): ct.write_version()
+  return True
+
+STAGES = [
+  Stage('refresh_bars', ['alpaca bars'],
+        ['minute_bar_dir/SYMBOL.csv', 'hour_bar_dir/SYMBOL.csv'],
+        refresh_plan, refresh_run),
+  Stage('interpolate', ['minute_bar_dir/SYMBOL.csv'],
+        ['interpolated_bars_dir/SYMBOL.csv', 'pearson_dir/interpolated.csv'],
+        interpolate_plan, interpolate_run, interpolate_finish,
+        after=('refresh_bars',)),
+  Stage('pearson_all', ['interpolated_bars_dir/*.csv'],
+        ['pearson_dir/pearson.csv'], pearson_all_plan, pearson_all_run,
+        after=('interpolate',), whole=True),
+  Stage('historical', ['pearson_dir/pearson.csv', 'hour_bar_dir/SYMBOL.csv'],
+        [], historical_plan, historical_run, after=('refresh_bars',)),
+  Stage('sparse', ['minute_bar_dir/SYMBOL.csv'],
+        ['pearson_dir/pearson_historical.csv', 'root/pearson.csv'],
+        sparse_plan, sparse_run, sparse_finish,
+        after=('refresh_bars', 'historical'), whole=True),
+  Stage('tf', ['pearson_dir/pearson_historical.csv',
+               'minute_bar_dir/SYMBOL.csv'],
+        ['root/checkpoints/PAIR', 'tf_dir/{dev,regression,loss}/PAIR'],
+        tf_plan, tf_run, after=('refresh_bars', 'sparse')),
+]
+
+def dirty(ctx, stage, planned, upstream=()):
+  '''
+  The units of stage to run: those whose key changed or, when estimating
+  the plan, that read a symbol an earlier stage will rewrite.
+  '''
+  stored = ctx['state'].keys.get(stage.name, {})
+  symbols = ctx['symbols']
+  units = []
+  for u, (k, unit_symbols) in planned.items():
+    if symbols and not symbols.intersection(unit_symbols): continue
+    if (ctx['force'] or stored.get(u) != k or
+        any(s in upstream for s in unit_symbols)):
+      units.append(u)
+  return units
+
+def plan(ctx, stages):
+  '''
+  [(stage, units, to run, estimated seconds or None, note)]
+  '''
+  rows = []
+  rewritten = {} # 'stage': symbols it will rewrite
+  replanned = None
+  for stage in stages:
+    planned = stage.plan(ctx)
+    upstream = set()
+    for a in stage.after: upstream |= rewritten.get(a, set())
+    units = dirty(ctx, stage, planned, upstream)
+    rewritten[stage.name] = set(s for u in units for s in planned[u][1])
+    per_unit = ctx['state'].timings.get(stage.name)
+    note = ''
+    if replanned is not None: note = 'units known after %s' % replanned
+    if stage.whole and units and replanned is None: replanned = stage.name
+    rows.append((stage, len(planned), len(units),
+                 per_unit * len(units) if per_unit is not None else None,
+                 note))
+  return rows
+
+def table(rows, actual=None):
+  lines = ['%-14s %8s %8s %12s  %s' % ('stage', 'units', 'to run',
+                                       'est. (s)' if actual is None
+                                       else 'took (s)', 'inputs -> outputs')]
+  for stage, n, m, seconds, note in rows:
+    if actual is not None: seconds = actual.get(stage.name)
+    lines.append('%-14s %8s %8s %12s  %s -> %s%s' %
+                 (stage.name, n, m,
+                  '?' if seconds is None else '%.0f' % seconds,
+                  ', '.join(stage.inputs), ', '.join(stage.outputs) or '-',
+                  ' (%s)' % note if note else ''))
+  return '\n'.join(lines)
+
+def execute(ctx, stage):
+  '''
+  Re-plan stage from the files as they are now and run what changed.
+  Returns the seconds taken, or None if the pipeline must stop.
+  '''
+  logger = logging.getLogger(__name__)
+  state = ctx['state']
+  start = time.monotonic()
+  planned = stage.plan(ctx)
+  units = dirty(ctx, stage, planned)
+  logger.info('%s: %s of %s units to run', stage.name, len(units),
+              len(planned))
+  keys = state.keys.setdefault(stage.name, {})
+  results = state.results.setdefault(stage.name, {})
+  saved = [time.monotonic()]
+  def done(unit, result=None):
+    keys[unit] = planned[unit][0]
+    if result is not None: results[unit] = result
+    if time.monotonic() - saved[0] > SAVE_INTERVAL:
+      state.save()
+      saved[0] = time.monotonic()
+  with profiling.stage(stage.name):
+    ok = stage.run(ctx, units, planned, done) if units else True
+    if ok is not False and stage.finish is not None:
+      ok = stage.finish(ctx, planned)
+  # Forget the units that left the stage
+  for u in [u for u in keys.keys() if u not in planned.keys()]:
+    keys.pop(u)
+    results.pop(u, None)
+  seconds = time.monotonic() - start
+  if units: state.timings[stage.name] = seconds / len(units)
+  state.save()
+  logger.info('%s: done in %.1f seconds', stage.name, seconds)
+  if ok is False:
+    logger.error('%s did not complete; stopping', stage.name)
+    return None
+  return seconds
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Run the nightly pipeline, '
+                                   'redoing only what changed')
+  names = [s.name for s in STAGES]
+  parser.add_argument('--plan', action='store_true',
+                      help='show the plan and exit')
+  parser.add_argument('--only', help='comma separated stages to run (%s)' %
+                      ', '.join(names))
+  parser.add_argument('--skip', help='comma separated stages not to run')
+  parser.add_argument('--symbols', help='comma separated symbols to '
+                      'restrict every stage to')
+  parser.add_argument('--force', action='store_true',
+                      help='run every unit, changed or not')
+  parser.add_argument('--workers', type=int, default=mp.cpu_count())
+  parser.add_argument('--epochs', type=int, default=100)
+  parser.add_argument('--profile', action='store_true',
+                      help='profile the stages (see profiling.py)')
+  args = parser.parse_args(argv)
+  logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+    handlers=[logging.handlers.WatchedFileHandler(os.environ.get("LOGFILE", "creek-pipeline.log"))]
+  )
+  logger = logging.getLogger(__name__)
+  selected = args.only.split(',') if args.only else names
+  skipped = args.skip.split(',') if args.skip else []
+  unknown = set(selected + skipped) - set(names)
+  if unknown: parser.error('unknown stages: %s' % ', '.join(sorted(unknown)))
+  stages = [s for s in STAGES if s.name in selected and s.name not in skipped]
+  ctx = {'state': State(os.path.join(g.root, STATE)), 'today': date.today(),
+         'symbols': set(args.symbols.split(',')) if args.symbols else set(),
+         'force': args.force, 'workers': args.workers,
+         'epochs': args.epochs}
+  rows = plan(ctx, stages)
+  print(table(rows))
+  # Fingerprints computed while planning are kept for the run
+  ctx['state'].save()
+  if args.plan: return
+  profiling.start('creek-pipeline', g.root)
+  actual = {}
+  for stage in stages:
+    seconds = execute(ctx, stage)
+    if seconds is None: break
+    actual[stage.name] = seconds
+  print(table(plan(ctx, stages), actual))
+  return
+
+if __name__ == '__main__':
+  main()
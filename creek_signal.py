@@ -5,42 +5,73 @@ from datetime import timedelta as td
 import math
 import time
 import pytz as tz
-import pandas as pd
-from alpaca.data.requests import StockLatestTradeRequest
-from alpaca.data.requests import StockLatestQuoteRequest
+import numpy as np
 from . import trade
+from . import broker
+from . import market_data
+from . import tiers
+from . import ledger
+from . import orders
+from . import netting
+from . import hedging
 from . import io
+from . import metrics
+from . import logs
+from . import reload
 from . import config as g
 
 class Clock():
   '''
-  Uses machine time if it's wihin one second of market time, otherwise
-  uses market time via alpaca api.
-  _local(bool): whether to use the local clock or query the API.
-                If the two times are within a second of each other, use
-                the machine time.
+  Market time without a REST call per now(). The offset between the
+  broker's clock and the local monotonic clock is measured once, assuming
+  the broker stamped its reply halfway through the round trip, and now()
+  is served from time.monotonic() plus that offset. The offset is
+  remeasured every CLOCK_RESYNC_INTERVAL seconds (see resync_due).
+  skew(float): seconds the broker's clock is ahead of the machine's.
+  rtt(float): round-trip time of the last measurement in seconds.
   '''
   def __init__(self):
-    ac_clock = g.tclient.get_clock()
-    delta = dt.now(tz=tz.timezone('US/Eastern')) - ac_clock.timestamp
-    if abs(delta.total_seconds()) < 1: self._local = True
-    else: self._local = False
+    self.skew = 0.0
+    self.rtt = 0.0
+    self.sync()
     logger = logging.getLogger(__name__)
-    if self._local: logger.info('Using local clock')
-    else: logger.info('Using Alpaca clock')
+    logger.info('Clock skew against Alpaca: %.3f seconds (rtt %.3f)',
+                self.skew, self.rtt)
+
+  def _measure(self, ac_clock, sent, received, wall):
+    self.rtt = received - sent
+    self._synced = sent + self.rtt / 2
+    self._epoch = ac_clock.timestamp.timestamp()
+    self.skew = self._epoch - (wall + self.rtt / 2)
     self.is_open = ac_clock.is_open
     self.next_open = ac_clock.next_open
     self.next_close = ac_clock.next_close
 
-  def refresh(self):
+  def sync(self):
+    wall = time.time()
+    sent = time.monotonic()
     ac_clock = g.tclient.get_clock()
-    self.is_open = ac_clock.is_open
-    self.next_open = ac_clock.next_open
-    self.next_close = ac_clock.next_close
+    self._measure(ac_clock, sent, time.monotonic(), wall)
+
+  async def resync(self):
+    logger = logging.getLogger(__name__)
+    wall = time.time()
+    sent = time.monotonic()
+    ac_clock = await broker.get_clock()
+    self._measure(ac_clock, sent, time.monotonic(), wall)
+    logger.info('Clock resynced: skew %.3f seconds, rtt %.3f',
+                self.skew, self.rtt)
+
+  def resync_due(self):
+    return time.monotonic() - self._synced > g.CLOCK_RESYNC_INTERVAL
+
+  def refresh(self): self.sync()
+
+  def sleep(self, seconds): time.sleep(seconds)
 
   def now(self):
-    if self._local: return dt.now(tz=tz.timezone('US/Eastern'))
-    else: return g.tclient.get_clock().timestamp
+    return dt.fromtimestamp(self._epoch + time.monotonic() - self._synced,
+                            tz=tz.timezone('US/Eastern'))
 
   def rest(self):
     logger = logging.getLogger(__name__)
@@ -48,13 +79,13 @@ class Clock():
     if delta.seconds > 0:
       delta = delta + td(seconds=5)
       s = self.next_open.strftime("%m/%d/%Y %H:%M")
-      logger.info('Market next open at %s; sleeping for %s' % (s,delta))
-      time.sleep(delta.seconds)
+      logger.info('Market next open at %s; sleeping for %s', s,delta)
+      self.sleep(delta.seconds)
     self.refresh()
 
-def cancel_all():
+async def cancel_all():
   logger = logging.getLogger(__name__)
-  cancel_response = g.tclient.cancel_orders()
+  cancel_response = await broker.cancel_orders()
   if len(cancel_response) > 0:
     logger.info('There were canceled orders with the following HTTP statuses')
     for s in cancel_response:
@@ -68,7 +99,9 @@ def num(s):
   return q
 
 '''
-Compare open positions to actual positions and return the difference
+Compare open positions to actual positions and return the difference.
+This is the full reconciliation against the broker; between runs the
+ledger tracks positions incrementally from fills.
 '''
 async def resolve_positions():
   logger = logging.getLogger(__name__)
@@ -78,20 +111,24 @@ async def resolve_positions():
     if t.status() == 'open':
       # side, qty, avg_entry_price
       for s, p in t.get_position().items():
-        if p['qty'] < 0: logger.error('%s has position in %s with negative quantity' % (self._title, s))
+        if p['qty'] < 0: logger.error('%s has position in %s with negative quantity', self._title, s)
         if s in expected_positions.keys():
           expected_positions[s] = expected_positions[s] + p['qty'] if p['side'] == 'long' else expected_positions[s] - p['qty']
         else: expected_positions[s] = p['qty'] if p['side'] == 'long' else - p['qty']
-  g.positions = g.tclient.get_all_positions() # List[Position]
+  for s, q in hedging.residual.items():
+    expected_positions[s] = expected_positions.get(s, 0) + q
+  g.positions = await broker.get_all_positions() # List[Position]
+  ledger.seed(g.positions)
+  ledger.rebuild()
   for p in g.positions:
     # p.qty is already signed
     qty = num(p.qty)
     if p.symbol not in expected_positions.keys():
-      logger.warning('There is an unknown position in %s' % p.symbol)
+      logger.warning('There is an unknown position in %s', p.symbol)
       excess_positions[p.symbol] = qty
     else:
       if abs(expected_positions[p.symbol] - qty) > 0.1:
-        logger.warning('Expected position in %s = %s; actual position = %s' % (p.symbol, expected_positions[p.symbol], qty))
+        logger.warning('Expected position in %s = %s; actual position = %s', p.symbol, expected_positions[p.symbol], qty)
         excess_positions[p.symbol] = qty - expected_positions[p.symbol]
   
   await asyncio.gather(*(trade.fix_position(s, -q)
@@ -103,13 +140,11 @@ async def resolve_positions():
 Most trades will barely exceed the threshold, and those should be sorted
 by their pearson coefficients. Some, however, will materially exceed the 
 threshold, and those should be sorted by their deviation.
+Returns the indices of the candidates in rank order.
 '''
-def sort_trades(to_open):
-  to_open_outliers = to_open[to_open['dev'] > 1.1 * g.TO_OPEN_SIGNAL]
-  to_open_bulk = to_open[to_open['dev'] <= 1.1 * g.TO_OPEN_SIGNAL]
-  to_open_outliers.sort_values(by='dev',ascending=False,inplace=True)
-  to_open_bulk.sort_values(by='pearson',ascending=False,inplace=True)
-  return pd.concat([to_open_outliers,to_open_bulk])
+def rank_trades(pearson, dev):
+  outlier = dev > 1.1 * g.TO_OPEN_SIGNAL
+  return np.lexsort((np.where(outlier, -dev, -pearson), ~outlier))
 
 '''
 We want to make sure we don't become overconcentrated in one symbol
@@ -118,40 +153,42 @@ maximum allowed exposure to any one symbol as a percentage of total
 equity. We go by cost basis rather than market value because if we have
 a pair that undergoes a large tandem price movement, the cost basis is
 a better measure of exposure.
+
+select_trades ranks the candidates {'title': [pearson, dev, long, short]}
+and walks them once, in rank order, accepting a candidate only while
+both its symbols have long/short capacity left, and stops handing out
+trades after the first n (see available_trades). Capacities are computed
+once per candidate symbol with NumPy. Returns the accepted titles and
+how many candidates would have been accepted with unlimited cash.
 '''
-def remove_concentration(to_open):
-  logger = logging.getLogger(__name__)
-  positions_d = {}
-  for p in g.positions:
-    if p.symbol in positions_d.keys():
-      logger.error('Multiple positions in the same symbol.')
-    positions_d[p.symbol] = p
-  for key in g.active_symbols.keys():
-    if key in positions_d.keys():
-      position = positions_d[key]
-      sign = 1 if position.side == 'long' else -1
-      frac_position = sign * float(position.cost_basis) / g.equity
-    else: frac_position = 0
-    # frac_position + longs * g.MAX_TRADE_SIZE / 2 <= g.MAX_SYMBOL
-    longs = math.floor((g.MAX_SYMBOL
-                             -frac_position)*2/g.MAX_TRADE_SIZE)
-    # frac_position - shorts * g.MAX_TRADE_SIZE / 2 >= -g.MAX_SYMBOL
-    shorts = math.floor((g.MAX_SYMBOL
-                              +frac_position)*2/g.MAX_TRADE_SIZE)
-    l = to_open['long'].to_list().count(key)
-    s = to_open['short'].to_list().count(key)
-    net = l-s
-    if net > longs:
-      # diff = net - longs
-      mask = ((to_open['long']!=key) |
-              (to_open.groupby('long').cumcount() <= l - (net - longs)))
-      to_open = to_open[mask]
-    elif net < -shorts:
-      # diff = -(net - (-shorts)) = -net - shorts
-      mask = ((to_open['short']!=key) |
-              (to_open.groupby('short').cumcount() <= s -(-net-shorts)))
-      to_open = to_open[mask]
-  return to_open
+def select_trades(to_open, n):
+  if not to_open: return [], 0
+  titles = list(to_open.keys())
+  values = list(to_open.values())
+  pearson = np.fromiter((v[0] for v in values), np.float64, len(values))
+  dev = np.fromiter((v[1] for v in values), np.float64, len(values))
+  symbols, codes = np.unique([v[2] for v in values] +
+                             [v[3] for v in values], return_inverse=True)
+  codes = codes.reshape(2, len(values))
+  exposure = np.array([ledger.exposure(s) for s in symbols]) / g.equity
+  # frac_position + longs * g.MAX_TRADE_SIZE / 2 <= g.MAX_SYMBOL
+  longs = np.floor((g.MAX_SYMBOL - exposure) * 2 / g.MAX_TRADE_SIZE)
+  # frac_position - shorts * g.MAX_TRADE_SIZE / 2 >= -g.MAX_SYMBOL
+  shorts = np.floor((g.MAX_SYMBOL + exposure) * 2 / g.MAX_TRADE_SIZE)
+  longs = longs.astype(np.int64).tolist()
+  shorts = (-shorts).astype(np.int64).tolist()
+  net = [0] * len(symbols)
+  selected = []
+  eligible = 0
+  order = rank_trades(pearson, dev)
+  for i, l, s in zip(order.tolist(), codes[0][order].tolist(),
+                     codes[1][order].tolist()):
+    if net[l] + 1 > longs[l] or net[s] - 1 < shorts[s]: continue
+    net[l] = net[l] + 1
+    net[s] = net[s] - 1
+    eligible = eligible + 1
+    if len(selected) < n: selected.append(titles[i])
+  return selected, eligible
 
 '''
 The following method determines the number of trades that can be opened
@@ -176,119 +213,151 @@ def retarget(clock):
     util = sum(g.retarget['util'])/len(g.retarget['util'])
     missed = sum(g.retarget['missed']) / len(g.retarget['missed'])
     if util + missed * g.MAX_TRADE_SIZE < 0.95:
-      logger.info('Last hour util: %s. Last hour missed trades: %s. Lowering TO_OPEN_SIGNAL from %s to %s' % (util, missed, g.TO_OPEN_SIGNAL, g.TO_OPEN_SIGNAL - 0.1))
+      logger.info('Last hour util: %s. Last hour missed trades: %s. Lowering TO_OPEN_SIGNAL from %s to %s', util, missed, g.TO_OPEN_SIGNAL, g.TO_OPEN_SIGNAL - 0.1)
       g.TO_OPEN_SIGNAL = g.TO_OPEN_SIGNAL - 0.1
+      tiers.reset()
       g.retarget['missed'].clear()
       g.retarget['util'].clear()
     elif util + missed * g.MAX_TRADE_SIZE > 1.05:
-      logger.info('Last hour util: %s. Last hour missed trades: %s. Raising TO_OPEN_SIGNAL from %s to %s' % (util, missed, g.TO_OPEN_SIGNAL, g.TO_OPEN_SIGNAL + 0.1))
+      logger.info('Last hour util: %s. Last hour missed trades: %s. Raising TO_OPEN_SIGNAL from %s to %s', util, missed, g.TO_OPEN_SIGNAL, g.TO_OPEN_SIGNAL + 0.1)
       g.TO_OPEN_SIGNAL = g.TO_OPEN_SIGNAL + 0.1
       g.retarget['missed'].clear()
       g.retarget['util'].clear()
   return
 
+'''
+The evaluation half of main, with no order flow: takes the pairs whose
+symbols received bars, appends those bars to the pairs due this cycle
+(see tiers.py) and to every open pair, and reads their signals.
+Returns the evaluated titles, the titles to bail out of and to close,
+and the open candidates {'title': [pearson, dev, long, short]}.
+replay.py runs this on its own when it is not simulating a broker.
+'''
+def evaluate(clock):
+  to_close = []
+  to_bail_out = []
+  to_open = {}
+  with metrics.span('ingest'):
+    dirty = io.take_dirty()
+    evaluated = tiers.select(dirty - g.open_trades) | (dirty & g.open_trades)
+  with metrics.span('sigma'):
+    for key in evaluated | g.open_trades:
+      t = g.trades[key]
+      if key in evaluated: t.append_bar()
+      if t.status() == 'open':
+        if t.bail_out_signal(clock): to_bail_out.append(key)
+        elif t.close_signal(clock): to_close.append(key)
+      elif t.status() == 'closed':
+        o, d, l, s = t.open_signal(clock)
+        if o: to_open[key] = [abs(t.pearson()), d, l, s]
+        tiers.schedule(key, t)
+  return evaluated, to_bail_out, to_close, to_open
+
 async def main(clock):
   logger = logging.getLogger(__name__)
   logger.info('Entering main')
   start = time.time()
-  to_close = []
-  to_bail_out = []
-  to_open = {}
-  symbols = []
-  for key, t in g.trades.items():
-    t.append_bar()
-    if t.status() == 'open':
-      if t.bail_out_signal(clock):
-        to_bail_out.append(key)
-        symbols.extend(key.split('-'))
-      elif t.close_signal(clock):
-        to_close.append(key)
-        symbols.extend(key.split('-'))
-    elif t.status() == 'closed':
-      o, d, l, s = t.open_signal(clock)
-      if o: to_open[key] = [abs(t.pearson()), d, l, s]
-  to_open_df = pd.DataFrame.from_dict(to_open, orient='index',
-               columns=['pearson','dev','long','short'])
-  to_open_df = sort_trades(to_open_df)
-  to_open_df = remove_concentration(to_open_df)
-  n = available_trades()
-  symbols = list(set(to_open_df['long'][:n].to_list() +
-                 to_open_df['short'][:n].to_list() + symbols))
+  cycle = time.perf_counter()
+  lag = asyncio.create_task(metrics.loop_lag())
+  evaluated, to_bail_out, to_close, to_open = evaluate(clock)
+  with metrics.span('ranking'):
+    n = available_trades()
+    selected, eligible = select_trades(to_open, n)
+  symbols = set()
+  for key in to_bail_out + to_close + selected: symbols.update(key.split('-'))
+  symbols = sorted(symbols)
   if symbols:
-    quote_request = StockLatestQuoteRequest(symbol_or_symbols=symbols)
-    trade_request = StockLatestTradeRequest(symbol_or_symbols=symbols)
-    latest_quote = g.hclient.get_stock_latest_quote(quote_request)
-    latest_trade = g.hclient.get_stock_latest_trade(trade_request)
-    hedge = await asyncio.gather(
-      *(g.trades[k].try_close(clock, latest_quote, latest_trade)
-        for k in to_bail_out),
-      *(g.trades[k].try_close(clock, latest_quote, latest_trade)
-        for k in to_close),
-      *(g.trades[k].try_open(clock, latest_quote, latest_trade)
-        for k in to_open_df[:n].index))
-    # Need to buy a fraction of an index for the remainder.
-    # Remember to add this index to active_symbols manually.
-    hedge_notional = 0.0 # To go long (in dollars)
-    hedge_d = {} # To cover (negative fractional quantity)
-    closed_trades_by_hedge = {} # Indexed by hedging symbol
-    for h in hedge:
-      if h == 0: continue
-      if type(h) is float:
-         if h < 0: logger.error('Negative hedge passed without symbol')
-         else: hedge_notional = hedge_notional + h
-      if type(h) is tuple:
-        if h[1] > 0:
-          logger.error('Positive hedge passed with symbol')
-          continue
-        elif h[0] in hedge_d.keys():
-          hedge_d[h[0]] = hedge_d[h[0]] + h[1]
-        else: hedge_d[h[0]] = h[1]
-        if h[0] in closed_trades_by_hedge.keys():
-          closed_trades_by_hedge[h[0]].append(h[2])
-        else: closed_trades_by_hedge[h[0]] = [h[2]]
-    logger.info('Trying to close the following hedges:')
-    logger.info(hedge_d)
-    if hedge_notional > 1: # Minimum notational amount
-      hedged = await asyncio.gather(trade.hedge(hedge_notional),
-        *(trade.hedge_close(symbol, qty, closed_trades_by_hedge)
-          for symbol, qty in hedge_d.items()))
-      hedged_price = 0.0
-      for h in hedged:
-        if type(h) is float:
-          hedged_price = h
-          break
-      for k in to_open_df[:n].index:
-        if g.trades[k].status() == 'open':
-          g.trades[k].fill_hedge(hedged_price)
-    else:
-      hedged = await asyncio.gather(
-        *(trade.hedge_close(symbol, qty, closed_trades_by_hedge)
-          for symbol, qty in hedge_d.items()))
-      for k in to_open_df[:n].index:
-        if g.trades[k].status() == 'open':
-          g.trades[k].zero_hedge()
-    for k in to_bail_out: io.delete_json(k)
-    for k in to_close: io.delete_json(k)
-    for k in to_open_df[:n].index: io.save_json(k)
-    # Give a moment for positions to update from the recent trades
-    time.sleep(2)
-  g.retarget['missed'].append(max(0,len(to_open_df) - n))
-  account = g.tclient.get_account()
-  g.equity = trade.equity(account)
-  g.cash = trade.cash(account)
+    with metrics.span('quotes'):
+      market_data.watch(symbols)
+      latest_quote, latest_trade = await asyncio.gather(
+        market_data.latest_quote(symbols), market_data.latest_trade(symbols))
+    plans = []
+    for k in to_bail_out:
+      legs = g.trades[k].plan_close(clock, latest_quote, latest_trade,
+                                    priority=broker.BAIL_OUT)
+      plans.append((k, 'close', legs))
+    for k in to_close:
+      legs = g.trades[k].plan_close(clock, latest_quote, latest_trade)
+      plans.append((k, 'close', legs))
+    for k in selected:
+      legs = g.trades[k].plan_open(clock, latest_quote, latest_trade)
+      plans.append((k, 'open', legs))
+    # Net opposing legs on the same symbol before anything is submitted
+    with metrics.span('execute'):
+      filled = await netting.execute([l for k, a, legs in plans if legs
+                                      for l in legs])
+    hedge = []
+    i = 0
+    for k, action, legs in plans:
+      if not legs:
+        hedge.append(0)
+        continue
+      f = filled[i:i + len(legs)]
+      i = i + len(legs)
+      if action == 'close':
+        hedge.append(g.trades[k].book_close(clock, legs, f))
+      else: hedge.append(g.trades[k].book_open(clock, legs, f))
+    # Hedges of opened and closed trades are netted by the hedge manager
+    opened = []
+    closed = []
+    for (k, action, legs), h in zip(plans, hedge):
+      if type(h) is tuple: closed.append(h[2])
+      elif type(h) is float and h > 0: opened.append(g.trades[k])
+    with metrics.span('hedge'): await hedging.rebalance(opened, closed)
+    with metrics.span('booking'):
+      for k in to_bail_out + to_close:
+        if g.trades[k].status() == 'closed': g.open_trades.discard(k)
+      for k in selected:
+        if g.trades[k].status() != 'closed': g.open_trades.add(k)
+      for k in to_bail_out: io.delete_json(k)
+      for k in to_close: io.delete_json(k)
+      for k in selected: io.save_json(k)
+      for k in to_bail_out + to_close + selected:
+        ledger.book(g.trades[k])
+      # Stream quotes and trades only for what is still open
+      in_play = {g.HEDGE_SYMBOL}
+      for k in g.open_trades: in_play.update(k.split('-'))
+      market_data.retain(in_play)
+  g.retarget['missed'].append(max(0, eligible - n))
+  with metrics.span('reconcile'):
+    # Cancel whatever this engine left working, rather than every order
+    await orders.cancel()
+    orders.forget()
+    if ledger.reconcile_due():
+      # Give a moment for positions to update from the recent trades
+      await asyncio.sleep(2)
+      g.account = await broker.get_account()
+      await resolve_positions()
+  g.equity = trade.equity(g.account)
+  g.cash = trade.cash(g.account)
   g.retarget['util'].append(1 - g.cash / g.equity)
   retarget(clock)
-  cancel_all()
-  await resolve_positions()
-  logger.info('signal.main() finished after %s seconds' % (time.time() - start))
-  if time.time() - start < 2: time.sleep(2)
+  # Swap in a new model set now rather than after the sleep below, which
+  # would make the next cycle start late
+  began = time.time()
+  with metrics.span('reload'): reloaded = reload.check()
+  if reloaded:
+    logger.info('Reload took %.2f seconds, %.2f of the 60 second cycle used',
+                time.time() - began, time.time() - start)
+  lag.cancel()
+  metrics.observe('phase', time.perf_counter() - cycle, phase='cycle')
+  logs.record_cycle()
+  logger.info('signal.main() finished after %s seconds', time.time() - start)
+  broker.log_stats()
+  tiers.log_stats()
+  netting.log_stats()
+  hedging.log_stats()
+  metrics.flush()
+  if clock.resync_due(): await clock.resync()
+  if time.time() - start < 2:
+    with metrics.span('sleep'): clock.sleep(2)
   now = clock.now()
   if (time.time() - start) > 60: return
   elif ((clock.next_close - now) >= td(minutes=1, seconds=58)):
     if now.second==0: delta = 1-now.microsecond/1000000
     elif now.second<=2: return
     else: delta = 61-now.second-now.microsecond/1000000
-    logger.info('Sleeping for %s seconds' % delta)
-    time.sleep(delta)
+    logger.info('Sleeping for %s seconds', delta)
+    with metrics.span('sleep'): clock.sleep(delta)
     return
-  return
\ No newline at end of file
+  return
@@ -19,6 +19,8 @@ import sys
 import glob
 import shutil
 import config as g
+import bar_server
+import profiling
 
 # Default number of epochs
 e = 100
@@ -30,25 +32,28 @@ def get_active_symbols(p):
   active_symbols.extend(p['symbol2'].tolist())
   return set(active_symbols) # remove duplicates
 
+@profiling.stage('get_frames')
 def get_frames(symbols):
   logger = logging.getLogger(__name__)
   logger.info('Fetching minute bars for %s symbols' % len(symbols))
   global frames
   frame = pd.DataFrame()
+  cutoff_date = date.today().replace(year=date.today().year-1)
+  t = time(hour=0,minute=0,tzinfo=tz.timezone('UTC'))
+  cutoff = dt.combine(cutoff_date, t)
   for symbol in symbols:
     try:
-      path = os.path.join(g.minute_bar_dir, symbol + '.csv')
-      frame = pd.read_csv(path)
+      frame = bar_server.frame(symbol, 'Minute', start=cutoff)
+      if frame is None:
+        path = os.path.join(g.minute_bar_dir, symbol + '.csv')
+        frame = pd.read_csv(path)
+        frame = frame.drop(columns=['symbol','open','high','low','close','volume','trade_count'],axis=1)
+        frame.set_index('timestamp', inplace=True)
+        frame.index = pd.to_datetime(frame.index)
     except FileNotFoundError as error:
       logger.warning('%s.csv not found' % symbol)
       sys.exit(1)
     assert not frame.empty
-    frame = frame.drop(columns=['symbol','open','high','low','close','volume','trade_count'],axis=1)
-    frame.set_index('timestamp', inplace=True)
-    frame.index = pd.to_datetime(frame.index)
-    cutoff_date = date.today().replace(year=date.today().year-1)
-    t = time(hour=0,minute=0,tzinfo=tz.timezone('UTC'))
-    cutoff = dt.combine(cutoff_date, t)
     frames[symbol] = frame[cutoff:]
   logger.info('Databases loaded')
   return
@@ -93,6 +98,7 @@ def plot_loss(history, symbol1, symbol2, e):
   plt.savefig(path, bbox_inches='tight', dpi=300)
   return
 
+@profiling.task
 def regress(row):
   logger = logging.getLogger(__name__)
   symbol1 = row['symbol1']
@@ -148,6 +154,37 @@ def clear_dir(path):
     os.remove(f)
   return
 
+def clear_outputs(titles=None):
+  '''
+  Remove the dev, regression and loss outputs of the pairs in titles, or
+  of every pair if titles is None.
+  '''
+  for d, ext in [('dev', '.csv'), ('regression', '.png'), ('loss', '.png')]:
+    if titles is None:
+      clear_dir(os.path.join(g.tf_dir, d, '*'))
+      continue
+    for title in titles:
+      path = os.path.join(g.tf_dir, d, title + ext)
+      if os.path.exists(path): os.remove(path)
+  return
+
+def checkpoint_title(name):
+  for suffix in ('.index', '.data-'):
+    if suffix in name: return name[:name.index(suffix)]
+  return name
+
+def retire_checkpoints(retire):
+  '''
+  Empty old_checkpoints, then move there the checkpoint files of every
+  pair whose title retire(title) is true.
+  '''
+  clear_dir(os.path.join(g.tf_dir, 'old_checkpoints', '*'))
+  for f in glob.glob(os.path.join(g.root, 'checkpoints', '*')):
+    name = os.path.basename(f)
+    if retire(checkpoint_title(name)):
+      shutil.move(f, os.path.join(g.tf_dir, 'old_checkpoints', name))
+  return
+
 def get_open_trades():
   path = os.path.join(g.root, 'open_trades', '*.json')
   files = glob.glob(path)
@@ -160,25 +197,25 @@ def get_open_trades():
     symbol2.append(name.split('-')[1])
   return pd.DataFrame({'symbol1': symbol1, 'symbol2': symbol2})
 
+def write_version():
+  '''
+  Tell a running engine that a new model set is complete (see reload.py).
+  '''
+  path = os.path.join(g.root, 'model_version')
+  with open(path + '.tmp', 'w') as f:
+    f.write(dt.now().isoformat())
+  os.replace(path + '.tmp', path)
+  return
+
 def main():
   logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
     handlers=[logging.handlers.WatchedFileHandler(os.environ.get("LOGFILE", "creek-tf.log"))]
   )
-  path = os.path.join(g.tf_dir, 'dev', '*')
-  clear_dir(path)
-  path = os.path.join(g.tf_dir, 'regression', '*')
-  clear_dir(path)
-  path = os.path.join(g.tf_dir, 'loss', '*')
-  clear_dir(path)
-  path = os.path.join(g.tf_dir, 'old_checkpoints', '*')
-  clear_dir(path)
-  path = os.path.join(g.root, 'checkpoints', '*')
-  files = glob.glob(path)
-  for f in files:
-    name = f.split('/')[-1]
-    shutil.move(f, os.path.join(g.tf_dir, 'old_checkpoints', name))
+  profiling.start('creek-tf', g.tf_dir)
+  clear_outputs()
+  retire_checkpoints(lambda title: True)
   logger = logging.getLogger(__name__)
   path = os.path.join(g.pearson_dir, 'pearson_historical.csv')
   pearson = pd.read_csv(path)
@@ -189,8 +226,9 @@ def main():
   get_frames(symbols)
   logger.info('Beginning regression on %s pairs over %s epochs.' % (len(pearson), e))
   pandarallel.initialize(nb_workers = mp.cpu_count(), progress_bar = True)
-  pearson.parallel_apply(regress, axis=1)
+  with profiling.stage('regress'): pearson.parallel_apply(regress, axis=1)
   logger.info('Regression complete.')
+  write_version()
   return
 
 def refresh_symbols(*argv):
@@ -200,21 +238,10 @@ def refresh_symbols(*argv):
     format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
     handlers=[logging.handlers.WatchedFileHandler(os.environ.get("LOGFILE", "creek-tf.log"))]
   )
-  path = os.path.join(g.tf_dir, 'dev', '*')
-  clear_dir(path)
-  path = os.path.join(g.tf_dir, 'regression', '*')
-  clear_dir(path)
-  path = os.path.join(g.tf_dir, 'loss', '*')
-  clear_dir(path)
-  path = os.path.join(g.tf_dir, 'old_checkpoints', '*')
-  clear_dir(path)
-  path = os.path.join(g.root, 'checkpoints', '*')
-  files = glob.glob(path)
-  for f in files:
-    name = f.split('/')[-1]
-    title = name.split('.')[0]
-    if len(set(title.split('-')).intersection(set(a))) != 0:
-      shutil.move(f, os.path.join(g.tf_dir, 'old_checkpoints', name))
+  profiling.start('creek-tf', g.tf_dir)
+  clear_outputs()
+  retire_checkpoints(lambda title:
+                     len(set(title.split('-')).intersection(set(a))) != 0)
   logger = logging.getLogger(__name__)
   path = os.path.join(g.pearson_dir, 'pearson_historical.csv')
   pearson = pd.read_csv(path)
@@ -226,8 +253,9 @@ def refresh_symbols(*argv):
   get_frames(symbols)
   logger.info('Beginning regression on %s pairs over %s epochs.' % (len(pearson), e))
   pandarallel.initialize(nb_workers = mp.cpu_count(), progress_bar = True)
-  pearson.parallel_apply(regress, axis=1)
+  with profiling.stage('regress'): pearson.parallel_apply(regress, axis=1)
   logger.info('Regression complete.')
+  write_version()
   return
 
 if __name__ == '__main__':
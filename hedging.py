@@ -0,0 +1,161 @@
+import logging
+import asyncio
+import time
+from alpaca.trading.requests import MarketOrderRequest
+from . import config as g
+from . import broker
+from . import orders
+from . import market_data
+from . import ledger
+from . import trade
+from . import metrics
+from . import logs
+
+'''
+Hedge manager. Each open trade is hedged with a long fractional position
+in a hedge ETF, sized to the dollar difference between its short and long
+legs. Rather than buying every new trade's hedge and selling every closed
+trade's hedge with separate market orders, the manager works per hedge
+symbol: the shares released by trades that closed are netted against the
+shares needed by trades that opened, and the remainder is carried across
+cycles as an unattributed residual. The broker is only asked to trade
+when the residual is worth more than HEDGE_BAND dollars, and then only
+for the whole residual, in one order.
+
+Every trade is still attributed a hedge: trades opened in a cycle get
+notional / price shares at that cycle's hedge price, and trades closed in
+the cycle exit theirs at the same price. The hedge price is the fill
+price of the order if one was sent, otherwise the latest trade. The
+residual is reported to the ledger, so that reconciliation expects it.
+'''
+residual = {} # 'SYMBOL': signed shares held beyond what trades are attributed
+# Metrics since startup
+orders_sent = 0
+orders_saved = 0
+
+def attributed(symbol):
+  qty = 0.0
+  for title in g.open_trades:
+    h = g.trades[title].get_hedge()
+    if h['symbol'] == symbol: qty = qty + h['qty']
+  return qty
+
+def adopt():
+  '''
+  Take over whatever hedge shares the broker holds beyond those attributed
+  to open trades, up to HEDGE_BAND dollars, so that a restart does not
+  sell them off during reconciliation.
+  '''
+  logger = logging.getLogger(__name__)
+  for symbol in set(g.HEDGE_SYMBOL_LIST):
+    held = ledger.actual.get(symbol, 0)
+    if held == 0: continue
+    extra = held - attributed(symbol)
+    price = abs(ledger.cost.get(symbol, 0.0) / held)
+    if extra != 0 and abs(extra) * price <= g.HEDGE_BAND:
+      set_residual(symbol, extra)
+      logger.info('Adopted hedge residual of %s %s', extra, symbol)
+  return
+
+def set_residual(symbol, qty):
+  if abs(qty) < 1e-9: qty = 0.0
+  if qty: residual[symbol] = qty
+  else: residual.pop(symbol, None)
+  ledger.book_residual(symbol, qty)
+  return
+
+async def _market(symbol, side, notional=None, qty=None):
+  '''
+  Hedge with a market order, by notional or quantity. Returns the shares
+  filled and their average price.
+  '''
+  logger = logging.getLogger(__name__)
+  start = time.monotonic()
+  amount = ('notional %s' % notional if notional is not None
+            else 'qty %s' % qty)
+  request = MarketOrderRequest(symbol = symbol,
+                               notional = (round(notional, 2)
+                                           if notional is not None else None),
+                               qty = qty,
+                               side = side,
+                               client_order_id = trade.stamp('hedge'),
+                               time_in_force = 'day')
+  response = await trade.try_submit(request)
+  if response is None or type(response) is int:
+    logger.error('Market %s order for %s %s not submitted',
+                 side, symbol, amount)
+    return 0.0, 0.0
+  order = await orders.wait(response.id)
+  logger.info('Hedge %s of %s: status %s after %.2f seconds',
+              side, symbol, order.status, time.monotonic() - start, extra=logs.UNLIMITED)
+  if order.status in ('filled', 'partially_filled'):
+    return float(order.filled_qty), float(order.filled_avg_price)
+  logger.error('Market %s order %s for %s not filled with status %s',
+               side, order.id, symbol, order.status)
+  return 0.0, 0.0
+
+async def rebalance_symbol(symbol, opened, closed, price):
+  '''
+  Net the hedges of the trades opened and closed on one hedge symbol,
+  trade the residual if it is outside the band and attribute the hedge
+  price to every trade. Returns the signed shares traded.
+  '''
+  global orders_sent, orders_saved
+  logger = logging.getLogger(__name__)
+  released = sum(c.get_hedge()['qty'] for c in closed)
+  needed = sum(t.get_hedge()['notional'] for t in opened) / price
+  drift = residual.get(symbol, 0.0) + released - needed
+  traded = 0.0
+  # Orders the old per-cycle buy and sell would have sent
+  unnetted = int(bool(opened)) + int(released > 0)
+  if abs(drift) * price > g.HEDGE_BAND:
+    if drift < 0: filled, fill_price = await _market(symbol, 'buy',
+                                                     notional=-drift * price)
+    else:
+      filled, fill_price = await _market(symbol, 'sell',
+                                         qty=round(drift, 9))
+      filled = -filled
+    if filled != 0:
+      traded = filled
+      price = fill_price
+    orders_sent = orders_sent + 1
+    orders_saved = orders_saved + max(0, unnetted - 1)
+  else: orders_saved = orders_saved + unnetted
+  for t in opened: t.fill_hedge(price)
+  for c in closed:
+    c.set_hedge_exit_price(price if c.get_hedge()['qty'] else 0.0)
+  needed = sum(t.get_hedge()['qty'] for t in opened)
+  set_residual(symbol, residual.get(symbol, 0.0) + released + traded
+               - needed)
+  logger.info('Hedge %s: %s trades opened, %s closed, traded %s shares, residual %s shares',
+              symbol, len(opened), len(closed), traded,
+              residual.get(symbol, 0.0))
+  return traded
+
+async def rebalance(opened, closed):
+  '''
+  opened: Trades opened this cycle with a hedge notional to fill.
+  closed: ClosedTrades whose hedges were released this cycle.
+  '''
+  broker.priority.set(broker.HEDGE)
+  by_symbol = {}
+  for t in opened:
+    by_symbol.setdefault(t.get_hedge()['symbol'], ([], []))[0].append(t)
+  for c in closed:
+    by_symbol.setdefault(c.get_hedge()['symbol'], ([], []))[1].append(c)
+  if not by_symbol: return
+  latest_trade = await market_data.latest_trade(list(by_symbol.keys()))
+  await asyncio.gather(*(rebalance_symbol(s, o, c,
+                                          float(latest_trade[s].price))
+                         for s, (o, c) in by_symbol.items()))
+  return
+
+def log_stats():
+  logger = logging.getLogger(__name__)
+  if orders_sent or orders_saved:
+    logger.info('Hedging: %s orders sent, %s saved by netting, residual %s',
+                orders_sent, orders_saved, residual)
+  return
+
+metrics.register('hedging', lambda: {'orders_sent': orders_sent,
+                                     'orders_saved': orders_saved})
@@ -6,6 +6,8 @@ import numpy as np
 import asyncio
 import glob
 import json
+import threading
+import time
 from datetime import datetime as dt
 import pytz as tz
 from alpaca.trading.requests import GetAssetsRequest
@@ -13,17 +15,42 @@ from alpaca.trading.enums import AssetClass
 from alpaca.data.live import StockDataStream
 from alpaca.trading.stream import TradingStream
 from alpaca.trading.models import Asset
-import matplotlib.pyplot as plt
 from . import config as g
 from . import trade
+from . import orders
+from . import market_data
+from . import models
+from . import metrics
+from . import ledger
+from . import logs
 from . import creek_signal as signal
 
+dirty_lock = threading.Lock()
+
+'''
+Asset metadata for the whole US equity universe changes rarely, so it is
+cached on disk in assets.json and only refetched after ASSET_CACHE_TTL
+seconds.
+'''
 def get_assets():
+  logger = logging.getLogger(__name__)
+  path = os.path.join(g.root, 'assets.json')
+  try:
+    if time.time() - os.path.getmtime(path) < g.ASSET_CACHE_TTL:
+      with open(path, 'r') as f:
+        return {d['symbol']: Asset(**d) for d in json.load(f)}
+  except (IOError, ValueError) as error:
+    logger.warning('Asset cache unreadable: %s', error)
   search_params = GetAssetsRequest(asset_class=AssetClass.US_EQUITY)
   assets = g.tclient.get_all_assets(search_params)
   assets_dict = {}
   for a in assets:
     assets_dict[a.symbol] = a
+  try:
+    with open(path + '.tmp', 'w') as f:
+      json.dump([a.model_dump(by_alias=True) for a in assets], f, default=str)
+    os.replace(path + '.tmp', path)
+  except IOError as error: logger.error(error)
   return assets_dict
 
 '''
@@ -42,20 +69,31 @@ def read_trade(path, assets):
                       squeeze=True, parse_dates=True,
                       date_parser=lambda x: pd.to_datetime(x, utc=True))
   except FileNotFoundError:
-    logger.warn('%s not found' % path.split('/')[-1])
+    logger.warn('%s not found', path.split('/')[-1])
     sigma_series = pd.Series(dtype=np.float64)
   t.open_init(trade_dict, sigma_series)
   return t
 
+def read_pearson():
+  path = os.path.join(g.root, 'pearson.csv')
+  pearson = pd.read_csv(path, index_col=0)
+  pearson['title'] = pearson['symbol1'] + '-' + pearson['symbol2']
+  return pearson
+
 def load_trades():
   logger = logging.getLogger(__name__)
   symbol_list = []
   g.trades = {}
+  start = time.monotonic()
   assets = get_assets()
-  path = os.path.join(g.root, 'pearson.csv')
-  pearson = pd.read_csv(path, index_col=0)
+  logger.info('Loaded %s assets in %.2f seconds',
+              len(assets), time.monotonic() - start)
+  pearson = read_pearson()
   path = os.path.join(g.root, 'open_trades', '*.json')
   open_trade_list = glob.glob(path)
+  titles = [f.split('/')[-1].split('.')[0] for f in open_trade_list]
+  models.load(list(dict.fromkeys(titles + pearson['title'].to_list())))
+  start = time.monotonic()
   logger.info('Loading open trades')
   for open_trade in open_trade_list:
     title = open_trade.split('/')[-1]
@@ -63,25 +101,27 @@ def load_trades():
     symbols = title.split('-')
     symbol_list.extend(symbols)
     g.trades[title] = read_trade(open_trade, assets)
-  logger.info('Loading remaining tensorflow models')
-  for index, row in pearson.iterrows():
-    title = row['symbol1'] + '-' + row['symbol2']
+  logger.info('Loading remaining models')
+  for title, symbol1, symbol2, p, ph in zip(pearson['title'],
+      pearson['symbol1'], pearson['symbol2'], pearson['pearson'],
+      pearson['pearson_historical']):
     if title in g.trades.keys():
-      g.trades[title].pearson = float(row['pearson'])
-      g.trades[title].pearson_historical= float(row['pearson_historical'])
+      g.trades[title]._pearson = float(p)
+      g.trades[title]._pearson_historical = float(ph)
     if title not in g.trades.keys():
-      symbol_list.extend([row['symbol1'],row['symbol2']])
-      g.trades[title] = trade.Trade([assets[row['symbol1']], 
-                                    assets[row['symbol2']]],
-                                    float(row['pearson']), 
-                                    float(row['pearson_historical']))
+      symbol_list.extend([symbol1, symbol2])
+      g.trades[title] = trade.Trade([assets[symbol1], assets[symbol2]],
+                                    float(p), float(ph))
+  logger.info('Built %s trades in %.2f seconds',
+              len(g.trades), time.monotonic() - start)
   symbol_list.extend(g.HEDGE_SYMBOL_LIST)
   for p in g.positions:
     if p.symbol not in symbol_list:
-      logger.warning('There is an unknown position in %s' % p.symbol)
+      logger.warning('There is an unknown position in %s', p.symbol)
   asset_dict = {}
   for symbol in set(symbol_list):
     asset_dict[symbol] = assets[symbol]
+  index_trades()
   for i in range(len(g.HEDGE_SYMBOL_LIST)):
     if assets[g.HEDGE_SYMBOL_LIST[i]].fractionable:
       g.HEDGE_SYMBOL = g.HEDGE_SYMBOL_LIST[i]
@@ -92,14 +132,70 @@ def load_trades():
       sys.exit(1)
   return asset_dict
 
+'''
+Inverted index from each symbol to the pairs that reference it, so that
+signal.main only revisits pairs whose symbols have received new bars.
+'''
+def index_trades():
+  g.pairs_by_symbol = {}
+  g.open_trades = set()
+  for title, t in g.trades.items():
+    if t.status() == 'disabled': continue
+    for symbol in title.split('-'):
+      g.pairs_by_symbol.setdefault(symbol, set()).add(title)
+    if t.status() != 'closed': g.open_trades.add(title)
+  return
+
+'''
+Returns the pairs referencing a symbol that received a bar since the last
+call, and resets the dirty set. bar_data_handler runs on the websocket
+thread, hence the lock.
+'''
+def take_dirty():
+  with dirty_lock:
+    dirty = g.dirty_symbols
+    g.dirty_symbols = set()
+  pairs = set()
+  for symbol in dirty:
+    pairs.update(g.pairs_by_symbol.get(symbol, ()))
+  return pairs
+
 def stock_wss():
   wss_client = StockDataStream(g.key, g.secret_key)
   wss_client.subscribe_bars(bar_data_handler, 
                             *g.active_symbols.keys())
+  market_data.stream = wss_client
+  symbols = [g.HEDGE_SYMBOL]
+  for key, t in g.trades.items():
+    if t.status() == 'open': symbols.extend(key.split('-'))
+  market_data.watch(symbols)
   wss_client.run()
 
+'''
+If BAR_CAPTURE is set, every bar received is also appended to that file
+as a JSON line, for replay.py to play back.
+'''
+_capture = None
+
+def capture(bar):
+  global _capture
+  if _capture is None: _capture = open(g.BAR_CAPTURE, 'a')
+  _capture.write(json.dumps({'symbol': bar.symbol,
+                             'timestamp': bar.timestamp.isoformat(),
+                             'open': bar.open, 'high': bar.high,
+                             'low': bar.low, 'close': bar.close,
+                             'volume': bar.volume,
+                             'trade_count': bar.trade_count,
+                             'vwap': bar.vwap}) + '\n')
+  _capture.flush()
+  return
+
 async def bar_data_handler(bar):
+  metrics.count('ws_messages', stream='bars')
+  if g.BAR_CAPTURE: capture(bar)
+  if bar.symbol not in g.bars.keys(): return # Dropped by reload.apply
   g.bars[bar.symbol].append(bar)
+  with dirty_lock: g.dirty_symbols.add(bar.symbol)
 
 def account_wss():
   trading_stream = TradingStream(g.key, g.secret_key, paper=g.is_paper)
@@ -109,30 +205,20 @@ def account_wss():
 # update is class alpaca.trading.models TradeUpdate
 async def trading_stream_handler(update):
   logger = logging.getLogger(__name__)
-  coi = update.order.client_order_id.split('_')[0]
-  if coi not in g.orders.keys():
-    logger.error('TradeUpdate for a trade not in g.orders:')
-    logger.error(update)
+  metrics.count('ws_messages', stream='trade_updates')
+  if update.event in ('fill', 'partial_fill'):
+    ledger.fill(update.order.symbol, update.order.side, float(update.qty),
+                float(update.price))
+  if not orders.update(update.order): return # Stale update
+  if orders.title_of(update.order) not in g.trades.keys() and (
+     orders.title_of(update.order) not in ('hedge', update.order.symbol)):
+    logger.warning('TradeUpdate for an order not placed by creek: %s', update)
   else:
-    if update.order.side == 'buy':
-      if ('buy' in g.orders[coi].keys() and 
-          g.orders[coi]['buy'] is not None and
-          g.orders[coi]['buy'].id == update.order.id and
-          g.orders[coi]['buy'].status == 'filled'): return
-      else:
-        g.orders[coi]['buy'] = update.order
-        logger.info(update)
-    elif update.order.side == 'sell':
-      if ('sell' in g.orders[coi].keys() and 
-          g.orders[coi]['sell'] is not None and
-          g.orders[coi]['sell'].id == update.order.id and
-          g.orders[coi]['sell'].status == 'filled'): return
-      else:
-        g.orders[coi]['sell'] = update.order
-        logger.info(update)
-    else:
-      logger.warning('TradeUpdate for a trade with unknown side')
-      logger.warning(update)
+    order = update.order
+    logger.info('%s %s: %s %s, %s/%s filled at %s (order %s)',
+                update.event, order.client_order_id, order.side,
+                order.symbol, order.filled_qty, order.qty,
+                order.filled_avg_price, order.id, extra=logs.UNLIMITED)
 
 def load_config():
   logger = logging.getLogger(__name__)
@@ -165,11 +251,12 @@ def save_json(k):
       json.dump(t.to_dict(), f, indent=2)
   except IOError as error:
     logger = logging.getLogger(__name__)
-    logger.error('%s save failed:' % k)
+    logger.error('%s save failed:', k)
     logger.error(error)
   return
 
 def save():
+  import matplotlib.pyplot as plt
   logger = logging.getLogger(__name__)
   plt.style.use('seaborn')
   logger.info('Saving TO_OPEN_SIGNAL + burn_list')
@@ -181,7 +268,7 @@ def save():
       json.dump(config_data, f, indent=2)
   except IOError as error: logger.error(error)
   path = g.root + '/open_trades/*'
-  logger.info('Emptying %s/open_trades' % g.root)
+  logger.info('Emptying %s/open_trades', g.root)
   files = glob.glob(path)
   for f in files: os.remove(f)
   logger.info('Saving open trades')
@@ -201,6 +288,7 @@ def save():
   return
 
 def report(equity):
+  import matplotlib.pyplot as plt
   logger = logging.getLogger(__name__)
   plt.style.use('seaborn')
   logger.info('Archiving closed trades')
@@ -215,7 +303,7 @@ def report(equity):
       with open(path, 'w') as f:
         json.dump(t.to_dict(), f, indent=2)
     except IOError as error:
-      logger.error('%s save failed:' % t.title())
+      logger.error('%s save failed:', t.title())
       logger.error(error)
     s = t.get_sigma_series()
     plt.clf()
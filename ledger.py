@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+from . import config as g
+
+'''
+Incremental position ledger. For every symbol it keeps the actual signed
+position and its cost basis, updated from fill events on the trading
+stream, and the expected signed position implied by open trades, updated
+whenever a trade is opened or closed. Symbols where the two disagree are
+kept in a drift set, so each fill or booking costs O(1) per symbol and no
+REST calls. A full reconciliation against the broker (signal.
+resolve_positions) only runs when drift is left over at the end of a cycle
+or every RECONCILE_INTERVAL seconds.
+'''
+_lock = threading.Lock()
+actual = {} # 'SYMBOL': signed qty held at the broker
+cost = {} # 'SYMBOL': signed cost basis of the actual position
+expected = {} # 'SYMBOL': signed qty implied by open trades
+drift = set() # Symbols where actual and expected disagree
+_booked = {} # 'SYMBOL1-SYMBOL2': ({'SYMBOL': signed qty}, cost basis)
+_residual = {} # 'SYMBOL': signed hedge qty not attributed to any trade
+cost_basis = 0.0 # Unsigned cost basis of all open trades
+last_reconcile = 0.0
+
+def _check(symbol):
+  if abs(expected.get(symbol, 0) - actual.get(symbol, 0)) > 0.1:
+    drift.add(symbol)
+  else: drift.discard(symbol)
+
+def fill(symbol, side, qty, price):
+  '''
+  Apply a (partial) fill reported by the trading stream.
+  '''
+  with _lock:
+    q = actual.get(symbol, 0)
+    c = cost.get(symbol, 0.0)
+    delta = qty if side == 'buy' else -qty
+    new = q + delta
+    if q == 0 or new == 0 or (new > 0) != (q > 0): c = new * price
+    elif (q > 0) == (delta > 0): c = c + delta * price # Adding
+    else: c = c * new / q # Reducing at unchanged average cost
+    actual[symbol] = new
+    cost[symbol] = c
+    _check(symbol)
+  return
+
+def _contribution(t):
+  positions = {}
+  basis = 0.0
+  if t.status() != 'open': return positions, basis
+  for s, p in t.get_position().items():
+    qty = p['qty'] if p['side'] == 'long' else -p['qty']
+    positions[s] = positions.get(s, 0) + qty
+    basis = basis + p['qty'] * p['avg_entry_price']
+  return positions, basis
+
+def _replace(key, positions, basis):
+  global cost_basis
+  with _lock:
+    old_positions, old_basis = _booked.pop(key, ({}, 0.0))
+    for s, q in old_positions.items():
+      expected[s] = expected.get(s, 0) - q
+      _check(s)
+    for s, q in positions.items():
+      expected[s] = expected.get(s, 0) + q
+      _check(s)
+    cost_basis = cost_basis - old_basis + basis
+    if positions: _booked[key] = (positions, basis)
+  return
+
+def book(t):
+  '''
+  Replace whatever trade t contributed to expected positions and cost
+  basis with its current contribution. Call after t opens or closes.
+  '''
+  positions, basis = _contribution(t)
+  _replace(t.title(), positions, basis)
+  return
+
+def book_residual(symbol, qty):
+  '''
+  Expect qty hedge shares in symbol beyond those attributed to open
+  trades (see hedging.py).
+  '''
+  if qty: _residual[symbol] = qty
+  else: _residual.pop(symbol, None)
+  _replace('residual:' + symbol, {symbol: qty} if qty else {}, 0.0)
+  return
+
+def rebuild():
+  '''
+  Recompute expected positions from every open trade.
+  '''
+  global cost_basis
+  with _lock:
+    expected.clear()
+    _booked.clear()
+    cost_basis = 0.0
+  for t in g.trades.values(): book(t)
+  for s, q in list(_residual.items()): book_residual(s, q)
+  with _lock:
+    for s in set(actual.keys()) | set(expected.keys()): _check(s)
+  return
+
+def seed(positions):
+  '''
+  Reset actual positions from the broker's List[Position].
+  '''
+  global last_reconcile
+  with _lock:
+    actual.clear()
+    cost.clear()
+    for p in positions:
+      sign = 1 if p.side == 'long' else -1
+      actual[p.symbol] = float(p.qty)
+      cost[p.symbol] = sign * float(p.cost_basis)
+    for s in set(actual.keys()) | set(expected.keys()): _check(s)
+    last_reconcile = time.monotonic()
+  return
+
+def exposure(symbol):
+  '''
+  Signed cost basis of the actual position in symbol.
+  '''
+  return cost.get(symbol, 0.0)
+
+def reconcile_due():
+  logger = logging.getLogger(__name__)
+  if drift:
+    logger.info('Drift detected in %s', sorted(drift))
+    return True
+  return time.monotonic() - last_reconcile > g.RECONCILE_INTERVAL
@@ -0,0 +1,148 @@
+import logging
+import logging.handlers
+import atexit
+import copy
+import queue
+import threading
+import time
+from . import config as g
+from . import metrics
+
+'''
+Logging for the live engine, off the event loop and the websocket
+threads. Records are put on a queue as they are (message template and
+arguments, nothing formatted) and a listener thread formats them and
+writes them to the log file, so a slow disk delays the log rather than
+order handling. Only what could change before the listener gets to it is
+copied when queued: container arguments (shallow) and tracebacks.
+
+Repetitive messages are rate limited per call site: at most
+LOG_RATE_BURST records of INFO or below from one line of code every
+LOG_RATE_WINDOW seconds. The first record let through after a window in
+which some were dropped says how many were. Warnings and errors are never
+dropped, and neither are records logged with extra=logs.UNLIMITED: order
+and fill records, which come from a few lines of code but must all be
+kept.
+
+The time spent logging in the calling threads is measured: signal.main
+reports it once per cycle as log_overhead (see metrics.py), along with
+how many records were queued and dropped, and the listener's write time
+per record as log_write.
+'''
+FORMAT = '%(asctime)s:%(levelname)s:%(name)s:%(message)s'
+UNLIMITED = {'ratelimit': False} # logger.info(..., extra=logs.UNLIMITED)
+_queue = None
+_listener = None
+_lock = threading.Lock()
+# Since the last take_stats(): seconds spent queuing, records, dropped
+_stats = [0.0, 0, 0]
+total_dropped = 0
+
+class RateLimit(logging.Filter):
+  def __init__(self):
+    super().__init__()
+    self.sites = {} # (pathname, lineno): [window start, records, dropped]
+    self.lock = threading.Lock()
+
+  def filter(self, record):
+    global total_dropped
+    if record.levelno >= logging.WARNING: return True
+    if not getattr(record, 'ratelimit', True): return True
+    site = (record.pathname, record.lineno)
+    with self.lock:
+      s = self.sites.get(site)
+      if s is None or record.created - s[0] >= g.LOG_RATE_WINDOW:
+        dropped = s[2] if s is not None else 0
+        self.sites[site] = [record.created, 1, 0]
+        if dropped:
+          record.msg = str(record.msg) + (' (%s similar messages dropped)' %
+                                          dropped)
+        return True
+      if s[1] < g.LOG_RATE_BURST:
+        s[1] += 1
+        return True
+      s[2] += 1
+      total_dropped = total_dropped + 1
+    with _lock: _stats[2] += 1
+    return False
+
+class Handler(logging.handlers.QueueHandler):
+  def prepare(self, record):
+    '''
+    Queue the record unformatted, unlike QueueHandler.
+    '''
+    if record.exc_info:
+      # Render the traceback now rather than keep its frames alive
+      if not record.exc_text:
+        record.exc_text = logging.Formatter().formatException(record.exc_info)
+      record.exc_info = None
+    if isinstance(record.args, dict): record.args = dict(record.args)
+    elif record.args:
+      record.args = tuple(copy.copy(a) if isinstance(a, (list, dict, set))
+                          else a for a in record.args)
+    return record
+
+  def handle(self, record):
+    start = time.perf_counter()
+    queued = super().handle(record)
+    with _lock:
+      _stats[0] += time.perf_counter() - start
+      if queued: _stats[1] += 1
+    return queued
+
+class Listener(logging.handlers.QueueListener):
+  def handle(self, record):
+    start = time.perf_counter()
+    super().handle(record)
+    metrics.observe('log_write', time.perf_counter() - start)
+
+def setup(path, level=logging.INFO):
+  '''
+  Route every logger through the queue to a WatchedFileHandler on path,
+  in place of logging.basicConfig.
+  '''
+  global _queue, _listener
+  if _listener is not None: return
+  file = logging.handlers.WatchedFileHandler(path)
+  file.setFormatter(logging.Formatter(FORMAT))
+  _queue = queue.SimpleQueue()
+  handler = Handler(_queue)
+  handler.addFilter(RateLimit())
+  root = logging.getLogger()
+  root.setLevel(level)
+  root.handlers = [handler]
+  _listener = Listener(_queue, file, respect_handler_level=True)
+  _listener.start()
+  atexit.register(stop)
+  return
+
+def stop():
+  '''
+  Write out whatever is still queued.
+  '''
+  global _listener
+  if _listener is None: return
+  _listener.stop()
+  _listener = None
+  return
+
+def take_stats():
+  '''
+  (seconds spent queuing records, records queued, records dropped) since
+  the last call.
+  '''
+  with _lock:
+    s = tuple(_stats)
+    _stats[:] = [0.0, 0, 0]
+  return s
+
+def record_cycle():
+  seconds, records, dropped = take_stats()
+  metrics.observe('log_overhead', seconds)
+  metrics.count('log_records', records)
+  metrics.count('log_dropped', dropped)
+  return
+
+metrics.register('logs', lambda: {'queue_depth': _queue.qsize()
+                                  if _queue is not None else 0,
+                                  'dropped': total_dropped})
@@ -0,0 +1,105 @@
+import logging
+import time
+from . import config as g
+from . import broker
+from . import metrics
+
+'''
+Latest quote/trade cache fed by the stock data websocket. Symbols are
+subscribed to quotes and trades as they come into play (open trades and
+candidates to open), and unsubscribed once the cycle is over if they are
+no longer part of an open trade (see retain). Every entry records when it
+was last refreshed. Reads fall back to one batched REST call for
+whichever symbols are stale.
+
+A subscribed symbol's entry is fresh if it was refreshed within
+MARKET_DATA_MAX_AGE seconds, or if the stream has delivered a message
+within MARKET_DATA_STREAM_TIMEOUT seconds (a quiet symbol's last print is
+still its latest print as long as the connection is alive). Any other
+entry, fetched by REST, is fresh for MARKET_DATA_REST_MAX_AGE seconds.
+'''
+stream = None # StockDataStream, set by io.stock_wss
+subscribed = set()
+quotes = {} # 'SYMBOL': (<Quote>, refreshed monotonic time)
+trades = {} # 'SYMBOL': (<Trade>, refreshed monotonic time)
+last_message = 0.0
+rest_fallbacks = 0
+
+async def quote_handler(quote):
+  global last_message
+  last_message = time.monotonic()
+  quotes[quote.symbol] = (quote, last_message)
+  metrics.count('ws_messages', stream='quotes')
+
+async def trade_handler(trade):
+  global last_message
+  last_message = time.monotonic()
+  trades[trade.symbol] = (trade, last_message)
+  metrics.count('ws_messages', stream='trades')
+
+def watch(symbols):
+  '''
+  Subscribe to quotes and trades for any symbols not yet subscribed.
+  '''
+  logger = logging.getLogger(__name__)
+  new = [s for s in set(symbols) if s not in subscribed]
+  if not new or stream is None: return
+  stream.subscribe_quotes(quote_handler, *new)
+  stream.subscribe_trades(trade_handler, *new)
+  subscribed.update(new)
+  logger.info('Subscribed to quotes and trades for %s symbols', len(new))
+  return
+
+def unwatch(symbols):
+  old = [s for s in set(symbols) if s in subscribed]
+  if not old or stream is None: return
+  stream.unsubscribe_quotes(*old)
+  stream.unsubscribe_trades(*old)
+  subscribed.difference_update(old)
+  for s in old:
+    quotes.pop(s, None)
+    trades.pop(s, None)
+  return
+
+def retain(symbols):
+  '''
+  Unsubscribe from every symbol not in symbols.
+  '''
+  logger = logging.getLogger(__name__)
+  old = subscribed - set(symbols)
+  if not old or stream is None: return
+  unwatch(old)
+  logger.info('Unsubscribed from quotes and trades for %s symbols', len(old))
+  return
+
+def is_fresh(cache, symbol, now):
+  if symbol not in cache.keys(): return False
+  age = now - cache[symbol][1]
+  if symbol not in subscribed: return age < g.MARKET_DATA_REST_MAX_AGE
+  if age < g.MARKET_DATA_MAX_AGE: return True
+  return now - last_message < g.MARKET_DATA_STREAM_TIMEOUT
+
+async def _latest(cache, fetch, symbols):
+  global rest_fallbacks
+  if type(symbols) is str: symbols = [symbols]
+  now = time.monotonic()
+  stale = [s for s in set(symbols) if not is_fresh(cache, s, now)]
+  if stale:
+    rest_fallbacks = rest_fallbacks + len(stale)
+    response = await fetch(stale)
+    now = time.monotonic()
+    for s, v in response.items(): cache[s] = (v, now)
+  return {s: cache[s][0] for s in symbols if s in cache.keys()}
+
+'''
+The following return {'SYMBOL': <Quote>} and {'SYMBOL': <Trade>}
+respectively, just like the batched REST latest-quote/latest-trade calls.
+'''
+async def latest_quote(symbols):
+  return await _latest(quotes, broker.latest_quote, symbols)
+
+async def latest_trade(symbols):
+  return await _latest(trades, broker.latest_trade, symbols)
+
+metrics.register('market_data', lambda: {'subscribed': len(subscribed),
+                                         'rest_fallbacks': rest_fallbacks})
@@ -0,0 +1,257 @@
+import logging
+import logging.handlers
+import asyncio
+import bisect
+import contextlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import config as g
+
+'''
+Hot-path metrics for the live engine. Everything slow enough to matter is
+recorded into histograms with fixed buckets (seconds), keyed by name and
+labels:
+- phase{phase}: each phase of signal.main (see span), and the whole cycle,
+- rest{endpoint}: every REST call made through broker.py,
+- order_queue: time spent waiting for the order-rate budget,
+- fill_wait{outcome}: orders.wait, until the order settled or timed out,
+- loop_lag: how late the event loop wakes up a sleeper (see loop_lag),
+and counters, such as ws_messages{stream} for every websocket message.
+Modules with their own statistics (broker, tiers, netting, hedging,
+market_data) register a collector returning their current values, which
+are read as gauges whenever metrics are exported.
+
+Metrics are exported two ways: in Prometheus text format (and as JSON at
+/metrics.json) from a local HTTP endpoint on METRICS_PORT, and as one JSON
+line per METRICS_INTERVAL seconds in the rolling METRICS_FILE. The file
+holds what happened during each interval (histogram quantiles and message
+rates over the interval), so that a slow stretch in production can be
+traced to the phase that slowed down.
+
+Recording is cheap (a dict lookup, a bisect and a few additions under a
+lock), and safe from the websocket threads.
+'''
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_lock = threading.Lock()
+histograms = {} # (name, labels): <Histogram>
+counters = {} # (name, labels): count
+_collectors = {} # 'module': function returning {'gauge': value}
+_server = None
+_last = None # (monotonic time, histograms, counters) at the last flush
+
+class Histogram():
+  def __init__(self):
+    self.counts = [0] * (len(BUCKETS) + 1)
+    self.sum = 0.0
+    self.max = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+    self.sum = self.sum + value
+    if value > self.max: self.max = value
+
+  def copy(self):
+    h = Histogram()
+    h.counts = list(self.counts)
+    h.sum = self.sum
+    h.max = self.max
+    return h
+
+  def minus(self, other):
+    '''
+    What was observed since other, a copy of this histogram (the max is
+    this histogram's, as the interval's own is not kept).
+    '''
+    h = self.copy()
+    if other is not None:
+      h.counts = [a - b for a, b in zip(self.counts, other.counts)]
+      h.sum = self.sum - other.sum
+    return h
+
+  def count(self): return sum(self.counts)
+
+  def quantile(self, q):
+    '''
+    Interpolated within the bucket the quantile falls in.
+    '''
+    n = self.count()
+    if n == 0: return 0.0
+    rank = q * n
+    seen = 0
+    for i, c in enumerate(self.counts):
+      if c and seen + c >= rank:
+        low = BUCKETS[i - 1] if i > 0 else 0.0
+        high = BUCKETS[i] if i < len(BUCKETS) else self.max
+        return min(low + (high - low) * (rank - seen) / c, self.max)
+      seen = seen + c
+    return self.max
+
+  def summary(self):
+    n = self.count()
+    return {'count': n, 'sum': self.sum, 'mean': self.sum / n if n else 0.0,
+            'p50': self.quantile(0.5), 'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99), 'max': self.max}
+
+def key(name, labels):
+  return (name, tuple(sorted(labels.items())))
+
+def observe(name, seconds, **labels):
+  k = key(name, labels)
+  with _lock:
+    h = histograms.get(k)
+    if h is None: h = histograms[k] = Histogram()
+    h.observe(seconds)
+  return
+
+def count(name, n=1, **labels):
+  k = key(name, labels)
+  with _lock: counters[k] = counters.get(k, 0) + n
+  return
+
+@contextlib.contextmanager
+def span(phase):
+  '''
+  with metrics.span('quotes'): ... records the block's duration.
+  '''
+  start = time.perf_counter()
+  try: yield
+  finally: observe('phase', time.perf_counter() - start, phase=phase)
+
+async def loop_lag():
+  '''
+  Run as a task alongside a cycle: sleeps LOOP_LAG_INTERVAL seconds at a
+  time and records how much later than that it woke up, i.e. how long
+  something held the event loop.
+  '''
+  interval = g.LOOP_LAG_INTERVAL
+  while True:
+    start = time.monotonic()
+    await asyncio.sleep(interval)
+    observe('loop_lag', max(0.0, time.monotonic() - start - interval))
+
+def register(module, collector):
+  _collectors[module] = collector
+  return
+
+def gauges():
+  logger = logging.getLogger(__name__)
+  d = {}
+  for module, collector in list(_collectors.items()):
+    try: values = collector()
+    except Exception as error:
+      logger.warning('Metrics collector %s failed: %s' % (module, error))
+      continue
+    for name, value in values.items(): d[module + '_' + name] = value
+  return d
+
+def label_name(name, labels):
+  if not labels: return name
+  return name + '{' + ','.join('%s="%s"' % (k, v) for k, v in labels) + '}'
+
+def prometheus():
+  with _lock:
+    hs = [(k, h.copy()) for k, h in histograms.items()]
+    cs = list(counters.items())
+  lines = []
+  for (name, labels), h in sorted(hs):
+    base = 'creek_%s_seconds' % name
+    cumulative = 0
+    for bound, c in zip(BUCKETS + ('+Inf',), h.counts):
+      cumulative = cumulative + c
+      lines.append('%s %s' % (label_name(base + '_bucket',
+                                         labels + (('le', bound),)),
+                              cumulative))
+    lines.append('%s %s' % (label_name(base + '_sum', labels), h.sum))
+    lines.append('%s %s' % (label_name(base + '_count', labels), cumulative))
+  for (name, labels), c in sorted(cs):
+    lines.append('%s %s' % (label_name('creek_%s_total' % name, labels), c))
+  for name, value in sorted(gauges().items()):
+    lines.append('creek_%s %s' % (name, value))
+  return '\n'.join(lines) + '\n'
+
+def snapshot(since=None):
+  '''
+  Histogram summaries, counters and gauges, as a dict. With since (a
+  previous (time, histograms, counters)), histograms cover only what was
+  observed after it and counters come with their rates per second.
+  '''
+  now = time.monotonic()
+  with _lock:
+    hs = {k: h.copy() for k, h in histograms.items()}
+    cs = dict(counters)
+  d = {'time': time.time(), 'histograms': {}, 'counters': {}}
+  for k, h in sorted(hs.items()):
+    if since is not None: h = h.minus(since[1].get(k))
+    if h.count(): d['histograms'][label_name(*k)] = h.summary()
+  for k, c in sorted(cs.items()):
+    d['counters'][label_name(*k)] = c
+  if since is not None:
+    elapsed = max(now - since[0], 1e-9)
+    d['interval'] = elapsed
+    d['rates'] = {label_name(*k): (c - since[2].get(k, 0)) / elapsed
+                  for k, c in sorted(cs.items())}
+  d['gauges'] = gauges()
+  return d, (now, hs, cs)
+
+class Handler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path == '/metrics':
+      body = prometheus().encode()
+      content_type = 'text/plain; version=0.0.4'
+    elif self.path == '/metrics.json':
+      body = json.dumps(snapshot()[0]).encode()
+      content_type = 'application/json'
+    else:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args): return # Keep scrapes out of the log
+
+def start():
+  '''
+  Start the HTTP endpoint and the rolling metrics file.
+  '''
+  global _server, _last
+  logger = logging.getLogger(__name__)
+  if g.METRICS_FILE:
+    handler = logging.handlers.RotatingFileHandler(
+                g.METRICS_FILE, maxBytes=g.METRICS_FILE_BYTES,
+                backupCount=g.METRICS_FILE_BACKUPS)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    records = logging.getLogger(__name__ + '.file')
+    records.handlers = [handler]
+    records.setLevel(logging.INFO)
+    records.propagate = False
+  _last = snapshot()[1]
+  if g.METRICS_PORT and _server is None:
+    try:
+      _server = ThreadingHTTPServer(('127.0.0.1', g.METRICS_PORT), Handler)
+    except OSError as error:
+      logger.error('Metrics endpoint not started: %s' % error)
+      return
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True,
+                     name='metrics').start()
+    logger.info('Serving metrics on http://127.0.0.1:%s/metrics' %
+                g.METRICS_PORT)
+  return
+
+def flush(force=False):
+  '''
+  Append the interval's metrics to METRICS_FILE once METRICS_INTERVAL
+  seconds have passed since the last flush.
+  '''
+  global _last
+  if not g.METRICS_FILE or _last is None: return
+  if not force and time.monotonic() - _last[0] < g.METRICS_INTERVAL: return
+  d, _last = snapshot(_last)
+  logging.getLogger(__name__ + '.file').info(json.dumps(d))
+  return
@@ -0,0 +1,112 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from . import config as g
+
+'''
+Every pair model is the same two-unit Dense layer feeding a Normal
+distribution (see creek_tf.regress):
+  loc   = kernel_loc * x + bias_loc
+  scale = 1e-3 + softplus(0.05 * (kernel_scale * x + bias_scale))
+so a model is fully described by four floats. Rather than rebuilding and
+compiling a Keras model per pair, the live engine reads those four floats
+out of each checkpoint once, keeps them all in model_params.csv next to the
+checkpoints, and evaluates the distribution with NumPy. Tensorflow is only
+imported when a checkpoint is newer than its cached parameters.
+'''
+COLUMNS = ['kernel_loc', 'kernel_scale', 'bias_loc', 'bias_scale']
+params = {} # 'SYMBOL1-SYMBOL2': np.array([kl, ks, bl, bs])
+_mtimes = {} # 'SYMBOL1-SYMBOL2': checkpoint mtime the params were read at
+
+def checkpoint_path(title):
+  return os.path.join(g.root, 'checkpoints', title)
+
+def checkpoint_mtime(title):
+  try: return os.path.getmtime(checkpoint_path(title) + '.index')
+  except FileNotFoundError: return None
+
+def read_checkpoint(title):
+  logger = logging.getLogger(__name__)
+  os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+  import tensorflow as tf
+  try:
+    reader = tf.train.load_checkpoint(checkpoint_path(title))
+  except (tf.errors.NotFoundError, ValueError) as e:
+    logger.error(e)
+    return None
+  kernel = bias = None
+  for name in reader.get_variable_to_shape_map().keys():
+    if name.endswith('kernel/.ATTRIBUTES/VARIABLE_VALUE'):
+      kernel = reader.get_tensor(name)
+    elif name.endswith('bias/.ATTRIBUTES/VARIABLE_VALUE'):
+      bias = reader.get_tensor(name)
+  if kernel is None or bias is None:
+    logger.error('%s checkpoint has no dense kernel/bias' % title)
+    return None
+  kernel = np.asarray(kernel, dtype=np.float64).reshape(-1)
+  bias = np.asarray(bias, dtype=np.float64).reshape(-1)
+  return np.array([kernel[0], kernel[1], bias[0], bias[1]])
+
+def cache_path(): return os.path.join(g.root, 'model_params.csv')
+
+def read_cache():
+  try: cache = pd.read_csv(cache_path(), index_col=0)
+  except FileNotFoundError: return
+  values = cache[COLUMNS].to_numpy(dtype=np.float64)
+  for title, row, mtime in zip(cache.index, values, cache['mtime']):
+    params[title] = row
+    _mtimes[title] = float(mtime)
+  return
+
+def write_cache():
+  titles = list(params.keys())
+  cache = pd.DataFrame(np.array([params[t] for t in titles]).reshape(-1, 4),
+                       index=titles, columns=COLUMNS)
+  cache['mtime'] = [_mtimes[t] for t in titles]
+  path = cache_path()
+  cache.to_csv(path + '.tmp')
+  os.replace(path + '.tmp', path)
+  return
+
+'''
+Load the parameters of every pair in titles, reading in parallel only
+those checkpoints that are missing from, or newer than, the cache.
+Returns the list of titles whose parameters changed.
+'''
+def load(titles):
+  logger = logging.getLogger(__name__)
+  start = time.monotonic()
+  if not params: read_cache()
+  mtimes = {t: checkpoint_mtime(t) for t in titles}
+  todo = [t for t in titles if mtimes[t] is not None and
+          (t not in params.keys() or _mtimes[t] < mtimes[t])]
+  for t in titles:
+    if mtimes[t] is None:
+      params.pop(t, None)
+      _mtimes.pop(t, None)
+  if todo:
+    logger.info('Reading %s checkpoints' % len(todo))
+    with ThreadPoolExecutor(max_workers=g.MODEL_LOAD_WORKERS) as pool:
+      results = list(pool.map(read_checkpoint, todo))
+    for t, p in zip(todo, results):
+      if p is None: continue
+      params[t] = p
+      _mtimes[t] = mtimes[t]
+    write_cache()
+  logger.info('Loaded parameters for %s pairs in %.2f seconds' %
+              (len([t for t in titles if t in params.keys()]),
+               time.monotonic() - start))
+  return todo
+
+def get(title):
+  if title not in params.keys(): load([title])
+  return params.get(title)
+
+def mean(p, x):
+  return p[0] * x + p[2]
+
+def stddev(p, x):
+  return 1e-3 + np.logaddexp(0, 0.05 * (p[1] * x + p[3]))
@@ -0,0 +1,114 @@
+import logging
+import asyncio
+import math
+from alpaca.trading.requests import LimitOrderRequest
+from . import broker
+from . import market_data
+from . import trade
+from . import metrics
+
+'''
+Cross-pair order netting. Within one cycle several pairs can want opposing
+legs in the same symbol (one pair closing a long in XYZ while another opens
+a short in it, say). Rather than sending both to the broker, the legs
+planned by Trade.plan_open and Trade.plan_close are grouped by symbol and
+only the net quantity is submitted, as a single limit order. The crossed
+quantity never leaves the engine: every leg on the smaller side is filled
+in full, and the net order's fills plus the crossed quantity are shared
+out across the legs on the larger side in proportion to their size. All
+legs on a symbol are booked at the net order's average fill price, or at
+the latest trade if nothing was left to submit. A symbol with a single leg
+is executed exactly as before.
+'''
+# Metrics since startup
+crossed_shares = 0
+orders_saved = 0
+
+def allocate(total, qtys):
+  '''
+  Split an integer total across legs in proportion to qtys by largest
+  remainder, without giving any leg more than it asked for.
+  '''
+  size = sum(qtys)
+  if size == 0: return [0 for q in qtys]
+  exact = [total * q / size for q in qtys]
+  shares = [min(q, math.floor(e)) for q, e in zip(qtys, exact)]
+  order = sorted(range(len(qtys)), key=lambda i: shares[i] - exact[i])
+  left = total - sum(shares)
+  for i in order:
+    if left <= 0: break
+    if shares[i] < qtys[i]:
+      shares[i] = shares[i] + 1
+      left = left - 1
+  return shares
+
+def weighted(legs, field):
+  size = sum(l['qty'] for l in legs)
+  return sum(l['qty'] * l[field] for l in legs) / size
+
+async def execute_symbol(symbol, legs):
+  global crossed_shares, orders_saved
+  logger = logging.getLogger(__name__)
+  broker.priority.set(min(l['priority'] for l in legs))
+  if len(legs) == 1:
+    l = legs[0]
+    return [await trade.limit_qty(l['request'], l['title'], l['cushion'],
+                                  l['bid_ask'])]
+  buys = [l for l in legs if l['side'] == 'buy']
+  sells = [l for l in legs if l['side'] == 'sell']
+  net = sum(l['qty'] for l in buys) - sum(l['qty'] for l in sells)
+  major, minor = (buys, sells) if net > 0 else (sells, buys)
+  crossed = sum(l['qty'] for l in minor)
+  titles = set(l['title'] for l in legs)
+  title = titles.pop() if len(titles) == 1 else symbol
+  logger.info('Netting %s legs in %s: %s shares crossed, %s net',
+              len(legs), symbol, crossed, net)
+  filled = (0, 0.0)
+  if net != 0:
+    request = LimitOrderRequest(
+                symbol = symbol,
+                qty = abs(net),
+                side = major[0]['side'],
+                time_in_force = 'day',
+                client_order_id = trade.stamp(title),
+                limit_price = round(weighted(major, 'limit_price'), 2)
+                )
+    filled = await trade.limit_qty(request, title,
+                                   weighted(major, 'cushion'),
+                                   max(l['bid_ask'] for l in major))
+  if filled[0] > 0: price = filled[1]
+  else:
+    latest_trade = await market_data.latest_trade([symbol])
+    price = float(latest_trade[symbol].price)
+  crossed_shares = crossed_shares + crossed
+  orders_saved = orders_saved + len(legs) - (1 if net != 0 else 0)
+  result = {}
+  for l in minor: result[id(l)] = (l['qty'], price)
+  shares = allocate(crossed + filled[0], [l['qty'] for l in major])
+  for l, q in zip(major, shares):
+    result[id(l)] = (q, price if q > 0 else 0.0)
+  return [result[id(l)] for l in legs]
+
+async def execute(legs):
+  '''
+  Execute a list of legs, netted per symbol. Returns the (qty, avg_price)
+  filled for each leg, in the order given.
+  '''
+  by_symbol = {}
+  for l in legs: by_symbol.setdefault(l['symbol'], []).append(l)
+  results = await asyncio.gather(*(execute_symbol(s, ls)
+                                   for s, ls in by_symbol.items()))
+  filled = {}
+  for ls, r in zip(by_symbol.values(), results):
+    for l, f in zip(ls, r): filled[id(l)] = f
+  return [filled[id(l)] for l in legs]
+
+def log_stats():
+  logger = logging.getLogger(__name__)
+  if crossed_shares:
+    logger.info('Netting: %s shares crossed internally, %s orders saved',
+                crossed_shares, orders_saved)
+  return
+
+metrics.register('netting', lambda: {'crossed_shares': crossed_shares,
+                                     'orders_saved': orders_saved})
@@ -0,0 +1,175 @@
+import logging
+import asyncio
+import threading
+import time
+from alpaca.common.exceptions import APIError
+from . import config as g
+from . import broker
+from . import metrics
+
+'''
+Order store keyed by order id. io.trading_stream_handler runs on the
+websocket thread and feeds every order update into update(); the execution
+coroutines in trade.py register what they submit with track() and await
+wait() on it instead of sleeping a fixed amount of time and then polling.
+
+Each order moves through an explicit lifecycle: its state is the alpaca
+order status, states only move forward (an update that arrives out of
+order cannot revive a terminal order), and orders are indexed by title
+(the client_order_id prefix: pair title, 'hedge' or a symbol being fixed),
+symbol and side, so that any number of overlapping orders on the same pair
+or symbol can be tracked and cancelled individually.
+'''
+PENDING = ('pending_new', 'accepted', 'accepted_for_bidding', 'new',
+           'pending_replace', 'pending_cancel', 'held', 'calculated')
+TERMINAL = ('filled', 'canceled', 'expired', 'rejected', 'replaced',
+            'done_for_day', 'stopped', 'suspended')
+
+_lock = threading.Lock()
+_orders = {} # 'order_id': {'order': <Order>, 'title', 'symbol', 'side', 'state'}
+_by_title = {} # 'title': {'order_id', ...}
+_by_symbol = {} # 'SYMBOL': {'order_id', ...}
+_waiters = {} # 'order_id': [(loop, future, statuses)]
+
+def title_of(order):
+  coi = order.client_order_id or ''
+  return coi.split('_')[0]
+
+def rank(state):
+  if state in TERMINAL: return 2
+  elif state == 'partially_filled': return 1
+  else: return 0
+
+def _store(order):
+  '''
+  Insert or advance an order record. Returns False if the update was
+  stale. Must be called with _lock held.
+  '''
+  oid = str(order.id)
+  state = str(order.status.value if hasattr(order.status, 'value')
+              else order.status)
+  record = _orders.get(oid)
+  if record is not None:
+    if rank(record['state']) == 2: return False
+    if rank(state) < rank(record['state']): return False
+    record['order'] = order
+    record['state'] = state
+    return True
+  record = {'order': order, 'title': title_of(order),
+            'symbol': order.symbol, 'side': str(order.side.value
+            if hasattr(order.side, 'value') else order.side),
+            'state': state}
+  _orders[oid] = record
+  _by_title.setdefault(record['title'], set()).add(oid)
+  _by_symbol.setdefault(record['symbol'], set()).add(oid)
+  return True
+
+def update(order):
+  '''
+  Record the latest state of an order and wake up any coroutine waiting
+  for it to reach that state. Safe to call from any thread. Returns False
+  if the update was stale.
+  '''
+  oid = str(order.id)
+  with _lock:
+    if not _store(order): return False
+    state = _orders[oid]['state']
+    waiters = _waiters.get(oid, [])
+    ready = [w for w in waiters if state in w[2]]
+    if ready: _waiters[oid] = [w for w in waiters if w not in ready]
+  for loop, future, statuses in ready:
+    loop.call_soon_threadsafe(_resolve, future, order)
+  return True
+
+def _resolve(future, order):
+  if not future.done(): future.set_result(order)
+
+def track(order):
+  '''
+  Register an order returned by a submit or replace. The trading stream
+  may already have reported on it, in which case that state is kept.
+  '''
+  with _lock:
+    if str(order.id) not in _orders.keys(): _store(order)
+  return
+
+def get(oid):
+  record = _orders.get(str(oid))
+  return record['order'] if record is not None else None
+
+def state(oid):
+  record = _orders.get(str(oid))
+  return record['state'] if record is not None else None
+
+def find(title=None, symbol=None, side=None, active=False):
+  '''
+  Orders matching all of the given title, symbol and side. If active,
+  only those that have not reached a terminal state.
+  '''
+  with _lock:
+    if title is not None: oids = set(_by_title.get(title, ()))
+    elif symbol is not None: oids = set(_by_symbol.get(symbol, ()))
+    else: oids = set(_orders.keys())
+    records = [_orders[oid] for oid in oids]
+  return [r['order'] for r in records
+          if (symbol is None or r['symbol'] == symbol)
+          and (side is None or r['side'] == side)
+          and (not active or r['state'] not in TERMINAL)]
+
+async def wait(oid, statuses=TERMINAL, timeout=None):
+  '''
+  Wait until the order reaches one of statuses and return it. On timeout
+  return the latest known state of the order instead.
+  '''
+  oid = str(oid)
+  timeout = g.FILL_TIMEOUT if timeout is None else timeout
+  loop = asyncio.get_running_loop()
+  future = loop.create_future()
+  entry = (loop, future, statuses)
+  with _lock:
+    record = _orders.get(oid)
+    if record is not None and record['state'] in statuses:
+      return record['order']
+    _waiters.setdefault(oid, []).append(entry)
+  start = time.monotonic()
+  outcome = 'settled'
+  try:
+    return await asyncio.wait_for(future, timeout)
+  except asyncio.TimeoutError:
+    outcome = 'timeout'
+    return get(oid)
+  finally:
+    metrics.observe('fill_wait', time.monotonic() - start, outcome=outcome)
+    with _lock:
+      if entry in _waiters.get(oid, []): _waiters[oid].remove(entry)
+      if oid in _waiters.keys() and not _waiters[oid]: del _waiters[oid]
+
+async def cancel(title=None, symbol=None, side=None):
+  '''
+  Cancel the active orders matching title, symbol and side.
+  '''
+  logger = logging.getLogger(__name__)
+  active = find(title=title, symbol=symbol, side=side, active=True)
+  async def _cancel(order):
+    try: await broker.cancel_order(order.id)
+    except APIError as e:
+      logger.error('There was an error when canceling order %s', order.id)
+      logger.error(e)
+  await asyncio.gather(*(_cancel(o) for o in active))
+  if active: logger.info('Canceled %s active orders', len(active))
+  return len(active)
+
+def forget():
+  '''
+  Drop terminal orders nobody is waiting on, to keep the store small.
+  '''
+  with _lock:
+    done = [oid for oid, r in _orders.items()
+            if r['state'] in TERMINAL and oid not in _waiters.keys()]
+    for oid in done:
+      r = _orders.pop(oid)
+      _by_title[r['title']].discard(oid)
+      if not _by_title[r['title']]: del _by_title[r['title']]
+      _by_symbol[r['symbol']].discard(oid)
+      if not _by_symbol[r['symbol']]: del _by_symbol[r['symbol']]
+  return
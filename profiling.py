@@ -0,0 +1,249 @@
+import os
+import sys
+import atexit
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import logging
+import multiprocessing.util
+import pstats
+import resource
+import time
+import tracemalloc
+from datetime import datetime as dt
+
+'''
+Opt-in profiling of the batch pipeline (creek_interpolate, creek_pearson,
+creek_tf). Turned on with CREEK_PROFILE=1 in the environment or --profile
+on the command line, and free otherwise: stage() only times and task()
+returns the function unchanged.
+
+A script calls start(name, directory) once, naming the directory its
+outputs go to, and the run's profile is written to
+directory/profile/name-TIMESTAMP/ when the script exits:
+- each stage (a with block or decorated function) is run under cProfile
+  and tracemalloc, and its wall time, CPU time (its own and that of the
+  workers it reaped), peak traced allocation and peak RSS are recorded,
+- each worker task (a function handed to pandarallel or a Pool, decorated
+  with task()) is profiled in the worker, accumulating one profile per
+  worker process, written every DUMP_INTERVAL seconds and when the worker
+  exits, along with its task counts and times and peak memory,
+- at exit, everything is aggregated into profile.json (stages and
+  workers), profile.txt (a stage table and the top functions over all
+  processes) and combined.prof (for snakeviz or pstats).
+'''
+ENABLED = bool(os.environ.get('CREEK_PROFILE')) or '--profile' in sys.argv
+TOP = 40 # functions listed in profile.txt
+DUMP_INTERVAL = 5 # seconds between a worker's profile dumps
+_directory = os.environ.get('CREEK_PROFILE_DIR') # set by start, inherited
+_main = None # pid of the process that called start
+_stages = []
+_profile = None # the running stage's profile, which forked workers inherit
+_running = [] # names of the stages running, outermost first
+_worker = None # this worker's {'profile', 'tasks', ...}
+
+def reset_peak_rss():
+  '''
+  Reset this process's peak RSS (Linux only), so that the next reading is
+  the peak of what ran since.
+  '''
+  try:
+    with open('/proc/self/clear_refs', 'w') as f: f.write('5')
+    return True
+  except OSError: return False
+
+def peak_rss_mb():
+  try:
+    with open('/proc/self/status', 'r') as f:
+      for line in f:
+        if line.startswith('VmHWM:'): return int(line.split()[1]) / 2**10
+  except OSError: pass
+  # ru_maxrss is in kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+def start(name, directory):
+  '''
+  Begin a profiled run of script name, writing next to directory.
+  '''
+  global _directory, _main
+  if not ENABLED: return
+  logger = logging.getLogger(__name__)
+  _directory = os.path.join(directory, 'profile', '%s-%s' %
+                            (name, dt.now().strftime('%Y%m%d-%H%M%S')))
+  os.makedirs(os.path.join(_directory, 'workers'), exist_ok=True)
+  os.environ['CREEK_PROFILE_DIR'] = _directory
+  _main = os.getpid()
+  atexit.register(finish)
+  logger.info('Profiling to %s' % _directory)
+  return
+
+@contextlib.contextmanager
+def stage(name):
+  '''
+  with profiling.stage('load'): ..., or @profiling.stage('load').
+
+  A stage run within another is timed, but stays in the outer stage's
+  profile (only one profiler can be active), and its peaks are those
+  since the outer stage began.
+  '''
+  global _profile
+  if not ENABLED or _directory is None or os.getpid() != _main:
+    yield
+    return
+  logger = logging.getLogger(__name__)
+  nested = len(_running) > 0
+  parent = _running[-1] if nested else None
+  exact = not nested and reset_peak_rss()
+  tracing = tracemalloc.is_tracing()
+  if not tracing: tracemalloc.start()
+  elif not nested: tracemalloc.reset_peak()
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  wall, cpu = time.perf_counter(), time.process_time()
+  profile = None
+  if _profile is None:
+    profile = _profile = cProfile.Profile()
+    profile.enable()
+  _running.append(name)
+  try: yield
+  finally:
+    _running.pop()
+    if profile is not None:
+      profile.disable()
+      _profile = None
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak = tracemalloc.get_traced_memory()[1]
+    if not tracing: tracemalloc.stop()
+    n = len(_stages)
+    if profile is not None:
+      profile.dump_stats(os.path.join(_directory, '%02d-%s.prof' % (n, name)))
+    s = {'stage': name, 'parent': parent, 'wall': wall, 'cpu': cpu,
+         'workers_cpu': (after.ru_utime + after.ru_stime) -
+                        (children.ru_utime + children.ru_stime),
+         'peak_traced_mb': peak / 2**20,
+         # Without a reset this is the peak of the whole run so far
+         'peak_rss_mb': peak_rss_mb(), 'peak_rss_exact': exact,
+         'workers_peak_rss_mb': after.ru_maxrss / 2**10}
+    _stages.append(s)
+    logger.info('Stage %s: %.2fs wall, %.2fs CPU (+%.2fs in workers), peak RSS %.0f MB' %
+                (name, wall, cpu, s['workers_cpu'], s['peak_rss_mb']))
+
+def dump_worker():
+  if _worker is None: return
+  _worker['profile'].disable()
+  _worker['dumped'] = time.monotonic()
+  path = os.path.join(_directory, 'workers', str(os.getpid()))
+  _worker['profile'].dump_stats(path + '.prof')
+  with open(path + '.json', 'w') as f:
+    json.dump({'pid': os.getpid(), 'tasks': _worker['tasks'],
+               'peak_traced_mb': tracemalloc.get_traced_memory()[1] / 2**20,
+               'peak_rss_mb': peak_rss_mb()}, f)
+  return
+
+def task(fn):
+  '''
+  Decorate a function run by worker processes to profile it there. The
+  function keeps its name, so that it still pickles for a Pool.
+  '''
+  if not ENABLED: return fn
+  @functools.wraps(fn)
+  def wrapper(*args, **kwargs):
+    global _worker
+    # In the main process the enclosing stage is already profiling
+    if _directory is None or os.getpid() == _main: return fn(*args, **kwargs)
+    if _worker is None:
+      if _profile is not None: _profile.disable()
+      tracemalloc.start()
+      _worker = {'profile': cProfile.Profile(), 'tasks': {},
+                 'dumped': time.monotonic()}
+      # Run when a Pool worker exits normally. Workers that are
+      # terminated instead lose at most DUMP_INTERVAL seconds of tasks.
+      multiprocessing.util.Finalize(None, dump_worker, exitpriority=100)
+    t = _worker['tasks'].setdefault(fn.__name__, {'calls': 0, 'wall': 0.0,
+                                                  'cpu': 0.0, 'max': 0.0})
+    wall, cpu = time.perf_counter(), time.process_time()
+    _worker['profile'].enable()
+    try: return fn(*args, **kwargs)
+    finally:
+      _worker['profile'].disable()
+      wall = time.perf_counter() - wall
+      t['calls'] += 1
+      t['wall'] += wall
+      t['cpu'] += time.process_time() - cpu
+      t['max'] = max(t['max'], wall)
+      if time.monotonic() - _worker['dumped'] > DUMP_INTERVAL: dump_worker()
+  return wrapper
+
+def workers():
+  '''
+  Per-task totals over every worker, and the workers' profile files.
+  '''
+  d = os.path.join(_directory, 'workers')
+  tasks = {}
+  peaks = []
+  profiles = []
+  for f in sorted(os.listdir(d)):
+    path = os.path.join(d, f)
+    if f.endswith('.prof'): profiles.append(path)
+    if not f.endswith('.json'): continue
+    with open(path, 'r') as fd: w = json.load(fd)
+    peaks.append(w['peak_rss_mb'])
+    for name, t in w['tasks'].items():
+      s = tasks.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                  'max': 0.0})
+      s['calls'] += t['calls']
+      s['wall'] += t['wall']
+      s['cpu'] += t['cpu']
+      s['max'] = max(s['max'], t['max'])
+  return {'count': len(peaks), 'tasks': tasks,
+          'max_peak_rss_mb': max(peaks) if peaks else 0.0}, profiles
+
+def report(summary, stats):
+  lines = ['%-24s %10s %10s %12s %12s %10s' % ('stage', 'wall (s)', 'cpu (s)',
+                                              'workers cpu', 'traced MB',
+                                              'RSS MB')]
+  for s in summary['stages']:
+    # Stages run within another are listed indented, before it
+    lines.append('%-24s %10.2f %10.2f %12.2f %12.1f %10.0f' %
+                 (('  ' if s.get('parent') else '') + s['stage'], s['wall'], s['cpu'], s['workers_cpu'],
+                  s['peak_traced_mb'], s['peak_rss_mb']))
+  w = summary['workers']
+  if w['count']:
+    lines.append('')
+    lines.append('%s workers, peak RSS %.0f MB' % (w['count'],
+                                                   w['max_peak_rss_mb']))
+    for name, t in w['tasks'].items():
+      lines.append('%-24s %s calls, %.2fs wall, %.2fs CPU, mean %.4fs, max %.4fs' %
+                   (name, t['calls'], t['wall'], t['cpu'],
+                    t['wall'] / max(t['calls'], 1), t['max']))
+  if stats is not None:
+    lines.append('')
+    out = io.StringIO()
+    stats.stream = out
+    stats.sort_stats('cumulative').print_stats(TOP)
+    lines.append(out.getvalue())
+  return '\n'.join(lines)
+
+def finish():
+  '''
+  Aggregate the run: called at exit of the process that called start.
+  '''
+  if _directory is None or os.getpid() != _main: return
+  logger = logging.getLogger(__name__)
+  w, profiles = workers()
+  summary = {'script': ' '.join(sys.argv), 'stages': _stages, 'workers': w}
+  with open(os.path.join(_directory, 'profile.json'), 'w') as f:
+    json.dump(summary, f, indent=2)
+  profiles = profiles + sorted(os.path.join(_directory, f)
+                               for f in os.listdir(_directory)
+                               if f.endswith('.prof'))
+  stats = None
+  if profiles:
+    stats = pstats.Stats(*profiles)
+    stats.dump_stats(os.path.join(_directory, 'combined.prof'))
+  with open(os.path.join(_directory, 'profile.txt'), 'w') as f:
+    f.write(report(summary, stats))
+  logger.info('Profile written to %s' % _directory)
+  return
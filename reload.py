@@ -0,0 +1,125 @@
+import logging
+import os
+import time
+from . import config as g
+from . import trade
+from . import models
+from . import market_data
+from . import tiers
+from . import warmup
+from . import io
+
+'''
+Hot reload of the pair universe and model parameters. creek_tf writes a
+version marker (root/model_version) once a retrain has finished, and
+pearson.csv is replaced whenever the universe is recomputed. At the
+end of each cycle, before it sleeps to the next minute, signal.main
+calls check(), which compares both against what the
+engine loaded and, if either moved, swaps the new universe in without a
+restart:
+- pairs new to pearson.csv are built and warmed up from stored bars once
+  they have a model; creek_pearson and the pipeline replace pearson.csv
+  before creek_tf has trained its new pairs, so those wait for the
+  model_version that follows,
+- pairs disabled for lack of a model are built again once they have one,
+- pairs whose checkpoint changed pick up their new parameters (closed
+  ones are warmed up again under the new model),
+- pairs that left pearson.csv are dropped, unless a trade is open on
+  them, in which case they stay until a later reload finds them closed,
+- bar subscriptions are extended or trimmed to the new set of symbols.
+Every other trade, including its sigma history, is left as it is.
+'''
+_version = None
+
+def version():
+  try:
+    with open(os.path.join(g.root, 'model_version'), 'r') as f:
+      marker = f.read().strip()
+  except FileNotFoundError: marker = None
+  try: mtime = os.path.getmtime(os.path.join(g.root, 'pearson.csv'))
+  except FileNotFoundError: mtime = None
+  return (marker, mtime)
+
+def mark():
+  '''
+  Record the version of whatever io.load_trades has just loaded.
+  '''
+  global _version
+  _version = version()
+  return
+
+def check():
+  v = version()
+  if _version is None or v == _version: return False
+  logger = logging.getLogger(__name__)
+  logger.info('Model set changed from %s to %s, reloading', _version, v)
+  apply()
+  return True
+
+def apply():
+  global _version
+  logger = logging.getLogger(__name__)
+  start = time.monotonic()
+  v = version()
+  pearson = io.read_pearson()
+  universe = dict(zip(pearson['title'], zip(pearson['symbol1'],
+                  pearson['symbol2'], pearson['pearson'],
+                  pearson['pearson_historical'])))
+  changed = set(models.load(list(set(universe.keys()) | g.open_trades)))
+  assets = io.get_assets()
+  added = []
+  retrained = []
+  removed = []
+  waiting = []
+  for title in list(g.trades.keys()):
+    if title in universe.keys() or title in g.open_trades: continue
+    del g.trades[title]
+    removed.append(title)
+  for title, (symbol1, symbol2, p, ph) in universe.items():
+    t = g.trades.get(title)
+    if t is None or (t.status() == 'disabled' and not t._has_model):
+      # New, or built before its checkpoint existed: (re)build it once
+      # the checkpoint is there
+      if title not in models.params.keys():
+        if t is None: waiting.append(title)
+        continue
+      g.trades.pop(title, None)
+    else:
+      t._pearson = float(p)
+      t._pearson_historical = float(ph)
+      if title in changed:
+        t.reload_params()
+        retrained.append(title)
+      continue
+    if symbol1 not in assets.keys() or symbol2 not in assets.keys():
+      logger.warning('%s: symbol not found among assets', title)
+      continue
+    g.trades[title] = trade.Trade([assets[symbol1], assets[symbol2]],
+                                  float(p), float(ph))
+    added.append(title)
+  if waiting:
+    logger.info('%s new pairs have no model yet; adding them once creek_tf has trained them',
+                len(waiting))
+  symbols = set(g.HEDGE_SYMBOL_LIST)
+  for title in g.trades.keys(): symbols.update(title.split('-'))
+  subscribe = sorted(symbols - set(g.active_symbols.keys()))
+  unsubscribe = sorted(set(g.active_symbols.keys()) - symbols)
+  for s in subscribe:
+    g.active_symbols[s] = assets[s]
+    g.bars[s] = []
+  io.index_trades()
+  tiers.forget(removed + retrained)
+  warmup.warm_up(titles=[k for k in added + retrained
+                         if g.trades[k].status() == 'closed'])
+  stream = market_data.stream
+  if stream is not None:
+    if subscribe: stream.subscribe_bars(io.bar_data_handler, *subscribe)
+    if unsubscribe: stream.unsubscribe_bars(*unsubscribe)
+  for s in unsubscribe:
+    del g.active_symbols[s]
+    g.bars.pop(s, None)
+  _version = v
+  logger.info('Reloaded in %.2f seconds: %s pairs added, %s retrained, %s removed; %s symbols subscribed, %s unsubscribed',
+              time.monotonic() - start, len(added), len(retrained),
+              len(removed), len(subscribe), len(unsubscribe))
+  return
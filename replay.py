@@ -0,0 +1,226 @@
+import os
+import sys
+import logging
+import logging.handlers
+import argparse
+import asyncio
+import collections
+import json
+import threading
+import time
+from datetime import timedelta as td
+import numpy as np
+import pandas as pd
+import pytz as tz
+from . import config as g
+from . import trade
+from . import market_data
+from . import tiers
+from . import warmup
+from . import io
+from . import sim_broker
+from . import logs
+from . import creek_signal as signal
+
+'''
+Offline replay of the live loop. Recorded minute bars, read from the bar
+store (the tail of minute_bar_dir/SYMBOL.csv) or from a websocket capture
+written with BAR_CAPTURE, are played back one minute at a time through
+io.bar_data_handler, exactly as the stock stream would deliver them, and
+each minute is followed by one cycle under a VirtualClock that jumps
+straight to the next minute instead of sleeping.
+
+With --sim, orders go to an in-process simulated broker (see
+sim_broker.py) and every cycle is a full signal.main. Without it, only
+the signal side of main runs (signal.evaluate and select_trades) and
+nothing is submitted. Latest trades and quotes are
+served from the replayed bars, so no market data is requested either.
+
+Reports per-cycle latency percentiles and, scaling the number of enabled
+pairs by the slowest cycles, the largest pair book that would still fit
+inside a 60-second cycle.
+'''
+Bar = collections.namedtuple('Bar', warmup.COLUMNS)
+Quote = collections.namedtuple('Quote', ['symbol', 'bid_price', 'ask_price'])
+Print = collections.namedtuple('Print', ['symbol', 'price'])
+SPREAD = 0.01 # Synthetic bid-ask spread around each bar's vwap
+
+class VirtualClock():
+  '''
+  Same interface as signal.Clock, over replayed time: now() is whatever
+  the harness last set, and sleep() advances it without waiting.
+  '''
+  def __init__(self, start, close):
+    self._now = start
+    self.skew = 0.0
+    self.rtt = 0.0
+    self.is_open = True
+    self.next_open = start
+    self.next_close = close
+
+  def set(self, now): self._now = now
+  def now(self): return self._now
+  def sleep(self, seconds): self._now = self._now + td(seconds=seconds)
+  def refresh(self): return
+  def rest(self): return
+  def resync_due(self): return False
+  async def resync(self): return
+
+def read_store(symbols, start, end):
+  logger = logging.getLogger(__name__)
+  frames = []
+  for symbol in symbols:
+    path = os.path.join(g.minute_bar_dir, symbol + '.csv')
+    try: frame = warmup.tail_frame(path, start)
+    except FileNotFoundError:
+      logger.warning('%s not in the bar store' % symbol)
+      continue
+    frame['symbol'] = symbol
+    frames.append(frame[frame['timestamp'] < end])
+  if not frames: return pd.DataFrame(columns=warmup.COLUMNS)
+  return pd.concat(frames)
+
+def read_capture(path, symbols, start, end):
+  with open(path, 'r') as f:
+    frame = pd.DataFrame([json.loads(line) for line in f if line.strip()],
+                         columns=warmup.COLUMNS)
+  frame['timestamp'] = pd.to_datetime(frame['timestamp'], utc=True)
+  frame = frame[frame['symbol'].isin(symbols)]
+  return frame[(frame['timestamp'] >= start) & (frame['timestamp'] < end)]
+
+def minutes(frame):
+  '''
+  Yield (minute, [Bar]) in time order.
+  '''
+  frame = frame.sort_values('timestamp', kind='stable')
+  for ts, group in frame.groupby('timestamp', sort=True):
+    yield ts, [Bar(*row) for row in
+               group[warmup.COLUMNS].itertuples(index=False, name=None)]
+
+async def feed(bars):
+  now = time.monotonic()
+  for bar in bars:
+    market_data.trades[bar.symbol] = (Print(bar.symbol, bar.vwap), now)
+    market_data.quotes[bar.symbol] = (Quote(bar.symbol,
+                                            bar.vwap - SPREAD / 2,
+                                            bar.vwap + SPREAD / 2), now)
+    await io.bar_data_handler(bar)
+  market_data.last_message = now
+  return
+
+async def signals(clock):
+  '''
+  The evaluation half of signal.main, without any order flow.
+  '''
+  evaluated, to_bail_out, to_close, to_open = signal.evaluate(clock)
+  signal.select_trades(to_open, signal.available_trades())
+  return len(evaluated)
+
+def percentiles(latency):
+  a = np.array(latency)
+  return {'p50': float(np.percentile(a, 50)),
+          'p90': float(np.percentile(a, 90)),
+          'p99': float(np.percentile(a, 99)),
+          'max': float(a.max())}
+
+async def replay(frame, clock, full, speed=0):
+  latency = []
+  evaluated = []
+  for ts, bars in minutes(frame):
+    # A minute's bar is published as the minute ends
+    clock.set(ts.tz_convert(tz.timezone('US/Eastern')).to_pydatetime()
+              + td(minutes=1))
+    await feed(bars)
+    start = time.perf_counter()
+    if full:
+      before = tiers.evaluated
+      await signal.main(clock)
+      evaluated.append(tiers.evaluated - before)
+    else: evaluated.append(await signals(clock))
+    latency.append(time.perf_counter() - start)
+    if speed > 0: await asyncio.sleep(max(0, 60 / speed - latency[-1]))
+  return latency, evaluated
+
+def report(latency, evaluated):
+  book = len([t for t in g.trades.values() if t.status() != 'disabled'])
+  r = {'cycles': len(latency), 'pairs': book,
+       'mean_evaluated': float(np.mean(evaluated)) if evaluated else 0.0}
+  if latency:
+    r['latency'] = percentiles(latency)
+    r['max_pairs'] = int(book * 60 / max(r['latency']['p99'], 1e-9))
+  return r
+
+def setup(client=None, equity=1e6):
+  io.load_config()
+  g.ASSET_CACHE_TTL = float('inf') # Never refetch assets while replaying
+  if client is not None:
+    g.tclient = client
+    g.hclient = client
+  g.active_symbols = io.load_trades()
+  for symbol in g.active_symbols.keys(): g.bars[symbol] = []
+  if client is not None:
+    if not asyncio.run(trade.account_ok()): sys.exit(1)
+  else:
+    g.equity = equity
+    g.cash = equity
+  trade.set_trade_size()
+  return
+
+def simulate(**kwargs):
+  '''
+  Start a simulated broker whose trade updates feed the engine.
+  '''
+  client = sim_broker.SimBroker(**kwargs)
+  stream = client.stream()
+  stream.subscribe_trade_updates(io.trading_stream_handler)
+  threading.Thread(target=stream.run, daemon=True).start()
+  return client
+
+def run(start, end, capture=None, client=None, speed=0):
+  logger = logging.getLogger(__name__)
+  start = pd.Timestamp(start, tz='UTC')
+  end = pd.Timestamp(end, tz='UTC')
+  setup(client)
+  symbols = sorted(g.active_symbols.keys())
+  if capture: frame = read_capture(capture, symbols, start, end)
+  else: frame = read_store(symbols, start, end)
+  logger.info('Replaying %s bars for %s symbols' %
+              (len(frame), frame['symbol'].nunique()))
+  clock = VirtualClock(start.tz_convert(tz.timezone('US/Eastern')),
+                       end.tz_convert(tz.timezone('US/Eastern')))
+  if client is not None and hasattr(client, 'now'): client.now = clock.now
+  latency, evaluated = asyncio.run(replay(frame, clock, client is not None,
+                                          speed))
+  return report(latency, evaluated)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Replay recorded bars '
+                                   'through the live loop')
+  parser.add_argument('start', help='first timestamp to replay (UTC)')
+  parser.add_argument('end', help='timestamp to stop at (UTC)')
+  parser.add_argument('--capture', help='websocket capture (BAR_CAPTURE) '
+                      'to replay instead of the bar store')
+  parser.add_argument('--speed', type=float, default=0,
+                      help='pace replay at this multiple of real time '
+                      '(default: as fast as possible)')
+  parser.add_argument('--sim', action='store_true',
+                      help='run full cycles against a simulated broker')
+  parser.add_argument('--ack-latency', type=float, default=0.0)
+  parser.add_argument('--fill-latency', type=float, default=0.0)
+  parser.add_argument('--partial-fill', type=float, default=0.0,
+                      help='probability that a fill is partial')
+  args = parser.parse_args(argv)
+  logs.setup(os.environ.get("LOGFILE", "creek-replay.log"))
+  client = None
+  if args.sim:
+    client = simulate(ack_latency=args.ack_latency,
+                      fill_latency=args.fill_latency,
+                      partial_fill=args.partial_fill)
+  r = run(args.start, args.end, capture=args.capture, client=client,
+          speed=args.speed)
+  if client is not None: client.log_stats()
+  print(json.dumps(r, indent=2))
+  return
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,355 @@
+import logging
+import asyncio
+import collections
+import copy
+import json
+import math
+import queue
+import random
+import threading
+import time
+import uuid
+from datetime import datetime as dt
+from datetime import timedelta as td
+from types import SimpleNamespace
+import pytz as tz
+from alpaca.common.exceptions import APIError
+from . import market_data
+
+'''
+In-process simulated broker. SimBroker implements the parts of alpaca's
+TradingClient that the engine calls (submit_order, replace_order_by_id,
+cancel_order_by_id, cancel_orders, get_order_by_id, get_all_positions,
+get_account, get_clock) and the latest trade/quote calls of the
+StockHistoricalDataClient, so it can be put in place of g.tclient and
+g.hclient. SimTradingStream stands in for TradingStream: it delivers the
+same new/fill/partial_fill/canceled/replaced trade updates to whatever
+handler is subscribed (normally io.trading_stream_handler).
+
+Orders are matched on a background thread against a price source, by
+default the latest trade in market_data (which replay.py feeds from the
+replayed bars). It can be configured with:
+- ack_latency: seconds each REST call takes,
+- fill_latency: seconds before an accepted order can first fill,
+- partial_fill: probability that a fill only covers half the remainder,
+- shortable: {'SYMBOL': shares} available to short, beyond which orders
+  are rejected with alpaca's 403 "insufficient qty available" error,
+- rate_limit: REST calls per minute, beyond which calls fail with 429.
+Everything random is drawn from a seeded generator, so runs repeat.
+'''
+TERMINAL = ('filled', 'canceled', 'replaced', 'rejected', 'expired')
+
+def value(x):
+  return str(x.value) if hasattr(x, 'value') else (None if x is None
+                                                   else str(x))
+
+def shares(q):
+  # alpaca reports quantities as strings, integral ones without a decimal
+  return str(int(q)) if float(q).is_integer() else str(q)
+
+def api_error(status_code, body):
+  http_error = SimpleNamespace(response=SimpleNamespace(
+                                 status_code=status_code), request=None)
+  return APIError(json.dumps(body), http_error)
+
+def latest_price(symbol):
+  if symbol not in market_data.trades.keys(): return None
+  return float(market_data.trades[symbol][0].price)
+
+class SimTradingStream():
+  def __init__(self, broker):
+    self._broker = broker
+    self._handler = None
+    self._queue = queue.Queue()
+    self._running = False
+    broker._streams.append(self)
+
+  def subscribe_trade_updates(self, handler): self._handler = handler
+
+  def publish(self, update): self._queue.put(update)
+
+  def run(self):
+    loop = asyncio.new_event_loop()
+    self._running = True
+    while self._running:
+      update = self._queue.get()
+      if update is None: break
+      if self._handler is not None:
+        loop.run_until_complete(self._handler(update))
+    loop.close()
+
+  def stop(self):
+    self._running = False
+    self._queue.put(None)
+
+class SimBroker():
+  def __init__(self, equity=1e6, price=latest_price, ack_latency=0.0,
+               fill_latency=0.0, partial_fill=0.0, shortable=None,
+               rate_limit=200, now=None, tick=0.01, seed=0):
+    self.price = price
+    self.ack_latency = ack_latency
+    self.fill_latency = fill_latency
+    self.partial_fill = partial_fill
+    self.shortable = shortable if shortable is not None else {}
+    self.rate_limit = rate_limit
+    self.now = now if now is not None else (
+                 lambda: dt.now(tz=tz.timezone('US/Eastern')))
+    self.tick = tick
+    self.cash = float(equity)
+    self.positions = {} # 'SYMBOL': [signed qty, signed cost basis]
+    self.orders = {} # 'order_id': <Order>
+    self._open = {} # 'order_id': monotonic time it may first fill
+    self._calls = collections.deque()
+    self._streams = []
+    self._random = random.Random(seed)
+    self._lock = threading.RLock()
+    self._matcher = None
+    # Metrics
+    self.requests = 0
+    self.rejected = 0
+    self.throttled = 0
+    self.fills = 0
+
+  def stream(self): return SimTradingStream(self)
+
+  def _request(self):
+    now = time.monotonic()
+    with self._lock:
+      while self._calls and now - self._calls[0] > 60:
+        self._calls.popleft()
+      if len(self._calls) >= self.rate_limit:
+        self.throttled = self.throttled + 1
+        raise api_error(429, {'code': 42910000,
+                              'message': 'rate limit exceeded'})
+      self._calls.append(now)
+      self.requests = self.requests + 1
+    if self.ack_latency > 0: time.sleep(self.ack_latency)
+    return
+
+  def _publish(self, event, order, qty=None, price=None):
+    update = SimpleNamespace(event=event, order=copy.copy(order),
+                             qty=qty, price=price,
+                             position_qty=self.positions.get(
+                               order.symbol, [0, 0.0])[0],
+                             timestamp=self.now())
+    for s in self._streams: s.publish(update)
+    return
+
+  def _start(self):
+    if self._matcher is None:
+      self._matcher = threading.Thread(target=self._match_loop,
+                                       daemon=True, name='sim-broker')
+      self._matcher.start()
+    return
+
+  # Orders
+  def _available(self, symbol, side):
+    '''
+    Shares that can still be sold (side 'sell') or bought to cover (side
+    'buy') without flipping the position in one order, net of open orders.
+    '''
+    q = self.positions.get(symbol, [0, 0.0])[0]
+    held = sum(float(o.qty or 0) - float(o.filled_qty)
+               for o in self.orders.values()
+               if o.symbol == symbol and o.side == side and
+               o.status not in TERMINAL)
+    if side == 'sell' and q > 0: return q - held
+    if side == 'buy' and q < 0: return -q - held
+    return None
+
+  def submit_order(self, order_data):
+    self._request()
+    symbol = order_data.symbol
+    side = value(order_data.side)
+    qty = order_data.qty
+    with self._lock:
+      available = self._available(symbol, side)
+      if side == 'sell' and available is None and symbol in self.shortable:
+        available = self.shortable[symbol]
+      if qty is not None and available is not None and qty > available:
+        self.rejected = self.rejected + 1
+        raise api_error(403, {
+          'code': 40310000,
+          'message': 'insufficient qty available for order (requested: %s, available: %s)' % (qty, math.floor(max(available, 0))),
+          'available': str(math.floor(max(available, 0))),
+          'symbol': symbol})
+      order = SimpleNamespace(
+        id=uuid.uuid4(), client_order_id=order_data.client_order_id,
+        symbol=symbol, side=side, qty=qty,
+        notional=getattr(order_data, 'notional', None),
+        type=value(order_data.type),
+        limit_price=getattr(order_data, 'limit_price', None),
+        time_in_force=value(order_data.time_in_force),
+        status='new', filled_qty='0', filled_avg_price=None,
+        created_at=self.now(), replaced_by=None)
+      self.orders[str(order.id)] = order
+      self._open[str(order.id)] = time.monotonic() + self.fill_latency
+      self._publish('new', order)
+    self._start()
+    return copy.copy(order)
+
+  def get_order_by_id(self, order_id):
+    self._request()
+    with self._lock: return copy.copy(self.orders[str(order_id)])
+
+  def replace_order_by_id(self, order_id, order_data=None):
+    self._request()
+    with self._lock:
+      old = self.orders.get(str(order_id))
+      if old is None or old.status in TERMINAL:
+        raise api_error(422, {'code': 42210000,
+                              'message': 'order is not open'})
+      old.status = 'replaced'
+      self._open.pop(str(order_id), None)
+      order = copy.copy(old)
+      order.id = uuid.uuid4()
+      order.status = 'new'
+      order.qty = (order_data.qty if order_data.qty is not None
+                   else float(old.qty) - float(old.filled_qty))
+      order.filled_qty = '0'
+      order.filled_avg_price = None
+      if order_data.limit_price is not None:
+        order.limit_price = order_data.limit_price
+      if order_data.client_order_id is not None:
+        order.client_order_id = order_data.client_order_id
+      old.replaced_by = order.id
+      self.orders[str(order.id)] = order
+      self._open[str(order.id)] = time.monotonic() + self.fill_latency
+      self._publish('replaced', old)
+      self._publish('new', order)
+    return copy.copy(order)
+
+  def _cancel(self, order_id):
+    order = self.orders.get(str(order_id))
+    if order is None or order.status in TERMINAL: return None
+    order.status = 'canceled'
+    self._open.pop(str(order_id), None)
+    self._publish('canceled', order)
+    return SimpleNamespace(id=order.id, status=200, body=None)
+
+  def cancel_order_by_id(self, order_id):
+    self._request()
+    with self._lock:
+      if self._cancel(order_id) is None:
+        raise api_error(422, {'code': 42210000,
+                              'message': 'order is not cancelable'})
+    return
+
+  def cancel_orders(self):
+    self._request()
+    with self._lock:
+      responses = [self._cancel(oid) for oid in list(self._open.keys())]
+    return [r for r in responses if r is not None]
+
+  # Matching
+  def _match_loop(self):
+    while True:
+      time.sleep(self.tick)
+      self.match()
+
+  def match(self):
+    '''
+    Fill whatever open orders are marketable at the current price.
+    '''
+    now = time.monotonic()
+    with self._lock:
+      for oid, due in list(self._open.items()):
+        if due > now: continue
+        order = self.orders[oid]
+        price = self.price(order.symbol)
+        if price is None: continue
+        if order.limit_price is not None and (
+           (order.side == 'buy' and price > float(order.limit_price)) or
+           (order.side == 'sell' and price < float(order.limit_price))):
+          continue
+        if order.qty is None: remaining = float(order.notional) / price
+        else: remaining = float(order.qty) - float(order.filled_qty)
+        qty = remaining
+        if remaining > 1 and self._random.random() < self.partial_fill:
+          qty = math.floor(remaining / 2)
+        self._fill(order, qty, price)
+        if order.qty is None: order.qty = qty
+    return
+
+  def _fill(self, order, qty, price):
+    filled = float(order.filled_qty)
+    avg = float(order.filled_avg_price or 0.0)
+    order.filled_avg_price = str((avg * filled + price * qty) /
+                                 (filled + qty))
+    order.filled_qty = shares(filled + qty)
+    delta = qty if order.side == 'buy' else -qty
+    q, c = self.positions.get(order.symbol, [0, 0.0])
+    new = q + delta
+    if q == 0 or new == 0 or (new > 0) != (q > 0): c = new * price
+    elif (q > 0) == (delta > 0): c = c + delta * price
+    else: c = c * new / q
+    if abs(new) < 1e-9: self.positions.pop(order.symbol, None)
+    else: self.positions[order.symbol] = [new, c]
+    self.cash = self.cash - delta * price
+    self.fills = self.fills + 1
+    if order.qty is None or float(order.filled_qty) >= float(order.qty) - 1e-9:
+      order.status = 'filled'
+      self._open.pop(str(order.id), None)
+      self._publish('fill', order, qty, price)
+    else:
+      order.status = 'partially_filled'
+      self._publish('partial_fill', order, qty, price)
+    return
+
+  # Account
+  def _market_value(self, symbol, q, c):
+    price = self.price(symbol)
+    return q * price if price is not None else c
+
+  def get_all_positions(self):
+    self._request()
+    positions = []
+    with self._lock:
+      for symbol, (q, c) in self.positions.items():
+        positions.append(SimpleNamespace(
+          symbol=symbol, qty=shares(q), side='long' if q > 0 else 'short',
+          cost_basis=str(abs(c)), avg_entry_price=str(abs(c / q)),
+          market_value=str(self._market_value(symbol, q, c))))
+    return positions
+
+  def get_account(self):
+    self._request()
+    with self._lock:
+      equity = self.cash + sum(self._market_value(s, q, c)
+                               for s, (q, c) in self.positions.items())
+    return SimpleNamespace(equity=str(equity), cash=str(self.cash),
+                           trading_blocked=False, account_blocked=False,
+                           trade_suspended_by_user=False,
+                           shorting_enabled=True)
+
+  def get_clock(self):
+    self._request()
+    now = self.now()
+    return SimpleNamespace(timestamp=now, is_open=True,
+                           next_open=now + td(days=1),
+                           next_close=now + td(hours=6))
+
+  # Market data
+  def _latest(self, request, make):
+    symbols = request.symbol_or_symbols
+    if type(symbols) is str: symbols = [symbols]
+    d = {}
+    for s in symbols:
+      price = self.price(s)
+      if price is not None: d[s] = make(s, price)
+    return d
+
+  def get_stock_latest_trade(self, request):
+    return self._latest(request, lambda s, p:
+                        SimpleNamespace(symbol=s, price=p))
+
+  def get_stock_latest_quote(self, request):
+    return self._latest(request, lambda s, p:
+                        SimpleNamespace(symbol=s, bid_price=p - 0.005,
+                                        ask_price=p + 0.005))
+
+  def log_stats(self):
+    logger = logging.getLogger(__name__)
+    logger.info('Sim broker: %s requests, %s fills, %s rejected (403), %s throttled (429)' %
+                (self.requests, self.fills, self.rejected, self.throttled))
+    return
@@ -0,0 +1,433 @@
+import os
+import logging
+import logging.handlers
+import argparse
+import itertools
+import json
+import math
+import time
+import uuid
+import multiprocessing as mp
+from datetime import datetime as dt
+import numpy as np
+import pandas as pd
+from . import config as g
+from . import warmup
+
+'''
+Synthetic market data, so that the pipeline and the live loop can be run
+and benchmarked without the bar store on /mnt/disks/creek-1. generate()
+writes, under one output directory, the same layout config.py points at:
+- us_equities/SYMBOL.csv and us_equities_hourly/SYMBOL.csv: minute and
+  hour bars in the bar store's schema (warmup.COLUMNS), one row per bar
+  and only for minutes in which the symbol traded,
+- pearson/pearson.csv (what pearson.cpp writes) and
+  pearson/pearson_historical.csv, and creek/pearson.csv for the engine,
+- creek/model_params.csv, with an empty checkpoints/TITLE.index marker
+  per pair so that models.load takes the cached parameters as current,
+- creek/assets.json, the asset cache io.get_assets reads, and
+  creek/config.json (io.load_config),
+- empty creek/open_trades, us_equities_interpolated and tf directories.
+use(out) points config at such a directory.
+
+Prices are log random walks over regular sessions (9:30-16:00 US/Eastern
+on weekdays) with an overnight gap, driven by a market factor. Planted
+clusters of symbols also share a cluster factor and only differ by a
+mean-reverting idiosyncratic term, so their pairs correlate strongly and
+their spreads revert, as the pairs the pipeline selects do; every other
+symbol only shares the market factor. The knobs that upset the pipeline
+in practice are all there:
+- price scales are log-uniform from PRICE_RANGE, and a fraction of
+  symbols (heavy) trade at NVR-like prices of thousands of dollars, put in
+  clusters first so that they end up in pairs,
+- each symbol trades in a given minute with a probability drawn per
+  symbol, so some are liquid and others sparse (thin),
+- symbols can be halted for several days (halts per year) or list part of
+  the way through the history (late).
+Pairs are every combination within a cluster, ordered so that the symbol
+with the larger mean price is symbol2 (as creek_pearson.sparse_truncate
+does), with their minute and hour bar correlations. Their model
+parameters are the least squares fit of symbol2 on symbol1 with a
+constant standard deviation equal to the residuals'. Everything is drawn
+from generators seeded per cluster, so a seed always gives the same data
+whatever the number of workers.
+'''
+PRICE_RANGE = (2.0, 500.0)
+HEAVY_RANGE = (2000.0, 8000.0)
+SESSION = 390 # Minutes per regular session
+OPEN = 570 # Minutes from midnight to the open, US/Eastern
+DAILY_VOL = 0.02 # Daily volatility of the market and cluster factors
+FLOAT_FORMAT = '%.4f'
+STAMP = '%Y-%m-%d %H:%M:%S+00:00'
+_calendars = {} # (start, days): session timestamps, see calendar
+
+def symbol_name(i):
+  '''
+  AAA, AAB, ... skipping the hedge ETFs, which are generated separately.
+  '''
+  letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+  name = ''
+  i = i + 26 + 26 * 26 # Start at three letters
+  while True:
+    name = letters[i % 26] + name
+    i = i // 26 - 1
+    if i < 0: return name
+
+def symbols(n):
+  names = []
+  i = 0
+  while len(names) < n:
+    s = symbol_name(i)
+    if s not in g.HEDGE_SYMBOL_LIST: names.append(s)
+    i = i + 1
+  return names
+
+def sessions(start, days):
+  '''
+  UTC timestamps of every regular-session minute of the first days
+  weekdays from start.
+  '''
+  dates = pd.bdate_range(start, periods=days)
+  opens = dates.tz_localize('US/Eastern') + pd.Timedelta(minutes=OPEN)
+  opens = opens.tz_convert('UTC').as_unit('ns').asi8
+  minute = 60 * 10**9
+  stamps = (opens[:, None] + np.arange(SESSION)[None, :] * minute).reshape(-1)
+  return pd.DatetimeIndex(stamps).tz_localize('UTC')
+
+def walk(rng, n_days, vol, overnight):
+  '''
+  A log random walk over n_days sessions with an overnight gap.
+  '''
+  steps = rng.normal(0, vol / math.sqrt(SESSION), (n_days, SESSION))
+  steps[1:, 0] = steps[1:, 0] + rng.normal(0, overnight, n_days - 1)
+  return np.cumsum(steps.reshape(-1))
+
+def reverting(rng, n, sigma, half_life):
+  '''
+  A discrete Ornstein-Uhlenbeck path with stationary standard deviation
+  sigma and the given half-life in minutes.
+  '''
+  phi = 0.5 ** (1 / half_life)
+  shocks = rng.normal(0, sigma * math.sqrt(1 - phi * phi), n)
+  path = np.empty(n)
+  level = rng.normal(0, sigma)
+  for start in range(0, n, 4096):
+    # Solve the recursion a block at a time: x[t] = phi * x[t-1] + e[t]
+    e = shocks[start:start + 4096]
+    powers = phi ** np.arange(1, len(e) + 1)
+    block = powers * (level + np.cumsum(e / powers))
+    path[start:start + len(e)] = block
+    level = block[-1]
+  return path
+
+def presence(rng, n, n_days, spec):
+  '''
+  Which minutes a symbol trades in: a liquidity drawn per symbol, halts of
+  1-10 days and a late listing.
+  '''
+  if rng.random() < spec['thin']: p = rng.uniform(0.02, 0.3)
+  else: p = rng.uniform(0.85, 1.0)
+  mask = rng.random(n) < p
+  for k in range(rng.poisson(spec['halts'] * n_days / 252)):
+    first = rng.integers(0, n_days)
+    mask[first * SESSION:(first + rng.integers(1, 11)) * SESSION] = False
+  if rng.random() < spec['late']:
+    mask[:rng.integers(0, n_days // 2 + 1) * SESSION] = False
+  return mask
+
+def calendar(start, days):
+  '''
+  The session minutes with their timestamps as written to the bar files,
+  and the hour each falls in. Cached, as every cluster shares it.
+  '''
+  key = (start, days)
+  if key not in _calendars:
+    index = sessions(start, days)
+    codes, hours = pd.factorize(index.floor('h'))
+    _calendars[key] = (index.strftime(STAMP).to_numpy(dtype=object), codes,
+                       hours.strftime(STAMP).to_numpy(dtype=object))
+  return _calendars[key]
+
+def bars(rng, log_price):
+  '''
+  Minute bars around a log price path, as a dict of columns.
+  '''
+  close = np.exp(log_price)
+  open_ = np.r_[close[0], close[:-1]]
+  wiggle = np.abs(rng.normal(0, 3e-4, (2, len(close))))
+  high = np.maximum(open_, close) * (1 + wiggle[0])
+  low = np.minimum(open_, close) * (1 - wiggle[1])
+  vwap = np.clip((open_ + close) / 2 * (1 + rng.normal(0, 1e-4, len(close))),
+                 low, high)
+  size = rng.lognormal(math.log(2e4 / max(close.mean(), 1)), 0.5)
+  volume = np.ceil(rng.lognormal(0, 1, len(close)) * size).astype(np.int64)
+  trade_count = np.maximum(1, np.round(volume / rng.uniform(50, 150))) \
+                  .astype(np.int64)
+  return {'open': open_, 'high': high, 'low': low, 'close': close,
+          'volume': volume, 'trade_count': trade_count, 'vwap': vwap}
+
+def hourly(columns, codes):
+  '''
+  Aggregate minute bars (sorted, codes being the hour of each) into hour
+  bars as alpaca does. Returns the columns and the hour of each bar.
+  '''
+  starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+  ends = np.r_[starts[1:], len(codes)] - 1
+  volume = np.add.reduceat(columns['volume'], starts)
+  notional = np.add.reduceat(columns['vwap'] * columns['volume'], starts)
+  return {'open': columns['open'][starts],
+          'high': np.maximum.reduceat(columns['high'], starts),
+          'low': np.minimum.reduceat(columns['low'], starts),
+          'close': columns['close'][ends], 'volume': volume,
+          'trade_count': np.add.reduceat(columns['trade_count'], starts),
+          'vwap': notional / volume}, codes[starts]
+
+def write(directory, symbol, stamps, columns):
+  path = os.path.join(directory, symbol + '.csv')
+  frame = pd.DataFrame({'symbol': symbol, 'timestamp': stamps, **columns},
+                       columns=warmup.COLUMNS)
+  frame.to_csv(path + '.tmp', index=False, float_format=FLOAT_FORMAT)
+  os.replace(path + '.tmp', path)
+  return
+
+def pearson(a, b):
+  both = ~np.isnan(a) & ~np.isnan(b)
+  if both.sum() < 3: return float('nan')
+  return float(np.corrcoef(a[both], b[both])[0, 1])
+
+def fit(x, y):
+  '''
+  Model parameters [kernel_loc, kernel_scale, bias_loc, bias_scale] of a
+  linear fit of y on x whose standard deviation is that of the residuals.
+  '''
+  both = ~np.isnan(x) & ~np.isnan(y)
+  slope, intercept = np.polyfit(x[both], y[both], 1)
+  scale = max(np.std(y[both] - slope * x[both] - intercept) - 1e-3, 1e-6)
+  # 1e-3 + softplus(0.05 * bias_scale) == residual standard deviation
+  return [slope, 0.0, intercept, math.log(math.expm1(scale)) / 0.05]
+
+def cluster(task):
+  '''
+  Generate and write the bars of one cluster. Returns its pairs.
+  '''
+  c, members, spec = task
+  rng = np.random.default_rng([spec['seed'], c])
+  stamps, codes, hour_stamps = calendar(spec['start'], spec['days'])
+  n = len(stamps)
+  market = walk(np.random.default_rng([spec['seed'], 1 << 30]),
+                spec['days'], DAILY_VOL * 0.6, 0.005)
+  shared = walk(rng, spec['days'], DAILY_VOL, 0.01) if len(members) > 1 \
+           else 0.0
+  minute, hour = {}, {}
+  for symbol, scale in members:
+    log_price = math.log(scale) + rng.uniform(0.8, 1.2) * market
+    if len(members) > 1:
+      log_price = log_price + shared + reverting(
+                    rng, n, rng.uniform(0.005, 0.02),
+                    rng.uniform(0.5, 5) * SESSION)
+    elif symbol not in g.HEDGE_SYMBOL_LIST:
+      log_price = log_price + walk(rng, spec['days'], DAILY_VOL, 0.01)
+    columns = bars(rng, log_price)
+    if symbol in g.HEDGE_SYMBOL_LIST: mask = np.ones(n, dtype=bool)
+    else: mask = presence(rng, n, spec['days'], spec)
+    columns = {k: v[mask] for k, v in columns.items()}
+    h, h_codes = hourly(columns, codes[mask])
+    write(os.path.join(spec['out'], 'us_equities'), symbol, stamps[mask],
+          columns)
+    write(os.path.join(spec['out'], 'us_equities_hourly'), symbol,
+          hour_stamps[h_codes], h)
+    if len(members) > 1:
+      minute[symbol] = np.full(n, np.nan)
+      minute[symbol][mask] = columns['vwap']
+      hour[symbol] = np.full(len(hour_stamps), np.nan)
+      hour[symbol][h_codes] = h['vwap']
+  pairs = []
+  for (s1, _), (s2, _) in itertools.combinations(members, 2):
+    x, y = minute[s1], minute[s2]
+    if np.nanmean(x) > np.nanmean(y): s1, s2, x, y = s2, s1, y, x
+    p = pearson(x, y)
+    if np.isnan(p): continue
+    pairs.append({'symbol1': s1, 'symbol2': s2, 'pearson': p,
+                  'pearson_historical': pearson(hour[s1], hour[s2]),
+                  'params': fit(x, y)})
+  return pairs
+
+def plan(spec):
+  '''
+  Assign symbols to clusters and price scales.
+  '''
+  rng = np.random.default_rng([spec['seed'], 1 << 31])
+  names = symbols(spec['symbols'])
+  sizes = rng.integers(spec['cluster_min'], spec['cluster_max'] + 1,
+                       spec['clusters'])
+  clustered = min(int(sizes.sum()), len(names))
+  low, high = np.log(PRICE_RANGE)
+  scales = np.exp(rng.uniform(low, high, len(names)))
+  n_heavy = math.ceil(spec['heavy'] * len(names)) if spec['heavy'] > 0 else 0
+  heavy_low, heavy_high = np.log(HEAVY_RANGE)
+  # Heavy symbols go in clusters first, one per cluster, so they get paired
+  heavy = list(np.cumsum(np.r_[0, sizes[:-1]])[:n_heavy])
+  heavy = [i for i in heavy if i < clustered]
+  heavy = heavy + list(range(clustered, clustered + n_heavy - len(heavy)))
+  for i in heavy[:n_heavy]:
+    if i < len(names): scales[i] = np.exp(rng.uniform(heavy_low, heavy_high))
+  groups = []
+  i = 0
+  for size in sizes:
+    if i >= len(names): break
+    groups.append(list(zip(names[i:i + size], scales[i:i + size])))
+    i = i + size
+  groups.extend([[(s, p)] for s, p in zip(names[i:], scales[i:])])
+  # The hedge ETFs track the market factor alone
+  groups.extend([[(s, rng.uniform(50, 400))]
+                 for s in dict.fromkeys(g.HEDGE_SYMBOL_LIST)])
+  return groups
+
+def asset(symbol, rng, etf=False):
+  return {'id': str(uuid.UUID(int=int(rng.integers(0, 1 << 63)))),
+          'class': 'us_equity',
+          'exchange': 'ARCA' if etf else str(rng.choice(['NYSE', 'NASDAQ'])),
+          'symbol': symbol,
+          'name': '%s %s' % (symbol, 'ETF' if etf else 'Inc.'),
+          'status': 'active', 'tradable': True, 'marginable': True,
+          'shortable': True, 'easy_to_borrow': True,
+          'fractionable': True if etf else bool(rng.random() < 0.5),
+          'min_order_size': None, 'min_trade_increment': None,
+          'price_increment': None, 'maintenance_margin_requirement': 30.0,
+          'attributes': []}
+
+def write_universe(out, groups, pairs, spec):
+  root = os.path.join(out, 'creek')
+  rng = np.random.default_rng([spec['seed'], 1 << 32])
+  with open(os.path.join(root, 'assets.json'), 'w') as f:
+    json.dump([asset(s, rng, etf=s in g.HEDGE_SYMBOL_LIST)
+               for group in groups for s, _ in group], f)
+  frame = pd.DataFrame(pairs, columns=['symbol1', 'symbol2', 'pearson',
+                                       'pearson_historical', 'params'])
+  frame['symbol1_name'] = frame['symbol1'] + ' Inc.'
+  frame['symbol2_name'] = frame['symbol2'] + ' Inc.'
+  frame[['symbol1', 'symbol2', 'pearson']].to_csv(
+    os.path.join(out, 'pearson', 'pearson.csv'), index=False)
+  frame = frame.reindex(frame['pearson_historical'].abs()
+                        .sort_values(ascending=False).index)
+  if spec['pairs']: frame = frame[:spec['pairs']]
+  frame = frame.reset_index(drop=True)
+  columns = ['symbol1', 'symbol2', 'pearson', 'pearson_historical',
+             'symbol1_name', 'symbol2_name']
+  frame[columns].to_csv(os.path.join(out, 'pearson',
+                                     'pearson_historical.csv'))
+  frame[columns].to_csv(os.path.join(root, 'pearson.csv'))
+  titles = (frame['symbol1'] + '-' + frame['symbol2']).to_list()
+  mtimes = []
+  for title in titles:
+    path = os.path.join(root, 'checkpoints', title + '.index')
+    open(path, 'w').close()
+    mtimes.append(os.path.getmtime(path))
+  params = pd.DataFrame(frame['params'].to_list(), index=titles,
+                        columns=['kernel_loc', 'kernel_scale', 'bias_loc',
+                                 'bias_scale'])
+  params['mtime'] = mtimes
+  params.to_csv(os.path.join(root, 'model_params.csv'))
+  with open(os.path.join(root, 'model_version'), 'w') as f:
+    f.write(dt.now().isoformat())
+  with open(os.path.join(root, 'config.json'), 'w') as f:
+    json.dump({'TO_OPEN_SIGNAL': g.TO_OPEN_SIGNAL, 'burn_list': []}, f)
+  return len(titles)
+
+def generate(out, symbols=500, days=250, start='2022-01-03', clusters=None,
+             cluster_min=2, cluster_max=6, heavy=0.002, thin=0.1,
+             halts=0.5, late=0.05, pairs=None, seed=0, workers=None):
+  '''
+  Write a synthetic universe under out (see above). clusters defaults to
+  one planted cluster per 10 symbols. Returns a summary dict.
+  '''
+  logger = logging.getLogger(__name__)
+  began = time.monotonic()
+  spec = {'out': out, 'symbols': symbols, 'days': days,
+          'start': pd.Timestamp(start), 'seed': seed,
+          'clusters': clusters if clusters is not None else symbols // 10,
+          'cluster_min': cluster_min, 'cluster_max': cluster_max,
+          'heavy': heavy, 'thin': thin, 'halts': halts, 'late': late,
+          'pairs': pairs}
+  for d in ['us_equities', 'us_equities_hourly', 'us_equities_interpolated',
+            'pearson', 'tf', os.path.join('creek', 'checkpoints'),
+            os.path.join('creek', 'open_trades')]:
+    os.makedirs(os.path.join(out, d), exist_ok=True)
+  for d in ['dev', 'regression', 'loss', 'old_checkpoints']:
+    os.makedirs(os.path.join(out, 'tf', d), exist_ok=True)
+  groups = plan(spec)
+  tasks = [(c, members, spec) for c, members in enumerate(groups)]
+  # Big clusters first, so that they do not straggle at the end
+  tasks.sort(key=lambda t: -len(t[1]))
+  workers = workers or os.cpu_count()
+  if workers <= 1: results = [cluster(t) for t in tasks]
+  else:
+    with mp.get_context('fork').Pool(workers) as pool:
+      results = pool.map(cluster, tasks, chunksize=1)
+  n_pairs = write_universe(out, groups, [p for r in results for p in r],
+                           spec)
+  summary = {'symbols': sum(len(m) for m in groups),
+             'clusters': len([m for m in groups if len(m) > 1]),
+             'pairs': n_pairs, 'days': days,
+             'seconds': time.monotonic() - began}
+  logger.info('Generated %s symbols and %s pairs over %s days in %.1f seconds' %
+              (summary['symbols'], summary['pairs'], days,
+               summary['seconds']))
+  return summary
+
+def use(out, config=g):
+  '''
+  Point config (or the batch scripts' own top-level config module) at a
+  directory written by generate.
+  '''
+  config.root = os.path.join(out, 'creek')
+  config.minute_bar_dir = os.path.join(out, 'us_equities')
+  config.hour_bar_dir = os.path.join(out, 'us_equities_hourly')
+  config.interpolated_bars_dir = os.path.join(out, 'us_equities_interpolated')
+  config.pearson_dir = os.path.join(out, 'pearson')
+  config.tf_dir = os.path.join(out, 'tf')
+  return
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Generate a synthetic '
+                                   'universe of correlated bars')
+  parser.add_argument('out', help='directory to write to')
+  parser.add_argument('--symbols', type=int, default=500)
+  parser.add_argument('--days', type=int, default=250,
+                      help='sessions of history')
+  parser.add_argument('--start', default='2022-01-03',
+                      help='first session')
+  parser.add_argument('--clusters', type=int,
+                      help='planted clusters (default: symbols / 10)')
+  parser.add_argument('--cluster-min', type=int, default=2)
+  parser.add_argument('--cluster-max', type=int, default=6)
+  parser.add_argument('--heavy', type=float, default=0.002,
+                      help='fraction of symbols at NVR-like prices')
+  parser.add_argument('--thin', type=float, default=0.1,
+                      help='fraction of sparsely traded symbols')
+  parser.add_argument('--halts', type=float, default=0.5,
+                      help='multi-day halts per symbol per year')
+  parser.add_argument('--late', type=float, default=0.05,
+                      help='fraction of symbols listed part way through')
+  parser.add_argument('--pairs', type=int,
+                      help='keep only the best PAIRS pairs')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--workers', type=int,
+                      help='worker processes (default: one per CPU)')
+  args = parser.parse_args(argv)
+  logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s:%(levelname)s:%(name)s:%(message)s",
+    handlers=[logging.handlers.WatchedFileHandler(os.environ.get("LOGFILE", "creek-synth.log"))]
+  )
+  summary = generate(args.out, symbols=args.symbols, days=args.days,
+                     start=args.start, clusters=args.clusters,
+                     cluster_min=args.cluster_min,
+                     cluster_max=args.cluster_max, heavy=args.heavy,
+                     thin=args.thin, halts=args.halts, late=args.late,
+                     pairs=args.pairs, seed=args.seed, workers=args.workers)
+  print(json.dumps(summary, indent=2))
+  return
+
+if __name__ == '__main__':
+  main()
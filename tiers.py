@@ -0,0 +1,101 @@
+import logging
+import math
+import numpy as np
+import pandas as pd
+from . import config as g
+from . import metrics
+
+'''
+Adaptive evaluation tiers for closed pairs. Most pairs sit well below
+TO_OPEN_SIGNAL, so after each evaluation we bound how fast the pair's sigma
+can move (the largest per-minute change over its last TIER_WINDOW points,
+times TIER_SAFETY) and skip the pair until it could possibly have reached
+the threshold, up to TIER_MAX_INTERVAL cycles. Pairs with new bars that are
+not yet due are kept pending and evaluated on the latest bar once due.
+
+Open trades are not tiered: their close thresholds step down with holding
+time and the bail-out rule needs every bar, so signal.main evaluates them
+every cycle.
+'''
+cycle = 0
+evaluated = 0
+skipped = 0
+tier_sizes = {'hot': 0, 'warm': 0, 'cold': 0}
+_next = {} # 'SYMBOL1-SYMBOL2': cycle at which the pair is next due
+_tier = {} # 'SYMBOL1-SYMBOL2': 'hot', 'warm' or 'cold'
+_pending = set() # Pairs with unseen bars that were not yet due
+
+def select(pairs):
+  '''
+  Start a new cycle and return those of pairs (plus previously skipped
+  pairs) that are due for evaluation.
+  '''
+  global cycle, evaluated, skipped
+  cycle = cycle + 1
+  _pending.update(pairs)
+  due = {k for k in _pending if _next.get(k, 0) <= cycle}
+  _pending.difference_update(due)
+  evaluated = evaluated + len(due)
+  skipped = skipped + len(_pending)
+  return due
+
+def max_step(sigma_series):
+  recent = sigma_series[-g.TIER_WINDOW:]
+  if len(recent) < 2: return None
+  index = pd.to_datetime(recent.index, utc=True).values
+  minutes = np.diff(index).astype('timedelta64[s]').astype(float) / 60
+  steps = np.abs(np.diff(recent.to_numpy())) / np.maximum(minutes, 1)
+  return float(steps.max()) * g.TIER_SAFETY
+
+def interval(sigma_series):
+  if len(sigma_series) == 0: return 1
+  distance = g.TO_OPEN_SIGNAL - sigma_series.iloc[-1]
+  step = max_step(sigma_series)
+  if step is None or distance <= 0: return 1
+  if step == 0: return g.TIER_MAX_INTERVAL
+  return max(1, min(g.TIER_MAX_INTERVAL, math.floor(distance / step)))
+
+def schedule(key, t):
+  '''
+  Reschedule a closed pair after it has been evaluated.
+  '''
+  i = interval(t.get_sigma_series())
+  _next[key] = cycle + i
+  if i == 1: tier = 'hot'
+  elif i < g.TIER_MAX_INTERVAL: tier = 'warm'
+  else: tier = 'cold'
+  if key in _tier.keys(): tier_sizes[_tier[key]] -= 1
+  tier_sizes[tier] += 1
+  _tier[key] = tier
+  return
+
+def reset():
+  '''
+  Make every pair due, e.g. after TO_OPEN_SIGNAL has been lowered.
+  '''
+  _next.clear()
+  return
+
+def log_stats():
+  logger = logging.getLogger(__name__)
+  logger.info('Tiers: %s hot, %s warm, %s cold; %s evaluated, %s skipped so far',
+              tier_sizes['hot'], tier_sizes['warm'], tier_sizes['cold'],
+              evaluated, skipped)
+  return
+
+def forget(keys):
+  '''
+  Drop the schedule of pairs that left the universe or were retrained
+  (see reload.py), so they are due as soon as they see a bar.
+  '''
+  for k in keys:
+    _next.pop(k, None)
+    if k in _tier.keys(): tier_sizes[_tier.pop(k)] -= 1
+    _pending.discard(k)
+  return
+
+metrics.register('tiers', lambda: {'hot': tier_sizes['hot'],
+                                   'warm': tier_sizes['warm'],
+                                   'cold': tier_sizes['cold'],
+                                   'evaluated': evaluated,
+                                   'skipped': skipped})
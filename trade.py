@@ -11,26 +11,24 @@ import pytz as tz
 from fractions import Fraction
 import math
 import json
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-import tensorflow.compat.v2 as tf
-tf.enable_v2_behavior()
-import tensorflow_probability as tfp
-tfd = tfp.distributions
-from tensorflow.python.framework import errors_impl as tf_errors
 import numpy as np
 from alpaca.trading.requests import LimitOrderRequest
 from alpaca.trading.requests import MarketOrderRequest
 from alpaca.trading.requests import ReplaceOrderRequest
-from alpaca.data.requests import StockLatestTradeRequest
-from alpaca.data.requests import StockLatestQuoteRequest
 from alpaca.common.exceptions import APIError
 from . import config as g
+from . import broker
+from . import orders
+from . import market_data
+from . import models
+from . import ledger
+from . import logs
 
 class Trade:
   """
   Trade class.
   Attributes:
-    _model: contains tensorflow model
+    _params: the pair's model parameters (see models.py)
     _has_model (bool): whether model weights have been successfully
                        loaded
     _status: 'uninitialized, ''disabled', 'open', 'closed', 'opening', 
@@ -41,23 +39,12 @@ class Trade:
 
   def _LoadWeights(self):
     logger = logging.getLogger(__name__)
-    negloglik = lambda y, rv_y: -rv_y.log_prob(y)
-    self._model = tf.keras.Sequential([
-    tf.keras.layers.Dense(1 + 1),
-    tfp.layers.DistributionLambda(
-      lambda t: tfd.Normal(loc=t[..., :1],
-                scale=1e-3 + tf.math.softplus(0.05 * t[...,1:]))),
-    ])
-    self._model.compile(
-                optimizer=tf.optimizers.Adam(learning_rate=0.01),
-                loss=negloglik)
-    try:
-      self._model.load_weights('%s/checkpoints/%s' % 
-                               (g.root,self._title)).expect_partial()
+    self._params = models.get(self._title)
+    if self._params is not None:
       self._has_model = True
       return 1
-    except tf_errors.NotFoundError as e:
-      logger.error(e)
+    else:
+      logger.error('No model parameters for %s', self._title)
       self._has_model = False
       self._status = 'disabled'
       return 0
@@ -101,10 +88,10 @@ class Trade:
     self._sigma_series = sigma_series
     if not self._symbols[0].tradable or not self._symbols[1].tradable:
       self._status = 'disabled'
-      logger.error('%s is open but not tradable' % self._title)
+      logger.error('%s is open but not tradable', self._title)
     if not self._symbols[0].shortable or not self._symbols[1].shortable:
       self._status = 'disabled'
-      logger.error('%s is open but not shortable' % self._title)
+      logger.error('%s is open but not shortable', self._title)
     return
   
   def status(self): return self._status
@@ -114,6 +101,7 @@ class Trade:
     return {self._symbols[0].symbol:self._position[0],
             self._symbols[1].symbol:self._position[1],
             self._hedge_position['symbol']:self._hedge_position}
+  def get_hedge(self): return self._hedge_position
   def get_sigma_series(self):
     if self._status == 'open': return self._sigma_series[self._opened:]
     else: return self._sigma_series
@@ -148,22 +136,39 @@ class Trade:
     return
   
   def _mean(self, x):
-    val = np.array([[x]], dtype=np.float32)
-    return float(np.squeeze(self._model(val).mean().numpy()))
+    return float(models.mean(self._params, x))
 
   def _stddev(self, x):
-    val = np.array([[x]], dtype=np.float32)
-    return float(np.squeeze(self._model(val).stddev().numpy()))
+    return float(models.stddev(self._params, x))
 
   def _sigma(self, x, y):
     return abs(y - self._mean(x)) / self._stddev(x)
 
   def _stddev_x(self, x):
-    xpoints = np.array([[x], [2 * x]], dtype='float32')
-    m = self._model(xpoints)
-    ypoints = np.squeeze(m.mean().numpy())
     ydelta = self._stddev(x)
-    return ( ydelta  / (ypoints[1] - ypoints[0]) ) * x 
+    return ( ydelta  / (self._mean(2 * x) - self._mean(x)) ) * x 
+
+  def warm_up(self, history):
+    '''
+    Prepend sigma history computed from stored bars to whatever the trade
+    already has (open trades reload theirs from open_trades/*.csv).
+    '''
+    if len(self._sigma_series) > 0:
+      history = history[history.index < self._sigma_series.index[0]]
+      self._sigma_series = pd.concat([history, self._sigma_series])
+    else: self._sigma_series = history
+    return
+
+  def reload_params(self):
+    '''
+    Pick up retrained model parameters. A closed pair's sigma history was
+    computed with the old model, so it is dropped to be warmed up again;
+    an open trade keeps its history.
+    '''
+    if not self._LoadWeights(): return 0
+    if self._status == 'closed':
+      self._sigma_series = pd.Series(dtype=np.float64)
+    return 1
 
   def append_bar(self):
     if (not g.bars[self._symbols[0].symbol] or
@@ -190,7 +195,7 @@ class Trade:
     if len(self._sigma_series) == 0: return 0, None, None, None
     if self._title in g.burn_list: return 0, None, None, None
     else:
-      sigma = self._sigma_series[-1]
+      sigma = self._sigma_series.iloc[-1]
       if sigma > g.TO_OPEN_SIGNAL:
         x = g.bars[self._symbols[0].symbol][-1].vwap
         y = g.bars[self._symbols[1].symbol][-1].vwap
@@ -205,9 +210,9 @@ class Trade:
   def close_signal(self, clock):
     logger = logging.getLogger(__name__)
     if len(self._sigma_series) == 0:
-      logger.warn('%s is open but has no sigma series' % self._title)
+      logger.warn('%s is open but has no sigma series', self._title)
       return 0
-    sigma = self._sigma_series[-1]
+    sigma = self._sigma_series.iloc[-1]
     time = self._sigma_series.index[-1]
     delta = clock.now() - self._opened
     if sigma < 0.25: return 1
@@ -232,7 +237,7 @@ class Trade:
     if (clock.now() - self._opened) > td(days=7):
       recent = self._sigma_series[(clock.now() - td(days=7)):].to_list()
       if sum(recent)/max(len(recent),1) > 6:
-        logger.info('Last week of bars of %s have average sigma > 6, bailing out' % self._title)
+        logger.info('Last week of bars of %s have average sigma > 6, bailing out', self._title)
         g.burn_list.append(self._title)
         return 1
     return 0
@@ -242,10 +247,11 @@ class Trade:
     Get the hell out
     '''
     logger = logging.getLogger(__name__)
+    broker.priority.set(broker.BAIL_OUT)
     _short = 0 if self._position[0]['side'] == 'short' else 1
     _long = int(abs(1-_short))
     self._status = 'closed'
-    logger.info('Getting the hell out of %s' % self._title)
+    logger.info('Getting the hell out of %s', self._title)
     short_request = MarketOrderRequest(
                               symbol = self._symbols[_short].symbol,
                               qty = self._position[_short]['qty'],
@@ -256,18 +262,17 @@ class Trade:
                               qty = self._position[_long]['qty'],
                               side = 'sell',
                               time_in_force = 'day')
-    g.orders[self._title] = {'buy': None, 'sell': None}
     filled = await asyncio.gather(market_qty(short_request,self._title), 
                          market_qty(long_request, self._title))
     avg_exit_price = {}
     for i in range(2):
       j = _long if i else _short
       avg_exit_price[j] = filled[i][1]
-      if filled[i][0]: logger.info('Bailed out of %s in trade %s' % (self._symbols[j].symbol, self._title))
-      else: logger.error('Unable to bail out of %s in trade %s' %
-                         (self._symbols[j].symbol, self._title))
+      if filled[i][0]: logger.info('Bailed out of %s in trade %s', self._symbols[j].symbol, self._title, extra=logs.UNLIMITED)
+      else: logger.error('Unable to bail out of %s in trade %s',
+                         self._symbols[j].symbol, self._title)
     self._status = 'closed'
-    logger.info('%s closed' % self._title)
+    logger.info('%s closed', self._title, extra=logs.UNLIMITED)
     closed_self = ClosedTrade(self, clock.now(), avg_exit_price)
     g.closed_trades.append(closed_self)
     self._position = [{'side':None,'qty':0,'avg_entry_price':0.0},
@@ -277,14 +282,19 @@ class Trade:
 
 
 
-  async def try_close(self, clock, latest_quote, latest_trade):
+  def plan_close(self, clock, latest_quote, latest_trade,
+                 priority=broker.CLOSE):
+    '''
+    Returns the two limit order legs (see netting.py) that close the
+    trade, or None if there is nothing to close.
+    '''
     logger = logging.getLogger(__name__)
     if self._symbols[0].symbol not in latest_trade.keys():
-      logger.warn('%s not in latest_trade.keys()' % self._symbols[0].symbol)
-      return 0
+      logger.warn('%s not in latest_trade.keys()', self._symbols[0].symbol)
+      return None
     if self._symbols[1].symbol not in latest_trade.keys():
-      logger.warn('%s not in latest_trade.keys()' % self._symbols[1].symbol)
-      return 0
+      logger.warn('%s not in latest_trade.keys()', self._symbols[1].symbol)
+      return None
     price = (latest_trade[self._symbols[0].symbol].price,
              latest_trade[self._symbols[1].symbol].price)
     if (self._position[0]['qty'] == 0) or (self._position[1]['qty'] == 0):
@@ -294,56 +304,48 @@ class Trade:
                               'side':'long','notional':0.0,
                               'qty':0,'avg_entry_price':0.0}
       self._status = 'closed'
-      return 0
+      return None
     _short = 0 if self._position[0]['side'] == 'short' else 1
     _long = int(abs(1-_short))
     bid_ask = compute_bid_ask(latest_quote, self._symbols)
     stddev = self._stddev(price[0])
     stddev_x = self._stddev_x(price[0]) # signed float
     self._status = 'closing'
-    logger.info('Closing %s, long %s, short %s' %
-                (self._title, self._symbols[_long],
-                 self._symbols[_short]))
+    logger.info('Closing %s, long %s, short %s',
+                self._title, self._symbols[_long],
+                self._symbols[_short], extra=logs.UNLIMITED)
     short_cushion = stddev * g.SIGMA_CUSHION if _short else abs(stddev_x) * g.SIGMA_CUSHION
     short_limit = price[_short] + min(bid_ask[_short],short_cushion)
     short_limit = round(short_limit, 2)
     long_cushion = stddev * g.SIGMA_CUSHION if _long else abs(stddev_x) * g.SIGMA_CUSHION
     long_limit = price[_long] - min(bid_ask[_long],long_cushion)
     long_limit = round(long_limit, 2)
-    short_request = LimitOrderRequest(
-                      symbol = self._symbols[_short].symbol,
-                      qty = self._position[_short]['qty'],
-                      side = 'buy',
-                      time_in_force = 'day',
-                      client_order_id = stamp(self._title),
-                      limit_price = short_limit
-                      )
-    long_request = LimitOrderRequest(
-                      symbol = self._symbols[_long].symbol,
-                      qty = self._position[_long]['qty'],
-                      side = 'sell',
-                      time_in_force = 'day',
-                      client_order_id = stamp(self._title),
-                      limit_price = long_limit
-                      )
-    g.orders[self._title] = {'buy': None, 'sell': None}
-    filled = await asyncio.gather(
-               limit_qty(short_request, self._title, short_cushion, 
-                         bid_ask[_short]),
-               limit_qty(long_request, self._title, long_cushion, 
-                         bid_ask[_long]))
+    return [
+      leg(self._title, _short, self._symbols[_short].symbol, 'buy',
+          self._position[_short]['qty'], short_limit, short_cushion,
+          bid_ask[_short], priority),
+      leg(self._title, _long, self._symbols[_long].symbol, 'sell',
+          self._position[_long]['qty'], long_limit, long_cushion,
+          bid_ask[_long], priority)]
+
+  def book_close(self, clock, legs, filled):
+    '''
+    Record the fills, as (qty, avg_price) per leg, of the legs returned
+    by plan_close and close the trade.
+    '''
+    logger = logging.getLogger(__name__)
     avg_exit_price = {}
     for i in range(2):
-      j = _long if i else _short
+      j = legs[i]['index']
       avg_exit_price[j] = filled[i][1]
       if filled[i][0] == self._position[j]['qty']: 
-        logger.info('Successfully closed %s in trade %s' % (self._symbols[j].symbol, self._title))
-      else: logger.error('Only closed %s/%s shares of %s in trade %s' %
-                         (filled[i][0], 
-                         self._position[_short]['qty'],
-                         self._symbols[j].symbol, self._title))
+        logger.info('Successfully closed %s in trade %s', self._symbols[j].symbol, self._title, extra=logs.UNLIMITED)
+      else: logger.error('Only closed %s/%s shares of %s in trade %s',
+                         filled[i][0], 
+                         self._position[j]['qty'],
+                         self._symbols[j].symbol, self._title)
     self._status = 'closed'
-    logger.info('%s closed' % self._title)
+    logger.info('%s closed', self._title, extra=logs.UNLIMITED)
     closed_self = ClosedTrade(self, clock.now(), avg_exit_price)
     g.closed_trades.append(closed_self)
     self._position = [{'side':None,'qty':0,'avg_entry_price':0.0},
@@ -351,44 +353,53 @@ class Trade:
     return (self._hedge_position['symbol'],
             -1 * self._hedge_position['qty'], closed_self)
 
+  async def try_close(self, clock, latest_quote, latest_trade,
+                      priority=broker.CLOSE):
+    broker.priority.set(priority)
+    legs = self.plan_close(clock, latest_quote, latest_trade, priority)
+    if legs is None: return 0
+    filled = await asyncio.gather(*(limit_qty(l['request'], self._title,
+                                      l['cushion'], l['bid_ask'])
+                                    for l in legs))
+    return self.book_close(clock, legs, filled)
 
-
-
-
-
-  async def try_open(self, clock, latest_quote, latest_trade):
+  def plan_open(self, clock, latest_quote, latest_trade):
+    '''
+    Returns the two limit order legs (see netting.py) that open the
+    trade, or None if the trade should not be opened after all.
+    '''
     logger = logging.getLogger(__name__)
     if self._symbols[0].symbol not in latest_trade.keys():
-      logger.warn('%s not in latest_trade.keys()' % self._symbols[0].symbol)
-      return 0
+      logger.warn('%s not in latest_trade.keys()', self._symbols[0].symbol)
+      return None
     if self._symbols[1].symbol not in latest_trade.keys():
-      logger.warn('%s not in latest_trade.keys()' % self._symbols[1].symbol)
-      return 0
+      logger.warn('%s not in latest_trade.keys()', self._symbols[1].symbol)
+      return None
 
     price = (float(latest_trade[self._symbols[0].symbol].price),
              float(latest_trade[self._symbols[1].symbol].price))
     for i in range(2):
       if price[i] == 0:
-        logger.error('%s price = %s, aborting' % 
-                     (self._symbols[i].symbol, price[i]))
-        return 0
+        logger.error('%s price = %s, aborting', 
+                     self._symbols[i].symbol, price[i])
+        return None
     if price[0] > (g.trade_size / 2):
-      logger.info('Passing on %s as one share of %s costs %s, whereas the max trade size is %s' % (self._title, self._symbols[0].symbol, price[0], g.trade_size))
-      return 0
+      logger.info('Passing on %s as one share of %s costs %s, whereas the max trade size is %s', self._title, self._symbols[0].symbol, price[0], g.trade_size)
+      return None
     if price[1] > g.trade_size / 2:
-      logger.info('Passing on %s as one share of %s costs %s, whereas the max trade size is %s' % (self._title, self._symbols[1].symbol, price[1], g.trade_size))
-      return 0
+      logger.info('Passing on %s as one share of %s costs %s, whereas the max trade size is %s', self._title, self._symbols[1].symbol, price[1], g.trade_size)
+      return None
     sigma = self._sigma(price[0], price[1])
-    if sigma < g.TO_OPEN_SIGNAL: return 0
+    if sigma < g.TO_OPEN_SIGNAL: return None
     bid_ask = compute_bid_ask(latest_quote, self._symbols)
     stddev = self._stddev(price[0])
     if stddev < 10 * bid_ask[0]:
-      logger.info('Passing on %s as bid-ask spread for %s = %s while stddev = %s' % (self._title, self._symbols[0].symbol, bid_ask[0], stddev))
-      return 0
+      logger.info('Passing on %s as bid-ask spread for %s = %s while stddev = %s', self._title, self._symbols[0].symbol, bid_ask[0], stddev)
+      return None
     stddev_x = self._stddev_x(price[0]) # signed float
     if abs(stddev_x) < 10 * bid_ask[1]:
-      logger.info('Passing on %s as bid-ask spread for %s = %s while |stddev_x| = %s' % (self._title, self._symbols[1].symbol, bid_ask[1], abs(stddev_x)))
-      return 0
+      logger.info('Passing on %s as bid-ask spread for %s = %s while |stddev_x| = %s', self._title, self._symbols[1].symbol, bid_ask[1], abs(stddev_x))
+      return None
 
     mean = self._mean(price[0])
     if price[1] > mean:
@@ -398,11 +409,6 @@ class Trade:
       to_long = 1
       to_short = 0
 
-    self._status = 'opening'
-    logger.info('Opening %s, long %s, short %s' %
-                (self._title, self._symbols[to_long],
-                 self._symbols[to_short]))
-
     if price[1] >= price[0]:
       expensive = 1
       cheap = 0
@@ -420,7 +426,7 @@ class Trade:
     if (shares_to_short * price[to_short] 
         - shares_to_long * price[to_long]) < 0:
       logger.error('Long position is larger than short position')
-      return 0
+      return None
     multiple = min(math.floor( (g.trade_size / 2) / 
                    (shares_to_short * price[to_short]) ),
                    math.floor( (g.trade_size / 2) / 
@@ -428,8 +434,11 @@ class Trade:
     if multiple > 1:
       shares_to_short = shares_to_short * multiple
       shares_to_long = shares_to_long * multiple
-    qty_requested = (shares_to_short, shares_to_long)
 
+    self._status = 'opening'
+    logger.info('Opening %s, long %s, short %s',
+                self._title, self._symbols[to_long],
+                self._symbols[to_short], extra=logs.UNLIMITED)
 
     short_cushion = stddev * g.SIGMA_CUSHION if to_short else abs(stddev_x) * g.SIGMA_CUSHION
     short_limit = price[to_short] - min(bid_ask[to_short],short_cushion)
@@ -437,39 +446,31 @@ class Trade:
     long_cushion = stddev * g.SIGMA_CUSHION if to_long else abs(stddev_x) * g.SIGMA_CUSHION
     long_limit = price[to_long] + min(bid_ask[to_long],long_cushion)
     long_limit = round(long_limit, 2)
-    short_request = LimitOrderRequest(
-                      symbol = self._symbols[to_short].symbol,
-                      qty = shares_to_short,
-                      side = 'sell',
-                      time_in_force = 'day',
-                      client_order_id = stamp(self._title),
-                      limit_price = short_limit
-                      )
-    long_request = LimitOrderRequest(
-                      symbol = self._symbols[to_long].symbol,
-                      qty = shares_to_long,
-                      side = 'buy',
-                      time_in_force = 'day',
-                      client_order_id = stamp(self._title),
-                      limit_price = long_limit
-                      )
-    logger.info('Submitting long order for %s, qty=%s, limit price=%s' % (self._symbols[to_long].symbol, shares_to_long, long_limit))
-    logger.info('Submitting short order for %s, qty=%s, limit price=%s' % (self._symbols[to_short].symbol, shares_to_short, short_limit))
-    g.orders[self._title] = {'buy': None, 'sell': None}
-    filled = await asyncio.gather(
-             limit_qty(short_request, self._title, short_cushion, 
-                       bid_ask[to_short]),
-             limit_qty(long_request, self._title, long_cushion, 
-                       bid_ask[to_long]))
-    avg_exit_price = {}
+    logger.info('Submitting long order for %s, qty=%s, limit price=%s', self._symbols[to_long].symbol, shares_to_long, long_limit, extra=logs.UNLIMITED)
+    logger.info('Submitting short order for %s, qty=%s, limit price=%s', self._symbols[to_short].symbol, shares_to_short, short_limit, extra=logs.UNLIMITED)
+    return [
+      leg(self._title, to_short, self._symbols[to_short].symbol, 'sell',
+          shares_to_short, short_limit, short_cushion, bid_ask[to_short],
+          broker.OPEN),
+      leg(self._title, to_long, self._symbols[to_long].symbol, 'buy',
+          shares_to_long, long_limit, long_cushion, bid_ask[to_long],
+          broker.OPEN)]
+
+  def book_open(self, clock, legs, filled):
+    '''
+    Record the fills, as (qty, avg_price) per leg, of the legs returned
+    by plan_open and open the trade. Returns the notional to hedge.
+    '''
+    logger = logging.getLogger(__name__)
+    to_short = legs[0]['index']
+    to_long = legs[1]['index']
     for i in range(2):
-      j = to_long if i else to_short
-      avg_exit_price[j] = filled[i][1]
-      if filled[i][0] == qty_requested[i]:
-        logger.info('Successfully opened %s in trade %s' % (self._symbols[j].symbol, self._title))
-      else: logger.error('Only opened %s/%s shares of %s in trade %s' %
-                         (filled[i][0], qty_requested[i],
-                         self._symbols[j].symbol, self._title))
+      j = legs[i]['index']
+      if filled[i][0] == legs[i]['qty']:
+        logger.info('Successfully opened %s in trade %s', self._symbols[j].symbol, self._title, extra=logs.UNLIMITED)
+      else: logger.error('Only opened %s/%s shares of %s in trade %s',
+                         filled[i][0], legs[i]['qty'],
+                         self._symbols[j].symbol, self._title)
 
     self._position[to_short]={'side':'short', 'qty':filled[0][0],
                               'avg_entry_price':filled[0][1]}
@@ -482,7 +483,7 @@ class Trade:
                       - self._position[to_long]['qty']
                       * self._position[to_long]['avg_entry_price'])
     if hedge_notional < 1:
-      logger.error('%s: long position in %s - short position in %s = %s; position will be unhedged' % (self._title, self._symbols[to_long].symbol, self._symbols[to_short].symbol, hedge_notional))
+      logger.error('%s: long position in %s - short position in %s = %s; position will be unhedged', self._title, self._symbols[to_long].symbol, self._symbols[to_short].symbol, hedge_notional)
       self._hedge_position = {'symbol':g.HEDGE_SYMBOL, 
                               'side':'long','notional':0.0,
                               'qty':0,'avg_entry_price':0.0}
@@ -493,6 +494,14 @@ class Trade:
                               'qty':0,'avg_entry_price':0.0}
       return hedge_notional
 
+  async def try_open(self, clock, latest_quote, latest_trade):
+    legs = self.plan_open(clock, latest_quote, latest_trade)
+    if legs is None: return 0
+    filled = await asyncio.gather(*(limit_qty(l['request'], self._title,
+                                      l['cushion'], l['bid_ask'])
+                                    for l in legs))
+    return self.book_open(clock, legs, filled)
+
 class ClosedTrade:
   def __init__(self, trade, closed, avg_exit_price):
     self._symbols = trade._symbols
@@ -541,6 +550,7 @@ class ClosedTrade:
   def get_sigma_series(self):
     return self._sigma_series[self._opened:self._closed]
   def get_pl(self): return self._pl
+  def get_hedge(self): return self._hedge_position
   def to_dict(self):
     d = {
       'title': self._title,
@@ -556,13 +566,12 @@ class ClosedTrade:
     }
     return d
 
-def get_latest_trade(symbol_or_symbols):
-  trade_request = StockLatestTradeRequest(
-                  symbol_or_symbols=symbol_or_symbols)
-  return g.hclient.get_stock_latest_trade(trade_request)
+async def get_latest_trade(symbol_or_symbols):
+  return await market_data.latest_trade(symbol_or_symbols)
 
 async def market_qty(r, title):
   logger = logging.getLogger(__name__)
+  start = time.monotonic()
   qty = r.qty
   qty_filled = 0
   qty_requested = qty
@@ -582,31 +591,30 @@ async def market_qty(r, title):
         await asyncio.sleep(5)
         continue
       else:
-        logger.error('Trade in %s rejected for lack of available shares but available shares exceed request' % r.symbol)
+        logger.error('Trade in %s rejected for lack of available shares but available shares exceed request', r.symbol)
         break
     elif response is not None:
-      await asyncio.sleep(2)
-      if g.orders[title][r.side].status == 'partially_filled':
-        await asyncio.sleep(4)
-      if g.orders[title][r.side].status == 'filled':
-        prices.append((qty_requested,
-               float(g.orders[title][r.side].filled_avg_price)))
+      order = await orders.wait(response.id)
+      if order.status == 'filled':
+        prices.append((qty_requested, float(order.filled_avg_price)))
         qty_filled = qty_filled + qty_requested
         if qty_filled < qty:
           qty_requested = qty - qty_filled
           continue
         else: break
       else:
-        logger.error('Market %s order %s for %s not filled: status %s'  
-                   % (r.side, g.orders[title][r.side].id,
-                      r.symbol, g.orders[title][r.side].status))
+        logger.error('Market %s order %s for %s not filled: status %s', r.side, order.id, r.symbol, order.status)
         break
+  logger.info('Market %s %s %s: %s/%s filled in %.2f seconds',
+              title, r.side, r.symbol, qty_filled, qty,
+              time.monotonic() - start, extra=logs.UNLIMITED)
   if qty_filled > 0:
     return qty_filled, sum([a[0]*a[1] for a in prices])/qty_filled
   else: return 0, 0.0
 
 async def limit_qty(r, title, cushion, bid_ask):
   logger = logging.getLogger(__name__)
+  start = time.monotonic()
   qty = r.qty
   qty_filled = 0
   qty_requested = qty
@@ -630,41 +638,38 @@ async def limit_qty(r, title, cushion, bid_ask):
         await asyncio.sleep(5)
         continue
       else:
-        logger.error('Trade in %s rejected for lack of available shares but available shares exceed request' % r.symbol)
+        logger.error('Trade in %s rejected for lack of available shares but available shares exceed request', r.symbol)
         break
     elif response is not None:
       order = response
       limit = r.limit_price
-      await asyncio.sleep(2)
+      current = await orders.wait(order.id, timeout=g.REPRICE_INTERVAL)
       for i in range(g.EXECUTION_ATTEMPTS):
-        if g.orders[title][r.side].status == 'filled': break
+        if current.status == 'filled': break
         else:
-          latest_trade = get_latest_trade(r.symbol)
+          latest_trade = await get_latest_trade(r.symbol)
           new_limit=(
             latest_trade[r.symbol].price + sign
             * calc_cushion(i, g.EXECUTION_ATTEMPTS, bid_ask, cushion))
           new_limit = round(new_limit, 2)
-          logger.info('Replacing trade in %s by new limit %s' % (r.symbol, new_limit))
+          logger.info('Replacing trade in %s by new limit %s', r.symbol, new_limit)
           if new_limit != limit:
             updated_request = ReplaceOrderRequest(
                                  limit_price=new_limit,
                                  client_order_id = stamp(title))
-            order_try = try_replace(order.id, updated_request)
-            logger.info('Replace order_try:')
-            logger.info(order_try)
+            order_try = await try_replace(order.id, updated_request)
+            logger.debug('Replace order_try: %s', order_try)
             order = order_try if order_try is not None else order
             limit = new_limit
-          await asyncio.sleep(2)
-      if g.orders[title][r.side].status == 'filled':
-        prices.append((qty_requested,
-                      float(g.orders[title][r.side].filled_avg_price)))
+          current = await orders.wait(order.id, timeout=g.REPRICE_INTERVAL)
+      if current.status == 'filled':
+        prices.append((qty_requested, float(current.filled_avg_price)))
         qty_filled = qty_filled + qty_requested
       else:
-        logger.warning('%s order unfilled after %s attempts, proceeding with market execution' % (title, g.EXECUTION_ATTEMPTS))
-        fap = float(g.orders[title][r.side].filled_avg_price) if g.orders[title][r.side].filled_avg_price is not None else 0
-        prices.append(
-          (int(g.orders[title][r.side].filled_qty), fap))
-        try_cancel(order.id)
+        logger.warning('%s order unfilled after %s attempts, proceeding with market execution', title, g.EXECUTION_ATTEMPTS)
+        fap = float(current.filled_avg_price) if current.filled_avg_price is not None else 0
+        prices.append((int(current.filled_qty), fap))
+        await try_cancel(order.id)
         qty_remaining = qty_requested - prices[-1][0]
         request = MarketOrderRequest(
                      symbol = r.symbol,
@@ -675,25 +680,39 @@ async def limit_qty(r, title, cushion, bid_ask):
         market_filled = await market_qty(request, title)
         prices.append(market_filled)
         if market_filled[0] != qty_remaining:
-          logger.error('Only %s/%s shares of market order for %s filled' % (market_filled[0], qty_remaining, r.symbol))
+          logger.error('Only %s/%s shares of market order for %s filled', market_filled[0], qty_remaining, r.symbol)
         qty_filled = prices[-2][0] + prices[-1][0]
       if qty_filled < qty:
         qty_requested = qty - qty_filled
         continue
       else: break
+  logger.info('Limit %s %s %s: %s/%s filled in %.2f seconds',
+              title, r.side, r.symbol, qty_filled, qty,
+              time.monotonic() - start, extra=logs.UNLIMITED)
   if qty_filled > 0:
     return qty_filled, sum([a[0]*a[1] for a in prices])/qty_filled
   else: return 0, 0.0
 
 async def try_submit(request):
   logger = logging.getLogger(__name__)
+  limited = 0
   for i in range(45):
     try:
-      o = g.tclient.submit_order(request)
+      o = await broker.submit_order(request)
+      orders.track(o)
       return o
     except APIError as e:
-      if e.status_code == 403:
-        logger.error('APIError 403 when submitting a %s order for %s:' % (request.side, request.symbol))
+      if e.status_code == 429:
+        # Back off, then queue for a token again like any other request
+        delay = min(g.RATE_LIMIT_BACKOFF * 2**limited, g.RATE_LIMIT_BACKOFF_MAX)
+        limited = limited + 1
+        logger.warning('Rate limited submitting a %s order for %s, retrying in %.1f seconds',
+                       request.side, request.symbol, delay)
+        broker.rate_limited()
+        await asyncio.sleep(delay)
+        continue
+      elif e.status_code == 403:
+        logger.error('APIError 403 when submitting a %s order for %s:', request.side, request.symbol)
         logger.error(e)
         error = APIError_d(e)
         if 'available' in error.keys(): return int(error['available'])
@@ -703,27 +722,27 @@ async def try_submit(request):
       else:
         logger.error('Non-403 APIError encountered during try_submit')
         logger.error(e)
-        print(e)
         sys.exit(1)
   return None
 
-def try_replace(oid, request):
+async def try_replace(oid, request):
   logger = logging.getLogger(__name__)
   try:
-    o = g.tclient.replace_order_by_id(order_id=oid, order_data=request)
+    o = await broker.replace_order(oid, request)
+    orders.track(o)
     return o
   except APIError as e:
-    logger.error('There was an error when replacing order %s' % oid)
+    logger.error('There was an error when replacing order %s', oid)
     logger.error(e)
     return None
 
-def try_cancel(oid):
+async def try_cancel(oid):
   logger = logging.getLogger(__name__)
   try:
-    cancel_response = g.tclient.cancel_order_by_id(oid)
-    logger.info(cancel_response)
+    cancel_response = await broker.cancel_order(oid)
+    logger.debug('Cancel response: %s', cancel_response)
   except APIError as e:
-    logger.error('There was an error when canceling order %s' % oid)
+    logger.error('There was an error when canceling order %s', oid)
     logger.error(e)
   return
 
@@ -760,6 +779,24 @@ def compute_bid_ask(latest_quote, symbols):
                     latest_quote[s.symbol].bid_price))
   return ba[0], ba[1]
 
+def leg(title, index, symbol, side, qty, limit_price, cushion, bid_ask,
+        priority):
+  '''
+  One side of a pair's open or close, as planned by Trade.plan_open and
+  Trade.plan_close. index is the position of symbol within the pair.
+  '''
+  request = LimitOrderRequest(
+              symbol = symbol,
+              qty = qty,
+              side = side,
+              time_in_force = 'day',
+              client_order_id = stamp(title),
+              limit_price = limit_price
+              )
+  return {'title': title, 'index': index, 'symbol': symbol, 'side': side,
+          'qty': qty, 'limit_price': limit_price, 'cushion': cushion,
+          'bid_ask': bid_ask, 'priority': priority, 'request': request}
+
 def calc_cushion(i, attempts, bid_ask, cushion):
   if bid_ask == 0:
     logger = logging.getLogger(__name__)
@@ -767,100 +804,33 @@ def calc_cushion(i, attempts, bid_ask, cushion):
     bid_ask = 0.02
   return min((i+1) * bid_ask, (i+1) * cushion)
 
-# We don't need to worry about not having enough shares available to
-# buy or sell because we will always have a position >= 0 in the hedge
-# symbols.
-async def hedge(n):
-  logger = logging.getLogger(__name__)
-  g.orders['hedge'] = {'buy': None}
-  fractional_long_request = MarketOrderRequest(
-                            symbol = g.HEDGE_SYMBOL,
-                            notional = n,
-                            side = 'buy',
-                            client_order_id = stamp('hedge'),
-                            time_in_force = 'day')
-  await try_submit(fractional_long_request)
-  await asyncio.sleep(2)
-  if g.orders['hedge']['buy'].status == 'partially_filled':
-    await asyncio.sleep(4)
-  if g.orders['hedge']['buy'].status == 'filled':
-    logger.info('%s hedged notional %s' % (g.HEDGE_SYMBOL, n))
-    return float(g.orders['hedge']['buy'].filled_avg_price)
-  elif g.orders['hedge']['buy'].status == 'partially_filled':
-    logger.info('%s hedged notional %s only partially filled' % (g.HEDGE_SYMBOL, n))
-    return float(g.orders['hedge']['buy'].filled_avg_price)
-  else:
-    logger.error('Market buy order %s for %s not filled with status %s' %
-                 (g.orders['hedge']['buy'].id,
-                  g.HEDGE_SYMBOL,
-                  g.orders['hedge']['buy'].status))
-    return 0
-
-async def hedge_close(symbol, qty, closed_trades_by_hedge):
-  logger = logging.getLogger(__name__)
-  if qty == 0:
-    for t in closed_trades_by_hedge[symbol]:
-      t.set_hedge_exit_price(0.0)
-    return
-  g.orders[symbol] = {'sell': None}
-  logger.info('Trying to reduce hedge position in %s by %s shares' %
-              (symbol, abs(qty)))
-  fractional_sell_request = MarketOrderRequest(
-                            symbol = symbol,
-                            qty = abs(qty),
-                            side = 'sell',
-                            client_order_id = stamp(symbol),
-                            time_in_force = 'day')
-  await try_submit(fractional_sell_request)
-  await asyncio.sleep(2)
-  if g.orders[symbol]['sell'].status == 'partially_filled':
-    await asyncio.sleep(4)
-  if g.orders[symbol]['sell'].status == 'filled':
-    logger.info('%s hedge reduced by qty %s' % (symbol, abs(qty)))
-    for t in closed_trades_by_hedge[symbol]:
-      t.set_hedge_exit_price(float(g.orders[symbol]['sell'].filled_avg_price))
-  elif g.orders[symbol]['sell'].status == 'partially_filled':
-    logger.info('%s hedge reduction by qty %s only partially filled' % (symbol, abs(qty)))
-    for t in closed_trades_by_hedge[symbol]:
-      t.set_hedge_exit_price(float(g.orders[symbol]['sell'].filled_avg_price))
-  else:
-    logger.error('Market sell order %s for %s not filled with status %s' %
-                 (g.orders[symbol]['sell'].id, symbol,
-                  g.orders[symbol]['sell'].status))
-  return
-
 async def fix_position(symbol, qty):
   logger = logging.getLogger(__name__)
+  broker.priority.set(broker.CLOSE)
   side = 'buy' if qty > 0 else 'sell'
   request = MarketOrderRequest(symbol = symbol, qty = abs(qty),
                                side = side,
+                               client_order_id = stamp(symbol),
                                time_in_force = 'day')
-  g.orders[symbol] = {side: None}
   filled_qty, filled_avg_price = await market_qty(request, symbol)
   if filled_qty == abs(qty):
-    logger.info('Position in %s repaired' % symbol)
+    logger.info('Position in %s repaired', symbol)
   else:
-    logger.error('Market %s order %s for %s only %s/%s filled with status %s' %
-                 (side, g.orders[symbol][side].id, symbol,
-                  filled_qty, abs(qty),
-                  g.orders[symbol][side].status))
+    logger.error('Market %s order for %s only %s/%s filled',
+                 side, symbol, filled_qty, abs(qty))
   return
 
 def equity(account):
   return max(float(account.equity) - g.EXCESS_CAPITAL,1)
 
 def cash(account):
-  cash_basis = 0.0
-  for key, t in g.trades.items():
-    if t.status() == 'open':
-      # side, qty, avg_entry_price
-      for s, p in t.get_position().items():
-        cash_basis = cash_basis + p['qty'] * p['avg_entry_price']
-  return max(float(account.equity) - cash_basis - g.EXCESS_CAPITAL,0)
+  # ledger.cost_basis is the cost basis of every open trade's positions
+  return max(float(account.equity) - ledger.cost_basis - g.EXCESS_CAPITAL,0)
 
-def account_ok():
+async def account_ok():
   logger = logging.getLogger(__name__)
-  account = g.tclient.get_account()
+  account, positions = await asyncio.gather(broker.get_account(),
+                                            broker.get_all_positions())
   if account.trading_blocked:
     logger.error('Trading blocked, exiting')
     return 0
@@ -873,15 +843,18 @@ def account_ok():
   if not account.shorting_enabled:
     logger.error('Shorting disabled, exiting')
     return 0
+  g.account = account
+  g.positions = positions
+  ledger.rebuild()
+  ledger.seed(positions)
   g.equity = equity(account)
   g.cash = cash(account)
-  g.positions = g.tclient.get_all_positions()
   return 1
 
 def set_trade_size():
   logger = logging.getLogger(__name__)
   g.trade_size = g.equity * g.MAX_TRADE_SIZE
-  logger.info('trade_size = %s' % g.trade_size)
+  logger.info('trade_size = %s', g.trade_size)
   return
 
 def stamp(s):
@@ -914,7 +887,7 @@ async def fractional_try_close_obsolete():
       await asyncio.sleep(2)
       for i in range(g.EXECUTION_ATTEMPTS):
         if g.orders[self._title]['buy'].status != 'filled':
-          latest_trade = get_latest_trade(self._symbols[_short].symbol)
+          latest_trade = await get_latest_trade(self._symbols[_short].symbol)
           if (latest_trade[self._symbols[_short].symbol].price
               > price[_short] + sigma_box_short): break
           new_short_limit=(
@@ -926,7 +899,7 @@ async def fractional_try_close_obsolete():
             updated_short_request = ReplaceOrderRequest(
                                     limit_price=new_short_limit,
                                     client_order_id=stamp(self._title))
-            order_try = try_replace(short_order.id,
+            order_try = await try_replace(short_order.id,
                                     updated_short_request)
             short_order = order_try if order_try is not None else short_order
             short_limit = new_short_limit
@@ -943,12 +916,12 @@ async def fractional_try_close_obsolete():
         await try_submit(fractional_long_request)
         await asyncio.sleep(2)
         if g.orders[self._title]['sell'].status == 'filled':
-          logger.info('%s closed' % self._title)
+          logger.info('%s closed', self._title)
         else:
-          logger.error('Market sell order %s for %s not filled: status %s' %
-                       (g.orders[self._title]['sell'].id,
-                        self._symbols[_long].symbol,
-                        g.orders[self._title]['sell'].status))
+          logger.error('Market sell order %s for %s not filled: status %s',
+                       g.orders[self._title]['sell'].id,
+                       self._symbols[_long].symbol,
+                       g.orders[self._title]['sell'].status)
         if _short:
           exit_price = (
             float(g.orders[self._title]['sell'].filled_avg_price),
@@ -963,13 +936,13 @@ async def fractional_try_close_obsolete():
                           {'side':None,'qty':0,'avg_entry_price':0.0}]
         return 0
       else:
-        logger.warning('%s order unfilled after %s attempts' %
-                       (self._title, g.EXECUTION_ATTEMPTS))
+        logger.warning('%s order unfilled after %s attempts',
+                       self._title, g.EXECUTION_ATTEMPTS)
         self._status = 'open'
         qty_covered = float(g.orders[self._title]['buy'].filled_qty)
         notional_covered = (
           qty_covered * float(g.orders[self._title]['buy'].filled_avg_price))
-        try_cancel(short_order.id)
+        await try_cancel(short_order.id)
         if qty_covered == 0: return 0
         else:
            # In this case our P/L calculations will be off since we will
@@ -986,9 +959,9 @@ async def fractional_try_close_obsolete():
         adjust_long_order = await try_submit(adjust_long_request)
         await asyncio.sleep(2)
         if g.orders[self._title]['sell'].status != 'filled':
-          logger.error('Market buy order for %s not filled (status %s); position remains open and is unbalanced' %
-                       (self._symbols[_long].symbol,
-                        g.orders[self._title]['sell'].status))
+          logger.error('Market buy order for %s not filled (status %s); position remains open and is unbalanced',
+                       self._symbols[_long].symbol,
+                       g.orders[self._title]['sell'].status)
         return 0
 
 async def fractional_try_open_obsolete():
@@ -1006,14 +979,14 @@ async def fractional_try_open_obsolete():
                       client_order_id = stamp(self._title),
                       limit_price = short_limit
                       )
-      logger.info('Submitting short request for %s, qty=%s, limit_price=%s' % (self._symbols[to_short].symbol, math.floor((g.trade_size/2) / short_limit), short_limit))
+      logger.info('Submitting short request for %s, qty=%s, limit_price=%s', self._symbols[to_short].symbol, math.floor((g.trade_size/2) / short_limit), short_limit)
       g.orders[self._title] = {'buy': None, 'sell': None}
       short_order = await try_submit(short_request)
       sigma_box_short = stddev * g.SIGMA_BOX if to_short else abs(stddev_x) * g.SIGMA_BOX
       await asyncio.sleep(2)
       for i in range(g.EXECUTION_ATTEMPTS):
         if g.orders[self._title]['sell'].status != 'filled':
-          latest_trade = get_latest_trade(self._symbols[to_short].symbol)
+          latest_trade = await get_latest_trade(self._symbols[to_short].symbol)
           if (latest_trade[self._symbols[to_short].symbol].price
               < price[to_short] - sigma_box_short): break
           new_short_limit=(
@@ -1025,8 +998,8 @@ async def fractional_try_open_obsolete():
             updated_short_request = ReplaceOrderRequest(
                                   limit_price=new_short_limit,
                                   client_order_id = stamp(self._title))
-            logger.info('Replacing short request for %s with limit price %s' % (self._symbols[to_short].symbol, new_short_limit))
-            order_try = try_replace(short_order.id,
+            logger.info('Replacing short request for %s with limit price %s', self._symbols[to_short].symbol, new_short_limit)
+            order_try = await try_replace(short_order.id,
                                     updated_short_request)
             short_order = order_try if order_try is not None else short_order
             short_limit = new_short_limit
@@ -1041,7 +1014,7 @@ async def fractional_try_open_obsolete():
                               client_order_id = stamp(self._title),
                               time_in_force = 'day')
         await try_submit(fractional_long_request)
-        logger.info('Submitting fractional long request for %s, notional=%s' % (self._symbols[to_long].symbol, fractional_long_notional))
+        logger.info('Submitting fractional long request for %s, notional=%s', self._symbols[to_long].symbol, fractional_long_notional)
         await asyncio.sleep(2)
         if g.orders[self._title]['buy'].status == 'filled':
           self._position[to_short]={'side':'short',
@@ -1058,17 +1031,17 @@ async def fractional_try_open_obsolete():
           return 0
         else:
           self._status = 'closed'
-          logger.error('Market buy order %s for %s not filled: status %s' %
-                       (g.orders[self._title]['buy'].id,
-                        self._symbols[to_short].symbol,
-                        g.orders[self._title]['buy'].status))
+          logger.error('Market buy order %s for %s not filled: status %s',
+                       g.orders[self._title]['buy'].id,
+                       self._symbols[to_short].symbol,
+                       g.orders[self._title]['buy'].status)
         return 0
       else:
-        logger.warning('%s order unfilled after %s attempts' %
-                       (self._title, g.EXECUTION_ATTEMPTS))
+        logger.warning('%s order unfilled after %s attempts',
+                       self._title, g.EXECUTION_ATTEMPTS)
         self._status = 'closed'
         short_qty_filled = int(g.orders[self._title]['sell'].filled_qty)
-        try_cancel(short_order.id)
+        await try_cancel(short_order.id)
         if short_qty_filled == 0: return 0
         cover_short_request = MarketOrderRequest(
                               symbol = self._symbols[to_short].symbol,
@@ -1079,8 +1052,8 @@ async def fractional_try_open_obsolete():
         cover_short_order = await try_submit(cover_short_request)
         await asyncio.sleep(2)
         if g.orders[self._title]['buy'].status != 'filled':
-          logger.error('Market buy order %s for %s not filled: status %s' %
-                       (g.orders[self._title]['buy'].id,
-                        self._symbols[to_short].symbol,
-                        g.orders[self._title]['buy'].status))
+          logger.error('Market buy order %s for %s not filled: status %s',
+                       g.orders[self._title]['buy'].id,
+                       self._symbols[to_short].symbol,
+                       g.orders[self._title]['buy'].status)
         return 0
\ No newline at end of file
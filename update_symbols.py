@@ -24,4 +24,4 @@ def update_symbols(*argv):
   return
 
 if __name__ == '__main__':
-  update_symbols(*(sys.argv[1:]))
\ No newline at end of file
+  update_symbols(*(a for a in sys.argv[1:] if a != '--profile'))
\ No newline at end of file
@@ -0,0 +1,138 @@
+import logging
+import os
+from io import BytesIO
+import time
+from datetime import datetime as dt
+from datetime import timedelta as td
+import pandas as pd
+import numpy as np
+from alpaca.data.requests import StockBarsRequest
+from alpaca.data.timeframe import TimeFrame
+from alpaca.common.exceptions import APIError
+from . import config as g
+from . import models
+
+'''
+Pre-open warm-up. A fresh Trade starts with an empty sigma series, so
+open_signal has nothing to go on until live bars arrive and bail_out_signal
+needs a week of history. Before the open we read the last WARMUP_SESSIONS
+sessions of minute bars for every active symbol from the tail of its file
+in the local bar store (one batched historical request covers symbols
+missing from the store), then compute each pair's sigma history at once
+with NumPy.
+'''
+COLUMNS = ['symbol','timestamp','open','high','low','close','volume',
+           'trade_count','vwap']
+CHUNK = 1 << 20
+
+def tail_frame(path, since):
+  '''
+  Read the tail of a bar file back to the first bar before since, without
+  parsing the rest of the (possibly multi-gigabyte) file.
+  Returns a DataFrame of every column with a UTC timestamp column.
+  '''
+  with open(path, 'rb') as f:
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    pos = end
+    data = b''
+    while pos > 0:
+      # Read only the chunk before what was read so far
+      step = min(CHUNK, pos)
+      pos = pos - step
+      f.seek(pos)
+      data = f.read(step) + data
+      # The first complete line, unless we are at the start of the file
+      start = data.find(b'\n') + 1 if pos > 0 else 0
+      stop = data.find(b'\n', start)
+      if stop < 0: continue
+      try: ts = pd.Timestamp(data[start:stop].split(b',')[1].decode())
+      except (IndexError, ValueError): continue
+      if ts < since: break
+  if pos > 0: data = data.split(b'\n', 1)[1]
+  frame = pd.read_csv(BytesIO(data), header=None, names=COLUMNS)
+  frame = frame[frame['timestamp'] != 'timestamp'].copy()
+  frame[COLUMNS[2:]] = frame[COLUMNS[2:]].astype(np.float64)
+  frame['timestamp'] = pd.to_datetime(frame['timestamp'], utc=True)
+  return frame[frame['timestamp'] >= since]
+
+def tail_bars(path, since):
+  '''
+  Returns the vwap since since as a Series indexed by UTC timestamp.
+  '''
+  frame = tail_frame(path, since)
+  return pd.Series(frame['vwap'].to_numpy(dtype=np.float64),
+                   index=pd.DatetimeIndex(frame['timestamp']))
+
+def fetch_bars(symbols, since):
+  logger = logging.getLogger(__name__)
+  request = StockBarsRequest(symbol_or_symbols=symbols,
+                             timeframe=TimeFrame.Minute,
+                             start=since, adjustment='split')
+  try: df = g.hclient.get_stock_bars(request).df
+  except (APIError, AttributeError) as error:
+    logger.error('Batched bar request failed: %s' % error)
+    return {}
+  bars = {}
+  for symbol, frame in df.groupby(level='symbol'):
+    index = pd.to_datetime(frame.index.get_level_values('timestamp'),
+                           utc=True)
+    bars[symbol] = pd.Series(frame['vwap'].to_numpy(dtype=np.float64),
+                             index=index)
+  return bars
+
+def last_sessions(s, n):
+  dates = pd.Index(s.index.date).unique()
+  if len(dates) <= n: return s
+  return s[s.index.date >= dates[-n]]
+
+def load_bars(symbols, sessions):
+  logger = logging.getLogger(__name__)
+  # Enough calendar days to cover weekends and holidays
+  since = pd.Timestamp(dt.now() - td(days=sessions * 7 // 5 + 4), tz='UTC')
+  bars = {}
+  missing = []
+  for symbol in symbols:
+    path = os.path.join(g.minute_bar_dir, symbol + '.csv')
+    try: bars[symbol] = tail_bars(path, since)
+    except FileNotFoundError: missing.append(symbol)
+  if missing:
+    logger.info('Requesting bars for %s symbols not in the bar store' %
+                len(missing))
+    bars.update(fetch_bars(missing, since))
+  return {s: last_sessions(b, sessions) for s, b in bars.items()}
+
+def sigma_history(p, x, y):
+  '''
+  Sigma series of a pair over the timestamps its two symbols share.
+  '''
+  xy = pd.concat([x, y], axis=1, join='inner')
+  xv = xy.iloc[:, 0].to_numpy()
+  yv = xy.iloc[:, 1].to_numpy()
+  sigma = np.abs(yv - models.mean(p, xv)) / models.stddev(p, xv)
+  return pd.Series(sigma, index=xy.index)
+
+def warm_up(sessions=None, titles=None):
+  '''
+  Warm up every enabled pair, or only those in titles (see reload.py).
+  '''
+  logger = logging.getLogger(__name__)
+  start = time.monotonic()
+  sessions = g.WARMUP_SESSIONS if sessions is None else sessions
+  titles = g.trades.keys() if titles is None else titles
+  trades = {k: g.trades[k] for k in titles
+            if g.trades[k].status() != 'disabled'}
+  symbols = set()
+  for key in trades.keys(): symbols.update(key.split('-'))
+  bars = load_bars(sorted(symbols), sessions)
+  logger.info('Loaded %s sessions of bars for %s symbols in %.2f seconds' %
+              (sessions, len(bars), time.monotonic() - start))
+  warmed = 0
+  for key, t in trades.items():
+    s1, s2 = key.split('-')
+    if s1 not in bars.keys() or s2 not in bars.keys(): continue
+    t.warm_up(sigma_history(t._params, bars[s1], bars[s2]))
+    warmed = warmed + 1
+  logger.info('Warmed up %s/%s pairs in %.2f seconds' %
+              (warmed, len(trades), time.monotonic() - start))
+  return